@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+from   concurrent.futures import as_completed
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from   deployer import cache
+from   deployer import clients
+from   deployer import context
+from   deployer import pipeline
+from   deployer import s3
+from   deployer import tracing
+from   deployer import utils
+from   deployer.exceptions import ArtifactDownloadException
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# Defaults for the 'artifact_cache' section of the deployer config.
+CACHE_DEFAULTS = {
+    # Largest total size (bytes) of the local artifact cache. The least
+    # recently used artifacts are evicted beyond it. 0 turns the cache
+    # off; artifacts are then downloaded straight into place.
+    'max_bytes' : 20 * 1024 ** 3,
+
+    # Concurrent artifact downloads.
+    'workers'   : 4,
+}
+
+# Temporary download files older than this many seconds were left
+# behind by an interrupted run, and are removed on eviction.
+STALE_DOWNLOAD_AGE = 86400
+
+# Artifacts are stored once per distinct content, as
+# <cache dir>/artifacts/<sha256>. The 'artifact_index' cache namespace
+# maps (bucket, key, ETag, version) to the digest of the content.
+INDEX_NAMESPACE = 'artifact_index'
+
+
+def cache_settings(config):
+    """
+    Return the 'artifact_cache' section of the deployer config, filled
+    in with CACHE_DEFAULTS.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        dict with the keys of CACHE_DEFAULTS.
+    """
+    settings = dict(CACHE_DEFAULTS)
+    settings.update(config.get('artifact_cache', {}))
+    return settings
+
+
+def artifacts_dir():
+    """
+    Return the directory cached artifacts are stored in.
+
+    Args:
+        None
+
+    Returns:
+        string (path)
+    """
+    return os.path.join(cache.cache_dir(), 'artifacts')
+
+
+def fetch(config, bucket, artifacts):
+    """
+    Place S3 objects at local paths, downloading only those which are
+    not already in the local artifact cache.
+
+    Cache entries are keyed by bucket, key, ETag and version, so an
+    object which changes in S3 is always downloaded again. Downloads run
+    concurrently and are verified against the size of the object, and
+    against its SHA-256 digest when the object carries one (see
+    bootstrap.upload_staged_artifacts). Cached files are hard linked
+    into place, or copied where a link is not possible.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+        bucket: string representing a bucket name
+        artifacts: dict of object key to local file path
+
+    Returns:
+        number of bytes downloaded.
+
+    Raises:
+        ArtifactDownloadException if any artifact could not be placed.
+        Its second argument is a dict of key to error message.
+    """
+    if not artifacts:
+        return 0
+
+    settings = cache_settings(config)
+    use_cache = settings['max_bytes'] > 0
+    transfer_config = s3.transfer_config(config)
+    if use_cache:
+        os.makedirs(artifacts_dir(), exist_ok=True)
+
+    workers = min(settings['workers'], len(artifacts))
+    downloaded = 0
+    errors = {}
+    with context.ContextThreadPoolExecutor(max_workers=workers) as executor:
+        futures = { executor.submit(_fetch_artifact, bucket, key, local_file,
+                                    transfer_config, use_cache) : key
+                    for (key, local_file) in artifacts.items() }
+        for future in as_completed(futures):
+            try:
+                downloaded += future.result()
+            except Exception as e:
+                errors[futures[future]] = str(e)
+
+    if use_cache:
+        evict(settings['max_bytes'])
+
+    if errors:
+        msg = "Failed to download {} artifact(s) from {}:\n{}".format(
+            len(errors), bucket,
+            "\n".join("\t{}: {}".format(key, error)
+                      for key, error in sorted(errors.items())))
+        logger.error(msg)
+        raise ArtifactDownloadException(msg, errors)
+
+    tracing.annotate(artifacts=len(artifacts), downloaded_bytes=downloaded)
+    log_msg = "Placed {} artifact(s) from {}, downloaded {}"
+    logger.info(log_msg.format(len(artifacts), bucket,
+                               utils.format_bytes(downloaded)))
+    return downloaded
+
+
+def _fetch_artifact(bucket, key, local_file, transfer_config, use_cache):
+    """
+    Place a single artifact at LOCAL_FILE.
+
+    Returns:
+        number of bytes downloaded (0 on a cache hit).
+    """
+    # Artifacts still queued when the pipeline is cancelled are skipped.
+    pipeline.check_cancelled()
+    metadata = s3.object_metadata(bucket, key)
+    if metadata is None:
+        raise ArtifactDownloadException("{}/{} does not exist".format(bucket,
+                                                                      key))
+
+    os.makedirs(os.path.dirname(local_file), exist_ok=True)
+    index_key = [ bucket, key, metadata['etag'], metadata['version_id'] ]
+    if use_cache:
+        entry = cache.get(INDEX_NAMESPACE, index_key)
+        if entry:
+            blob = _blob_path(entry['sha256'])
+            if (_blob_size(blob) == metadata['size'] and
+                _place_cached(blob, local_file)):
+                log_msg = "Using cached {}/{} for {}"
+                logger.debug(log_msg.format(bucket, key, local_file))
+                return 0
+
+    download_dir = artifacts_dir() if use_cache else os.path.dirname(local_file)
+    (fd, tmp_file) = tempfile.mkstemp(dir=download_dir, prefix='.tmp-')
+    os.close(fd)
+    try:
+        extra_args = {}
+        if metadata['version_id']:
+            extra_args['VersionId'] = metadata['version_id']
+        started = time.time()
+        clients.client('s3').download_file(bucket, key, tmp_file,
+                                           ExtraArgs=extra_args,
+                                           Config=transfer_config)
+        digest = _verify(bucket, key, tmp_file, metadata)
+
+        if use_cache:
+            blob = _blob_path(digest)
+            os.chmod(tmp_file, 0o444)
+            os.replace(tmp_file, blob)
+            cache.put(INDEX_NAMESPACE, index_key,
+                      { 'sha256' : digest, 'size' : metadata['size'] }, None)
+            _place(blob, local_file)
+        else:
+            os.replace(tmp_file, local_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    elapsed = time.time() - started
+    log_msg = "Downloaded {}/{} to {} ({} in {:.1f}s)"
+    logger.debug(log_msg.format(bucket, key, local_file,
+                                utils.format_bytes(metadata['size']),
+                                elapsed))
+    return metadata['size']
+
+
+def _verify(bucket, key, path, metadata):
+    """
+    Check a downloaded file against the HEAD response of its object.
+
+    Returns:
+        string: SHA-256 hex digest of the file.
+
+    Raises:
+        ArtifactDownloadException on a size or digest mismatch.
+    """
+    size = os.path.getsize(path)
+    if size != metadata['size']:
+        msg = "{}/{}: downloaded {} bytes, expected {}".format(
+            bucket, key, size, metadata['size'])
+        raise ArtifactDownloadException(msg)
+
+    digest = utils.file_digest(path, cached=False)
+    expected = metadata['metadata'].get(s3.DIGEST_METADATA_KEY)
+    if expected and expected != digest:
+        msg = "{}/{}: SHA-256 digest {} does not match {}".format(
+            bucket, key, digest, expected)
+        raise ArtifactDownloadException(msg)
+
+    return digest
+
+
+def _blob_path(digest):
+    """
+    Return the path the content with DIGEST is cached at.
+    """
+    return os.path.join(artifacts_dir(), digest)
+
+
+def _blob_size(path):
+    """
+    Return the size of a cached file, or None if it has been evicted.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def _place_cached(blob, local_file):
+    """
+    Place a cached file at LOCAL_FILE on a cache hit.
+
+    Returns:
+        True, or False if it could not be placed (e.g. another deployer
+        process evicted it since it was looked up), so the artifact is
+        downloaded instead.
+    """
+    try:
+        # Mark the entry as recently used for eviction. In a shared cache
+        # the file may belong to another user, who alone may do so.
+        os.utime(blob)
+    except OSError:
+        pass
+    try:
+        _place(blob, local_file)
+    except OSError as e:
+        logger.debug("Cached {} is gone, downloading it: {}".format(blob, e))
+        return False
+
+    return True
+
+
+def _place(blob, local_file):
+    """
+    Hard link a cached file to LOCAL_FILE, copying it across file
+    systems.
+    """
+    if os.path.lexists(local_file):
+        os.remove(local_file)
+    try:
+        os.link(blob, local_file)
+    except OSError:
+        shutil.copyfile(blob, local_file)
+
+    return
+
+
+def evict(max_bytes):
+    """
+    Remove the least recently used cached artifacts until the cache
+    holds at most MAX_BYTES.
+
+    Args:
+        max_bytes: int, size (bytes) to shrink the cache to.
+
+    Returns:
+        number of artifacts removed.
+    """
+    entries = []
+    now = time.time()
+    try:
+        names = os.listdir(artifacts_dir())
+    except OSError:
+        return 0
+
+    for name in names:
+        path = os.path.join(artifacts_dir(), name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if name.startswith('.tmp-'):
+            if now - stat.st_mtime > STALE_DOWNLOAD_AGE:
+                os.remove(path)
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for (_, size, _) in entries)
+    removed = 0
+    for (_, size, path) in sorted(entries):
+        if total <= max_bytes:
+            break
+        logger.debug("Evicting cached artifact {}".format(path))
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+
+    return removed
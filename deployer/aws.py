@@ -1,21 +1,84 @@
 # -*- coding: utf-8 -*-
 #
 # Copyright Veracode Inc., 2014
-import boto3
+from collections import namedtuple
+from concurrent.futures import (FIRST_COMPLETED,
+                                wait)
+import hashlib
 import logging
 import os
-from botocore.exceptions import ClientError
-
+import random
+import threading
+import time
+from botocore.exceptions import (BotoCoreError,
+                                 ClientError)
+
+from   deployer import cache
+from   deployer import clients
+from   deployer import context
+from   deployer import metrics
+from   deployer import tracing
 import deployer.utils as utils
 import deployer.s3
+from   deployer.exceptions import ( MissingConfigurationParameterException,
+                                    ResourceTaggingException )
 
 logger = logging.getLogger(os.path.basename('deployer'))
 
+# EC2 describe_* calls accept at most 200 values per filter.
+DESCRIBE_FILTER_LIMIT = 200
+
+# get_resources() returns at most 100 resources per page.
+TAGGING_PAGE_SIZE = 100
+
+settings = {
+    # Seconds a resolved account id is kept in the local cache, keyed by
+    # the credentials it was resolved with. 0 turns the on-disk cache
+    # off. Account names are never cached on disk.
+    'identity_cache_ttl' : 3600,
+
+    # Concurrent tag_resources() calls, and how hard to retry the ARNs
+    # which fail.
+    'tagging_workers'      : 4,
+    'tagging_max_attempts' : 6,
+    'tagging_base_backoff' : 0.5,
+    'tagging_max_backoff'  : 20,
+
+    # Seconds vpc_inventory() reuses an index for before describing the
+    # VPCs again.
+    'vpc_inventory_ttl'    : 60,
+}
+
+# Error codes AWS uses when it's throttling us.
+THROTTLING_ERRORS = ( 'Throttling',
+                      'ThrottlingException',
+                      'ThrottledException',
+                      'RequestLimitExceeded',
+                      'TooManyRequestsException' )
+
+_identities = {}
+_identity_lock = threading.Lock()
+
+# Tags VPCs are indexed by in vpc_inventory().
+VPC_INVENTORY_TAGS = ( 'env', 'Name' )
+_vpc_inventories = {}
+_vpc_inventory_lock = threading.Lock()
+
+# A resource returned by the ResourceGroupsTaggingAPI. 'tags' is a dict
+# of tag key to value.
+TaggedResource = namedtuple('TaggedResource',
+                            ['arn', 'resource_type', 'resource_id', 'tags'])
+
 
 def configure(config):
     """
-    Configure the environment for both Terraform & boto3 to operate
-    via the AWS API.
+    Configure both Terraform & boto3 to operate via the AWS API.
+
+    The profile and region, and the settings tuning AWS access, are set
+    on a DeploymentContext (see deployer.context), activated for the
+    calling thread and everything it starts. Neither the process
+    environment nor any process-wide setting is changed, so deployments
+    to other accounts or regions can run on other threads.
 
     Args:
         config: dictionary containing all variable settings required
@@ -24,47 +87,35 @@ def configure(config):
     Returns:
         config
     """
-    # Clear out AWS_* vars from the environment if they exist
-    try:
-        os.environ.pop('AWS_DEFAULT_PROFILE')
-        os.environ.pop('AWS_SECRET_ACCESS_KEY')
-        os.environ.pop('AWS_ACCESS_KEY_ID')
-        os.environ.pop('AWS_DEFAULT_REGION')
-    except KeyError:
-        # They weren't set, so move on
-        pass
-
-    # Set the default profile
-    os.environ['AWS_DEFAULT_PROFILE'] = config['aws_profile']
-    os.environ['AWS_PROFILE'] = config['aws_profile']
-    os.environ['AWS_DEFAULT_REGION'] = config['aws_region']
-
-    if os.environ.get('API_TOKEN') and "API_TOKEN" in config.get('terraform'):
-        git_url = config['terraform']
-        config['terraform'] = git_url.replace("API_TOKEN",
-                                              os.environ['API_TOKEN'])
-        config['API_TOKEN'] = os.environ['API_TOKEN']
-
-    boto3.setup_default_session(profile_name=config['aws_profile'])
-    boto_profile = get_account_name()
+    deployment = context.activate(context.from_config(config))
+
+    utils.substitute_api_token(config)
+
+    # The AWS tunables of the config are carried on the deployment's
+    # context; these only warn about unknown ones.
+    clients.configure(config)
+    metrics.configure(config)
+    # Always asked of IAM, never taken from a cache: the profile's
+    # credentials may have been pointed at another account since.
+    boto_profile = get_account_name(refresh=True)
     # Verify the profile name we get back from AWS is the same as we just set
     # otherwise exit now.
     try:
-        assert(os.environ.get('AWS_DEFAULT_PROFILE') == config['aws_profile'])
         assert(config['aws_profile'] == boto_profile)
-        assert(os.environ.get('AWS_DEFAULT_PROFILE') == boto_profile)
+        assert(deployment.profile == boto_profile)
     except AssertionError:
-        msg = "AWS_DEFAULT_PROFILE mismatch with reality.\n"
-        msg += "\t   AWS_DEFAULT_PROFILE:              {}\n"
+        msg = "AWS profile mismatch with reality.\n"
+        msg += "\t   Deployment profile:               {}\n"
         msg += "\t   Profile passed in from config:    {}\n"
         msg += "\t   Profile boto3 thinks we're using: {}\n"
-        logger.critical(msg.format(os.environ.get('AWS_DEFAULT_PROFILE'),
+        logger.critical(msg.format(deployment.profile,
                                    config['aws_profile'],
                                    boto_profile))
         raise
 
+    if 'account_id' not in config:
+        config['account_id'] = get_account_id()
     config['availability_zones'] = get_current_az_list(config)
-    config['account_id'] = config.get('account_id', get_account_id())
 
     env_name = "{}".format(config['environment'].get('name'))
     if config['environment'].get('version'):
@@ -81,15 +132,14 @@ def configure(config):
     # Figure out where our buckets are.  This should go in pre-flight,
     # but we haven't established our account_id yet, therefore needs
     # to be here, after we set up the aws stuff.
-    config['project_config'] = config.get('project_config',
-                                          deployer.s3.get_bucket_name(config,
-                                                                      'data'))
+    if 'project_config' not in config:
+        config['project_config'] = deployer.s3.get_bucket_name(config, 'data')
 
     config['env_folder'] = config.get('env_folder', env_name)
 
-    tf_state_bucket_name = deployer.s3.get_bucket_name(config, "tfstate")
-    config['tf_state_bucket'] = config.get('tf_state_bucket',
-                                           tf_state_bucket_name)
+    if 'tf_state_bucket' not in config:
+        config['tf_state_bucket'] = deployer.s3.get_bucket_name(config,
+                                                                "tfstate")
     tf_state = "{}.tfstate".format(env_name)
     config['tf_state'] = config.get('tf_state', tf_state)
     config['env_name'] = config.get('env_name', env_name)
@@ -99,33 +149,114 @@ def configure(config):
     return config
 
 
-def get_account_name():
+def get_account_name(profile=None, refresh=False):
     """
     Return the account name we're using based on the value set in the
     deployer config file.
 
+    The name is what configure() checks the profile against, so it is
+    only ever memoized for the life of the process, never cached on
+    disk.
+
     Args:
-         None
+         profile: string representing an AWS profile name. Defaults to
+                  the profile currently configured.
+         refresh: boolean. Ask IAM again, even if the name is memoized.
 
     Returns:
          String representing the IAM account name.
 
     """
-    return boto3.client('iam').list_account_aliases()['AccountAliases'][0]
+    def lookup(profile):
+        iam = clients.client('iam', profile)
+        return iam.list_account_aliases()['AccountAliases'][0]
 
+    return _identity('account_name', profile, lookup, refresh=refresh)
 
-def get_account_id():
+
+def get_account_id(profile=None):
     """
     Return the account ID we're using based on the value set in the
     deployer config file.
 
     Args:
-        None
+        profile: string representing an AWS profile name. Defaults to
+                 the profile currently configured.
 
     Returns:
         String representing the IAM account number.
     """
-    return boto3.client('sts').get_caller_identity().get('Account')
+    def lookup(profile):
+        sts = clients.client('sts', profile)
+        return sts.get_caller_identity().get('Account')
+
+    return _identity('account_id', profile, lookup, persist=True)
+
+
+def _identity(attribute, profile, lookup, refresh=False, persist=False):
+    """
+    Resolve an identity attribute once per profile.
+
+    Results are memoized for the life of the process. PERSIST ones are,
+    unless settings['identity_cache_ttl'] is 0, also kept in the local
+    cache so later deployer runs don't have to ask STS again. Entries
+    are keyed by the credentials the profile resolves to, not just its
+    name, so pointing a profile at another account never hits an entry
+    of the old one.
+    """
+    profile = clients.resolve(profile)[0]
+    ttl = 0
+    if persist:
+        ttl = context.setting('identity_cache_ttl',
+                              settings['identity_cache_ttl'])
+    with _identity_lock:
+        identity = _identities.setdefault(profile, {})
+        if refresh or attribute not in identity:
+            value = None
+            key = _credentials_key(profile) if ttl else None
+            if key:
+                value = cache.get('identity', [ profile, key, attribute ])
+            if value is None:
+                value = lookup(profile)
+                if key:
+                    cache.put('identity', [ profile, key, attribute ], value,
+                              ttl)
+            identity[attribute] = value
+
+        return identity[attribute]
+
+
+def _credentials_key(profile):
+    """
+    Return a digest of the access key PROFILE's credentials resolve to,
+    or None when they can not be resolved here (boto3 will then fail the
+    call itself, with a better message).
+    """
+    try:
+        credentials = clients.session(profile).get_credentials()
+    except BotoCoreError:
+        return None
+    if credentials is None or not credentials.access_key:
+        return None
+
+    return hashlib.sha256(credentials.access_key.encode('utf-8')).hexdigest()
+
+
+def forget_identities():
+    """
+    Drop every memoized account id and name. The on-disk cache is left
+    alone.
+
+    Args:
+        None
+
+    Returns:
+        nothing
+    """
+    with _identity_lock:
+        _identities.clear()
+
+    return
 
 
 def get_current_region():
@@ -138,7 +269,7 @@ def get_current_region():
     Returns:
         String representing the current region.
     """
-    return boto3.DEFAULT_SESSION.region_name
+    return clients.session().region_name
 
 
 def get_current_az_list(config):
@@ -154,14 +285,26 @@ def get_current_az_list(config):
     """
     avail_zones = config.get('availability_zones', [])
     if not avail_zones:
-        ec2c = boto3.client('ec2')
-        for zone in ec2c.describe_availability_zones()['AvailabilityZones']:
-            if zone['State'] == 'available':
-                avail_zones.append(zone['ZoneName'])
+        def lookup():
+            ec2c = clients.client('ec2', region=region)
+            zones = ec2c.describe_availability_zones()['AvailabilityZones']
+            return [ zone['ZoneName'] for zone in zones
+                     if zone['State'] == 'available' ]
+
+        # Zones almost never change for an account and region, so they
+        # come from the local metadata cache whenever possible.
+        region = config.get('aws_region') or clients.resolve()[1]
+        account_id = config.get('account_id') or get_account_id()
+        avail_zones = cache.memoize('metadata',
+                                    [ account_id, region,
+                                      'availability_zones' ],
+                                    lookup,
+                                    cache.metadata_ttl())
 
     return avail_zones
 
 
+@tracing.traced('environment_exists')
 def environment_exists(env_name, env_vers=None, ephemeral_env=None):
     """
     Checks to see if this desired environment name already exists.
@@ -174,92 +317,490 @@ def environment_exists(env_name, env_vers=None, ephemeral_env=None):
         True:  if the environment exists.
         False: if the environment does not exist.
     """
-    client = boto3.client('resourcegroupstaggingapi')
-    env_name_filter = { 'Key': 'env_name', 'Values': [ env_name ] }
-    env_vers_filter = { 'Key': 'env_version', 'Values': [ env_vers ] }
-    ephemeral_filter = { 'Key': 'system_type', 'Values': [ ephemeral_env ] }
-
     # Search for a value of 'running'. Any other value means the
     # environment doesn't really exist
-    state_filter  = { 'Key': 'deployer_state', 'Values': ['running'] }
+    tag_filters = environment_tag_filters(env_name, env_vers, ephemeral_env,
+                                          state='running')
+
+    # Instances which aren't running and nat gateways which aren't
+    # really there are tagged as running, but don't count.
+    resources = iter_live_resources(iter_tagged_resources(tag_filters))
+    resourceArns = [ resource.arn for resource in resources ]
+    tracing.annotate(resources=len(resourceArns))
+    if len(resourceArns) > 0:
+        return resourceArns
 
-    tag_filters = [ env_name_filter, state_filter ]
-    if env_vers:
-        tag_filters.append(env_vers_filter)
-    if ephemeral_env:
-        tag_filters.append(ephemeral_filter)
+    return False
 
-    results = client.get_resources(TagFilters = tag_filters)
-    resourceArns = []
-    for resource in results['ResourceTagMappingList']:
-        arn = resource['ResourceARN'].split(':')
-        if arn[5].startswith('instance') and not instance_is_running(arn[5]):
-            # Don't add an instance ARN if it's not running.
-            logger.debug("Skipping instance: Not really running")
+
+def live_environment_versions(env_name, ephemeral_env=None):
+    """
+    Return every version of an environment which really exists.
+
+    All resources tagged as running for ENV_NAME are fetched in a single
+    paginated scan and grouped by their env_version tag. Versions with
+    any resource which is always taken at face value are live outright;
+    the instances and nat gateways of the remaining versions are then
+    checked together in one batch.
+
+    Args:
+        env_name: string - Name of environment to check
+        ephemeral_env - Name of ephemeral environment based on product tag.
+
+    Returns:
+        set of version strings in use.
+    """
+    tag_filters = environment_tag_filters(env_name, None, ephemeral_env,
+                                          state='running')
+    candidates = {}
+    live = set()
+    for resource in iter_tagged_resources(tag_filters):
+        version = resource.tags.get('env_version')
+        if not version or version in live:
             continue
-        if arn[5].startswith('nat') and not natgateway_exists(arn[5]):
-            # Don't add a natgw ARN if it's not really there
-            logger.debug("Skipping nat gw: Not really running")
+        if not _needs_liveness_check(resource):
+            live.add(version)
+            candidates.pop(version, None)
             continue
-            
-        # Add non-instance ARN tagged as running and actual running instance
-        resourceArns.append(resource['ResourceARN'])
+        candidates.setdefault(version, []).append(resource.arn)
 
-    if len(resourceArns) > 0:
-        return resourceArns
+    if candidates:
+        liveness = resource_liveness([ arn for arns in candidates.values()
+                                       for arn in arns ])
+        for version, arns in candidates.items():
+            if any(liveness[arn] for arn in arns):
+                live.add(version)
 
-    return False
+    return live
 
 
+def _needs_liveness_check(resource):
+    """
+    Whether a resource tagged as running has to be double-checked with
+    resource_liveness().
+    """
+    return bool(resource.resource_id and
+                (resource.resource_type.startswith('instance') or
+                 resource.resource_type.startswith('nat')))
+
+
+@tracing.traced('tag_resources')
 def tag_resources(config):
     """
     Tag resources based on action.
 
+    Resources already carrying the desired deployer_state are skipped.
+    The rest are tagged in batches of 20 from a bounded pool of
+    workers, and ARNs reported in FailedResourcesMap are retried with
+    jittered backoff.
+
     Args:
         config: dictionary containing all variable settings required
                 to run terraform with
 
-    Returns: nothing
+    Returns:
+        number of resources tagged.
+
+    Raises:
+        ResourceTaggingException if any resource could not be tagged.
     """
-    client = boto3.client('resourcegroupstaggingapi')
+    client = clients.client('resourcegroupstaggingapi')
     env_name = config['environment'].get('name')
     env_vers = config['environment'].get('version', None)
     ephemeral_env = config['tags'].get('system_type', None)
-        
+    tags = { 'deployer_state' : config['tags'].get('deployer_state') }
+
     # Search for all entities with of a given environment name and
     # version AND the deployer_state. deployer_state value is
     # irrellevant, we're going to set it anyway.
-    env_name_filter = { 'Key': 'env_name', 'Values': [ env_name ] }
-    query = [ env_name_filter]
+    # Every resource found is tagged, stopped instances and deleted nat
+    # gateways included, so none is left with a stale deployer_state.
+    query = environment_tag_filters(env_name, env_vers, ephemeral_env)
+    resources = iter_tagged_resources(query, client)
+
+    workers = settings['tagging_workers']
+    failures = {}
+    tagged = 0
+    pending = set()
+    with context.ContextThreadPoolExecutor(max_workers=workers) as executor:
+        # Batches are sent as soon as they fill up, while later pages
+        # are still being discovered. Only a couple of batches per
+        # worker are queued at any time.
+        for batch in _tag_batches(resources, tags):
+            if tags['deployer_state'] is None:
+                msg = "deployer_state tag is not set. Can not tag resources."
+                raise MissingConfigurationParameterException(msg)
+            if len(pending) >= 2 * workers:
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                tagged += _collect(done, failures)
+            pending.add(executor.submit(_tag_batch, client, batch, tags))
+        tagged += _collect(pending, failures)
+
+    if failures:
+        msg = "Failed to tag {} resource(s) with {}:\n{}".format(
+            len(failures), tags,
+            "\n".join("\t{}: {}".format(arn, error)
+                      for arn, error in sorted(failures.items())))
+        logger.error(msg)
+        raise ResourceTaggingException(msg, failures)
+
+    logger.debug("Tagged {} resource(s) with {}".format(tagged, tags))
+    tracing.annotate(tagged=tagged)
+    return tagged
+
+
+def _tag_batches(resources, tags):
+    """
+    Group the resources which don't already carry TAGS into lists of
+    ARNs tag_resources() can handle in a single call.
+    """
+    # tag_resources() can only handle 20 ARNs at a time.
+    stupidAWSlimit = 20
+    resourceArns = []
+    for resource in resources:
+        if all(resource.tags.get(k) == v for k, v in tags.items()):
+            logger.debug("Skipping {}: already tagged".format(resource.arn))
+            continue
+        resourceArns.append(resource.arn)
+        if len(resourceArns) == stupidAWSlimit:
+            yield resourceArns
+            resourceArns = []
 
-    if env_vers:
-        env_vers_filter = { 'Key': 'env_version', 'Values': [ env_vers ] }
-        query.append(env_vers_filter)
+    if len(resourceArns) > 0:
+        yield resourceArns
 
-    if ephemeral_env:
-        ephemeral_filter = { 'Key': 'system_type', 'Values': [ ephemeral_env ] }
-        query.append(ephemeral_filter)
-        
-    results = client.get_resources(TagFilters = query)
-    resourceArns = []
-    if len(results['ResourceTagMappingList']) > 0:
-        for resource in results['ResourceTagMappingList']:
-            arn = resource['ResourceARN'].split(':')
-            if ( (arn[5].startswith('instance') and instance_is_running(arn[5]))
-                 or (arn[5].startswith('nat') and natgateway_exists(arn[5]))):
-                resourceArns.append(resource['ResourceARN'])
+
+def _collect(futures, failures):
+    """
+    Gather the results of finished _tag_batch() futures, adding their
+    failures to FAILURES. Returns the number of resources tagged.
+    """
+    tagged = 0
+    for future in futures:
+        (succeeded, failed) = future.result()
+        tagged += succeeded
+        failures.update(failed)
+
+    return tagged
+
+
+def _tag_batch(client, arns, tags):
+    """
+    Tag a single batch of ARNs, retrying the ones which fail for
+    transient reasons.
+
+    Returns:
+        (number tagged, dict of ARN to error for ARNs which failed)
+    """
+    attempts = settings['tagging_max_attempts']
+    failed = {}
+    remaining = list(arns)
+    for attempt in range(attempts):
+        if attempt:
+            _backoff(attempt)
+        try:
+            response = client.tag_resources(ResourceARNList=remaining,
+                                            Tags=tags)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in THROTTLING_ERRORS or attempt == attempts - 1:
+                raise
+            logger.debug("Throttled tagging {} resources, retrying".format(
+                len(remaining)))
+            continue
+
+        retry = []
+        for arn, error in response.get('FailedResourcesMap', {}).items():
+            if _retryable(error) and attempt < attempts - 1:
+                retry.append(arn)
             else:
-                # If it's not an instance, we'll deal with it anyway.
-                resourceArns.append(resource['ResourceARN'])
+                failed[arn] = "{}: {}".format(error.get('ErrorCode'),
+                                              error.get('ErrorMessage'))
+        remaining = retry
+        if not remaining:
+            break
 
-    if len(resourceArns) > 0:
-        # tag_resources() can only handle 20 ARNs at a time.
-        stupidAWSlimit = 20
-        for arn in (range(0, len(resourceArns), stupidAWSlimit )):
-            tag_results = client.tag_resources(
-                ResourceARNList = resourceArns[ arn : arn + stupidAWSlimit ],
-                Tags = { 'deployer_state' : config['tags']['deployer_state']})
-    return
+    return (len(arns) - len(failed), failed)
+
+
+def _retryable(error):
+    """
+    Decide whether a FailedResourcesMap entry is worth retrying.
+    """
+    return (error.get('ErrorCode') in THROTTLING_ERRORS or
+            error.get('ErrorCode') == 'InternalServiceException' or
+            error.get('StatusCode', 0) >= 500 or
+            error.get('StatusCode') == 429)
+
+
+def _backoff(attempt):
+    """
+    Sleep for an exponentially growing, fully jittered interval.
+    """
+    ceiling = min(settings['tagging_max_backoff'],
+                  settings['tagging_base_backoff'] * (2 ** attempt))
+    time.sleep(random.uniform(0, ceiling))
+
+
+def environment_tag_filters(env_name, env_vers=None, ephemeral_env=None,
+                            state=None):
+    """
+    Build the ResourceGroupsTaggingAPI TagFilters selecting the
+    resources of an environment.
+
+    Args:
+        env_name: string - Name of environment
+        env_vers: string - Version of environment
+        ephemeral_env: string - Name of ephemeral environment based on
+                       product tag.
+        state: string - Required value of the deployer_state tag.
+
+    Returns:
+        list of TagFilter dicts.
+    """
+    tag_filters = [ { 'Key': 'env_name', 'Values': [ env_name ] } ]
+    if state:
+        tag_filters.append({ 'Key': 'deployer_state', 'Values': [ state ] })
+    if env_vers:
+        tag_filters.append({ 'Key': 'env_version', 'Values': [ env_vers ] })
+    if ephemeral_env:
+        tag_filters.append({ 'Key': 'system_type',
+                             'Values': [ ephemeral_env ] })
+
+    return tag_filters
+
+
+def iter_tagged_resources(tag_filters, client=None):
+    """
+    Stream every resource matching TAG_FILTERS from the
+    ResourceGroupsTaggingAPI, following PaginationToken until the
+    listing is complete.
+
+    Pages are only fetched as the caller consumes records, so work on
+    the first resources can start before later pages arrive, and the
+    full listing is never held in memory.
+
+    Args:
+        tag_filters: list of TagFilter dicts, as passed to get_resources()
+        client: optional resourcegroupstaggingapi client to reuse
+
+    Yields:
+        TaggedResource records.
+    """
+    client = client or clients.client('resourcegroupstaggingapi')
+    paginator = client.get_paginator('get_resources')
+    pages = paginator.paginate(TagFilters=tag_filters,
+                               ResourcesPerPage=TAGGING_PAGE_SIZE)
+    for page in pages:
+        for mapping in page.get('ResourceTagMappingList', []):
+            arn = mapping['ResourceARN']
+            (resource_type, resource_id) = arn_resource(arn)
+            tags = { tag['Key']: tag['Value']
+                     for tag in mapping.get('Tags', []) }
+            yield TaggedResource(arn, resource_type, resource_id, tags)
+
+
+def iter_live_resources(resources, batch_size=TAGGING_PAGE_SIZE):
+    """
+    Filter a stream of TaggedResource records down to those which are
+    really there.
+
+    Records are checked in batches of BATCH_SIZE with
+    resource_liveness(), and the live ones are yielded before the next
+    batch is pulled from RESOURCES.
+
+    Args:
+        resources: iterable of TaggedResource records
+        batch_size: number of records to check per batch
+
+    Yields:
+        TaggedResource records, in the order they were received.
+    """
+    batch = []
+    for resource in resources:
+        batch.append(resource)
+        if len(batch) >= batch_size:
+            for live in _live_batch(batch):
+                yield live
+            batch = []
+
+    for live in _live_batch(batch):
+        yield live
+
+
+def _live_batch(batch):
+    """
+    Return the live TaggedResource records out of BATCH.
+    """
+    if not batch:
+        return []
+    liveness = resource_liveness([ resource.arn for resource in batch ])
+    live = []
+    for resource in batch:
+        if not liveness[resource.arn]:
+            logger.debug("Skipping {}: Not really running".format(resource.arn))
+            continue
+        live.append(resource)
+
+    return live
+
+
+def arn_resource(arn):
+    """
+    Split the resource portion of an ARN into its type and id.
+
+    Args:
+        arn: String representing an ARN,
+             e.g. arn:aws:ec2:us-east-1:123456789012:instance/i-c3bef428
+
+    Returns:
+        (resource_type, resource_id) tuple of strings. resource_id is
+        None if the ARN has no resource id component.
+    """
+    resource = arn.split(':', 5)[5]
+    if '/' in resource:
+        (resource_type, resource_id) = resource.split('/', 1)
+        return (resource_type, resource_id)
+
+    return (resource, None)
+
+
+def live_resources(arns):
+    """
+    Filter a list of ARNs down to those which are really there.
+
+    Instances must be running and nat gateways must not be deleted.
+    Every other resource type is taken at face value. Liveness is
+    resolved with batched describe calls via resource_liveness().
+
+    Args:
+        arns: list of ARN strings
+
+    Returns:
+        list of ARN strings, in the order they were passed in.
+    """
+    liveness = resource_liveness(arns)
+    live = []
+    for arn in arns:
+        if not liveness[arn]:
+            logger.debug("Skipping {}: Not really running".format(arn))
+            continue
+        live.append(arn)
+
+    return live
+
+
+def resource_liveness(arns):
+    """
+    Determine the liveness of many resources at once.
+
+    ARNs are grouped by resource type so a whole environment is
+    resolved with a handful of multi-ID describe calls rather than
+    one call per resource.
+
+    Args:
+        arns: iterable of ARN strings
+
+    Returns:
+        dict mapping each ARN to True or False.
+    """
+    instances = {}
+    natgws = {}
+    liveness = {}
+    for arn in arns:
+        (resource_type, resource_id) = arn_resource(arn)
+        if resource_type.startswith('instance') and resource_id:
+            instances[arn] = resource_id
+        elif resource_type.startswith('nat') and resource_id:
+            natgws[arn] = resource_id
+        else:
+            liveness[arn] = True
+
+    if instances or natgws:
+        ec2c = clients.client('ec2')
+    if instances:
+        states = instance_states(set(instances.values()), ec2c)
+        for arn, instance_id in instances.items():
+            liveness[arn] = states.get(instance_id) == 'running'
+    if natgws:
+        states = natgateway_states(set(natgws.values()), ec2c)
+        for arn, natgw_id in natgws.items():
+            liveness[arn] = states.get(natgw_id, 'deleted') != 'deleted'
+
+    return liveness
+
+
+def _chunks(items, size):
+    """
+    Yield successive lists of at most SIZE elements from ITEMS.
+    """
+    items = sorted(items)
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def instance_states(instance_ids, ec2c=None):
+    """
+    Look up the state of many instances at once.
+
+    Instance ids are passed as a filter rather than via InstanceIds, so
+    ids which no longer exist are simply absent from the result instead
+    of failing the whole request. Any other error (e.g. access denied,
+    or throttling outlasting the client's retries) is raised: treating
+    a chunk of instances as gone could make a live environment look
+    absent.
+
+    Args:
+        instance_ids: iterable of instance id strings
+        ec2c: optional ec2 client to reuse
+
+    Returns:
+        dict mapping instance id to state name, e.g. 'running'. Instances
+        which could not be found are not included.
+
+    Raises:
+        botocore.exceptions.ClientError
+    """
+    ec2c = ec2c or clients.client('ec2')
+    states = {}
+    paginator = ec2c.get_paginator('describe_instances')
+    for chunk in _chunks(instance_ids, DESCRIBE_FILTER_LIMIT):
+        filters = [{'Name': 'instance-id', 'Values': chunk}]
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page.get('Reservations', []):
+                for instance in reservation.get('Instances', []):
+                    states[instance['InstanceId']] = instance['State']['Name']
+
+    return states
+
+
+def natgateway_states(natgw_ids, ec2c=None):
+    """
+    Look up the state of many nat gateways at once.
+
+    Args:
+        natgw_ids: iterable of nat gateway id strings
+        ec2c: optional ec2 client to reuse
+
+    Returns:
+        dict mapping nat gateway id to state name, e.g. 'available'. Nat
+        gateways which could not be found are not included.
+    """
+    ec2c = ec2c or clients.client('ec2')
+    states = {}
+    paginator = ec2c.get_paginator('describe_nat_gateways')
+    for chunk in _chunks(natgw_ids, DESCRIBE_FILTER_LIMIT):
+        filters = [{'Name': 'nat-gateway-id', 'Values': chunk}]
+        try:
+            for page in paginator.paginate(Filter=filters):
+                for natgw in page.get('NatGateways', []):
+                    states[natgw['NatGatewayId']] = natgw['State']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NatGatewayNotFound':
+                raise
+            # apparently they're ghost natgws
+
+    return states
 
 
 def instance_is_running(arn):
@@ -272,20 +813,8 @@ def instance_is_running(arn):
     Returns:
         True or False based on the state of the instance
     """
-    instance = boto3.client('ec2')
     instance_id = arn.split('/')[1]
-    try:
-        inst = instance.describe_instances(InstanceIds=[ instance_id ])
-        if len(inst['Reservations']) > 0:
-            state = inst['Reservations'][0]['Instances'][0]['State']['Name']
-            # If the ARN is an instance, only append it if it's running
-            if state == 'running':
-                return True
-    except ClientError as e:
-        logger.warn("Client: does not exist, skipping\n{}".format(e))
-        pass
-        
-    return False
+    return instance_states([ instance_id ]).get(instance_id) == 'running'
 
 
 def natgateway_exists(arn):
@@ -298,18 +827,9 @@ def natgateway_exists(arn):
     Returns:
         True or False based on the state of the nat-gateway
     """
-    nat = boto3.client('ec2')
     natgw_id = arn.split('/')[1]
-    try:
-        natgw = nat.describe_nat_gateways(NatGatewayIds=[ natgw_id ])
-        if natgw['NatGateways'][0]['State'] == 'deleted':
-            return False
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'NatGatewayNotFound':
-            # apparently it's a ghost natgw
-            return False
-
-    return True
+    state = natgateway_states([ natgw_id ]).get(natgw_id, 'deleted')
+    return state != 'deleted'
     
 
 def vpc_exists(config):
@@ -325,17 +845,7 @@ def vpc_exists(config):
         False: if the VPC does not exist.
     """
     vpc_name = '{}-{}'.format(config['project'], config['env_name'])
-    vpc_client = boto3.client('ec2')
-    filters = [{'Name': 'tag:Name', 'Values': [vpc_name]}]
-    vpcs = vpc_client.describe_vpcs(Filters=filters)
-    vpc_list = []
-    for vpc in vpcs.get("Vpcs", []):
-        tags = vpc.get("Tags", [])
-        for tag in tags:
-            if tag.get("Key") == 'Name':
-                vpc_list.append(tag.get("Value"))
-
-    return vpc_name in vpc_list
+    return vpc_name in vpc_inventory()['Name']
 
 
 def list_vpcs(env):
@@ -347,7 +857,8 @@ def list_vpcs(env):
              existing VPCs. e.g. coral, malachite, lapis
 
     Returns:
-        list of 'env' tag values. e.g. [ "coral-a", "coral-z", "coral-x" ]
+        sorted list of 'env' tag values, one per VPC. e.g.
+        [ "coral-a", "coral-x", "coral-z" ]
 
     """
 
@@ -361,19 +872,71 @@ def list_vpcs(env):
     #     "coral-z",
     #     "coral-x"
     # ]
-    vpc_client = boto3.client('ec2')
-    filters = [{'Name': 'tag:env',
-                'Values': [ '{}-*'.format(env) ] } ]
-
-    vpcs = vpc_client.describe_vpcs(Filters=filters)
-    env_list = []
-    for vpc in vpcs.get("Vpcs", []):
-        tags = vpc.get("Tags", [])
-        for tag in tags:
-            if tag.get("Key") == 'env':
-                env_list.append(tag.get("Value"))
+    prefix = '{}-'.format(env)
+    env_list = [ value for (value, vpc_ids) in vpc_inventory()['env'].items()
+                 if value.startswith(prefix) for vpc_id in vpc_ids ]
 
     env_list.sort()
     return env_list
 
 
+def vpc_inventory(refresh=False):
+    """
+    Return an index of the VPCs in the current account and region, keyed
+    by the tags the deployer looks VPCs up by.
+
+    The index is built from a single paginated pass over describe_vpcs
+    and reused for settings['vpc_inventory_ttl'] seconds, so lookups in
+    the meantime are dict accesses. environments.create() and destroy()
+    drop it once terraform ran.
+
+    Args:
+        refresh: boolean. Rebuild the index even if one is cached.
+
+    Returns:
+        dict of tag key ('env', 'Name') to a dict of tag value to the
+        list of ids of the VPCs carrying it. e.g.
+        { 'env' : { 'coral-a' : [ 'vpc-0bb4489428cd9b094' ] }, 'Name' : {...} }
+    """
+    key = clients.resolve()
+    with _vpc_inventory_lock:
+        (loaded, inventory) = _vpc_inventories.get(key, (0, None))
+        if (refresh or inventory is None or
+            time.time() - loaded >= settings['vpc_inventory_ttl']):
+            inventory = _load_vpc_inventory()
+            _vpc_inventories[key] = (time.time(), inventory)
+        return inventory
+
+
+def forget_vpc_inventories():
+    """
+    Drop every cached VPC index.
+
+    Args:
+        None
+
+    Returns:
+        nothing
+    """
+    with _vpc_inventory_lock:
+        _vpc_inventories.clear()
+
+    return
+
+
+def _load_vpc_inventory():
+    """
+    Page through describe_vpcs once and index VPCs by their tags.
+    """
+    inventory = { tag_key : {} for tag_key in VPC_INVENTORY_TAGS }
+    vpc_client = clients.client('ec2')
+    paginator = vpc_client.get_paginator('describe_vpcs')
+    filters = [{'Name': 'tag-key', 'Values': list(VPC_INVENTORY_TAGS)}]
+    for page in paginator.paginate(Filters=filters):
+        for vpc in page.get("Vpcs", []):
+            for tag in vpc.get("Tags", []):
+                if tag.get("Key") in inventory:
+                    index = inventory[tag["Key"]]
+                    index.setdefault(tag.get("Value"), []).append(vpc["VpcId"])
+
+    return inventory
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+from   collections import namedtuple
+from   concurrent.futures import (as_completed,
+                                  ThreadPoolExecutor)
+import glob
+import logging
+import os
+import sys
+import time
+
+from   deployer import cache
+from   deployer import utils
+from   deployer.exceptions import ConfigFileException
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# One environment of a batch: NAME tells its output apart, VARFILE is
+# what 'deployer <action> -v' is run with.
+Job = namedtuple('Job', ['name', 'varfile'])
+
+# The outcome of one job. RETURNCODE is the exit code of its deployer
+# process, ELAPSED the seconds it ran for, and LOG_FILE holds its
+# complete output.
+JobResult = namedtuple('JobResult', ['name', 'varfile', 'returncode',
+                                     'elapsed', 'timed_out', 'log_file'])
+
+
+def expand(patterns):
+    """
+    Expand varfile names and glob patterns into a list of varfiles.
+
+    Args:
+        patterns: list of file names or glob patterns.
+
+    Returns:
+        sorted list of absolute paths, without duplicates.
+
+    Raises:
+        ConfigFileException if a pattern matches nothing.
+    """
+    varfiles = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches:
+            raise ConfigFileException("No varfile matches {}".format(pattern))
+        varfiles.update(os.path.abspath(m) for m in matches)
+
+    return sorted(varfiles)
+
+
+def jobs(varfiles):
+    """
+    Create the jobs for VARFILES, named after the environment each
+    deploys ('<system_type>-<name>-<version>').
+
+    Args:
+        varfiles: list of varfile paths.
+
+    Returns:
+        list of Jobs.
+
+    Raises:
+        ConfigFileException if two varfiles deploy the same environment,
+        or share a tmpdir. Their runs would trample each other.
+    """
+    batch = []
+    tmpdirs = {}
+    for varfile in varfiles:
+        config = utils.load_vars(varfile)
+        environment = config.get('environment', {})
+        parts = [ config.get('tags', {}).get('system_type'),
+                  environment.get('name'), environment.get('version') ]
+        name = "-".join(p for p in parts if p) or os.path.basename(varfile)
+
+        for job in batch:
+            if job.name == name:
+                msg = "{} and {} both deploy environment {}"
+                raise ConfigFileException(msg.format(job.varfile, varfile,
+                                                     name))
+        if config.get('tmpdir'):
+            if config['tmpdir'] in tmpdirs:
+                msg = "{} and {} both use tmpdir {}"
+                raise ConfigFileException(msg.format(
+                    tmpdirs[config['tmpdir']], varfile, config['tmpdir']))
+            tmpdirs[config['tmpdir']] = varfile
+        batch.append(Job(name, varfile))
+
+    return batch
+
+
+def run(script, action, patterns, workers=4, log_dir=None, options=None,
+        timeout=None):
+    """
+    Run 'deployer ACTION' for every varfile matching PATTERNS, WORKERS
+    environments at a time.
+
+    Each environment runs in a deployer process of its own, so it gets
+    its own AWS environment and workdir. Output is streamed to the
+    console with every line prefixed by the environment name, and saved
+    to <LOG_DIR>/<name>.log. All processes share the deployer cache
+    directory: account identities, region metadata, git mirrors and
+    terraform providers fetched by one are reused by the rest.
+
+    Args:
+        script: string (path) of the deployer script to run.
+        action: string (create | destroy | plan)
+        patterns: list of varfile names or glob patterns.
+        workers: number of environments deployed at once.
+        log_dir: string (path) to write the per environment logs to.
+                 Defaults to a new temporary directory.
+        options: list of further command line options (e.g.
+                 '--remove-workdir') passed to every deployer process.
+        timeout: seconds each environment may take. None means no limit.
+                 A deployer process running past it is sent SIGTERM,
+                 which it passes on to the terraform or git command it
+                 is running before it exits.
+
+    Returns:
+        list of JobResults, in the order of the varfiles.
+
+    Raises:
+        ConfigFileException if the varfiles can not be run together.
+    """
+    batch = jobs(expand(patterns))
+    if not log_dir:
+        log_dir = os.path.join('/tmp', "deployer-batch-{}".format(
+            time.strftime('%Y%m%d-%H%M%S')))
+    os.makedirs(log_dir, exist_ok=True)
+    width = max(len(job.name) for job in batch)
+    env = { 'DEPLOYER_CACHE_DIR' : cache.cache_dir() }
+
+    log_msg = "Running {} on {} environment(s), {} at a time. Logs in {}"
+    logger.info(log_msg.format(action, len(batch), workers, log_dir))
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for job in batch:
+            command = [ sys.executable, script, action, '-v', job.varfile ]
+            command += options or []
+            log_file = os.path.join(log_dir, "{}.log".format(job.name))
+            futures[executor.submit(
+                utils.run_command, command, env=env, timeout=timeout,
+                log_file=log_file,
+                prefix="[{}] ".format(job.name.ljust(width)))] = (job,
+                                                                  log_file)
+        for future in as_completed(futures):
+            (job, log_file) = futures[future]
+            result = future.result()
+            results[job] = JobResult(job.name, job.varfile, result.returncode,
+                                     result.elapsed, result.timed_out,
+                                     log_file)
+            log_msg = "{} finished with code {} in {:.1f}s"
+            logger.info(log_msg.format(job.name, result.returncode,
+                                       result.elapsed))
+
+    return [ results[job] for job in batch ]
+
+
+def summary(results):
+    """
+    Return a table of how each environment of a batch did.
+
+    Args:
+        results: list of JobResults.
+
+    Returns:
+        string
+    """
+    failed = [ r for r in results if r.returncode != 0 ]
+    width = max([ len(r.name) for r in results ] + [ len('environment') ])
+    lines = [ "{:<{w}}  {:<9}  {:>9}  {}".format('environment', 'status',
+                                                  'time', 'log', w=width) ]
+    for result in results:
+        if result.timed_out:
+            status = 'timed out'
+        elif result.returncode != 0:
+            status = "failed {}".format(result.returncode)
+        else:
+            status = 'ok'
+        lines.append("{:<{w}}  {:<9}  {:>8.1f}s  {}".format(
+            result.name, status, result.elapsed, result.log_file, w=width))
+    lines.append("{} succeeded, {} failed, {:.1f}s longest".format(
+        len(results) - len(failed), len(failed),
+        max([ r.elapsed for r in results ] or [ 0 ])))
+
+    return "\n".join(lines)
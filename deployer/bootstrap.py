@@ -2,14 +2,19 @@
 #
 # Copyright Veracode Inc., 2014
 
-import boto3
+from   concurrent.futures import as_completed
 from   jsonschema import validate
 from   jsonschema.exceptions import ValidationError
 import logging
 import os
+import time
 
 from   deployer.exceptions import MissingConfigurationParameterException
+from   deployer import cache
+from   deployer import clients
+from   deployer import context
 from   deployer import s3
+from   deployer import utils
 
 
 logger = logging.getLogger(os.path.basename('deployer'))
@@ -28,10 +33,10 @@ def bootstrap(config):
     Returns:
         config dict.
     """
-    config['project_config'] = config.get('project_config',
-                                          s3.get_bucket_name(config, 'data'))
-    config['tf_state_bucket'] = config.get('tf_state_bucket',
-                                           s3.get_bucket_name(config,'tfstate'))
+    if 'project_config' not in config:
+        config['project_config'] = s3.get_bucket_name(config, 'data')
+    if 'tf_state_bucket' not in config:
+        config['tf_state_bucket'] = s3.get_bucket_name(config, 'tfstate')
 
     logmsg = "{}: Creating S3 project bucket: {}"
     logger.debug(logmsg.format(__name__, config['project_config']))
@@ -76,30 +81,105 @@ def upload_staged_artifacts(config):
     logmsg = "{}: Uploading staged artifacts to {}"
     logger.debug(logmsg.format(__name__, config['project_config']))
 
-    s3resource = boto3.resource('s3')
     bucket_name = config['project_config']
-
+    uploads = []
     for bucket_key in config['staged_artifacts'].keys():
         source_file = os.path.abspath(config['staged_artifacts'][bucket_key])
-        bucket_file = s3resource.Object(bucket_name, bucket_key)
-
         if not os.path.isfile(source_file):
             msg = "File {} does not exist".format(source_file)
             logger.critical(msg)
             raise SystemExit(msg)
-
+        uploads.append((source_file, bucket_key))
+
+    if not uploads:
+        return True
+
+    # Digests of staged artifacts are cached (see utils.file_digest).
+    # Entries of files since changed or gone are never read again.
+    cache.prune('file_digests')
+
+    # Files are uploaded by a pool of workers, each of which uses
+    # multipart transfers tuned by the 's3_transfer' config section.
+    transfer_config = s3.transfer_config(config)
+    workers = min(s3.transfer_settings(config)['file_workers'], len(uploads))
+    skip_unchanged = config.get('skip_unchanged_artifacts', True)
+    started = time.time()
+    total_bytes = 0
+    with context.ContextThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [ executor.submit(_upload_file, source_file, bucket_name,
+                                    bucket_key, transfer_config,
+                                    skip_unchanged)
+                    for (source_file, bucket_key) in uploads ]
         try:
-            bucket_file.upload_file(source_file)
-            log_msg = "Uploaded {} to {}/{}"
-            logger.debug(log_msg.format(source_file,
-                                        bucket_name,
-                                        bucket_key))
-        except ValueError as v:
-            log_msg = "Error uploading {} to {}/{}: {}".format(source_file,
-                                                               bucket_name,
-                                                               bucket_key,
-                                                               v.args[0])
-            logger.critical(log_msg)
-            raise ValueError(log_msg)
+            for future in as_completed(futures):
+                total_bytes += future.result()
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+
+    elapsed = time.time() - started
+    log_msg = "Uploaded {} file(s), {} in {:.1f}s ({}/s) to {}"
+    logger.info(log_msg.format(len(uploads),
+                               utils.format_bytes(total_bytes),
+                               elapsed,
+                               utils.format_bytes(total_bytes / max(elapsed,
+                                                                    0.001)),
+                               bucket_name))
 
     return True
+
+
+def _upload_file(source_file, bucket_name, bucket_key, transfer_config,
+                 skip_unchanged=True):
+    """
+    Upload a single staged artifact.
+
+    The SHA-256 digest of the file is stored as object metadata. When
+    SKIP_UNCHANGED is set and the object already in S3 carries the same
+    digest, the upload is skipped after a single HEAD request.
+
+    Returns:
+        number of bytes uploaded.
+
+    Raises:
+         ValueError exception on failure.
+    """
+    digest = utils.file_digest(source_file)
+    if skip_unchanged:
+        existing = s3.object_metadata(bucket_name, bucket_key)
+        if (existing and
+            existing['metadata'].get(s3.DIGEST_METADATA_KEY) == digest and
+            existing['size'] == os.path.getsize(source_file)):
+            log_msg = "Skipping {}: {}/{} is unchanged"
+            logger.debug(log_msg.format(source_file, bucket_name, bucket_key))
+            return 0
+
+    bucket_file = clients.resource('s3').Object(bucket_name, bucket_key)
+    transferred = []
+    started = time.time()
+    try:
+        # The callback is handed the size of each chunk as it goes out,
+        # possibly from several transfer threads at once.
+        bucket_file.upload_file(source_file, Config=transfer_config,
+                                Callback=transferred.append,
+                                ExtraArgs={ 'Metadata' : {
+                                    s3.DIGEST_METADATA_KEY : digest } })
+    except ValueError as v:
+        log_msg = "Error uploading {} to {}/{}: {}".format(source_file,
+                                                           bucket_name,
+                                                           bucket_key,
+                                                           v.args[0])
+        logger.critical(log_msg)
+        raise ValueError(log_msg)
+
+    elapsed = time.time() - started
+    size = sum(transferred)
+    log_msg = "Uploaded {} to {}/{} ({} in {:.1f}s, {}/s)"
+    logger.debug(log_msg.format(source_file,
+                                bucket_name,
+                                bucket_key,
+                                utils.format_bytes(size),
+                                elapsed,
+                                utils.format_bytes(size / max(elapsed, 0.001))))
+    return size
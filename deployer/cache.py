@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from   deployer import context
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# Overrides the cache location when set. Otherwise $DEPLOYER_CACHE_DIR,
+# then $XDG_CACHE_HOME/deployer, then ~/.cache/deployer are used.
+CACHE_DIR = None
+
+settings = {
+    # Seconds slow-changing region metadata (availability zones, hosted
+    # zone ids, ...) is cached for. 0 turns the metadata cache off.
+    # Deployments override it with 'metadata_cache_ttl' (see
+    # metadata_ttl()).
+    'metadata_ttl' : 86400,
+}
+
+
+def cache_dir():
+    """
+    Return the directory the deployer keeps its local caches in.
+
+    Args:
+        None
+
+    Returns:
+        string (path)
+    """
+    if CACHE_DIR:
+        return CACHE_DIR
+    if os.environ.get('DEPLOYER_CACHE_DIR'):
+        return os.environ['DEPLOYER_CACHE_DIR']
+    xdg_cache = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(xdg_cache, 'deployer')
+
+
+def metadata_ttl():
+    """
+    Return the seconds region metadata is cached for: the active
+    deployment's 'metadata_cache_ttl' (see deployer.context), or
+    settings['metadata_ttl'].
+
+    Args:
+        None
+
+    Returns:
+        number of seconds.
+    """
+    return context.setting('metadata_cache_ttl', settings['metadata_ttl'])
+
+
+def _entry_path(namespace, key):
+    """
+    Return the file an entry is stored in. Keys may be any JSON
+    serializable value, and are hashed into a file name.
+    """
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8'))
+    return os.path.join(cache_dir(), namespace,
+                        "{}.json".format(digest.hexdigest()))
+
+
+def get(namespace, key):
+    """
+    Look up an unexpired entry.
+
+    Args:
+        namespace: string grouping related entries, e.g. 'identity'
+        key: JSON serializable value identifying the entry
+
+    Returns:
+        The cached value, or None if there is no unexpired entry.
+    """
+    path = _entry_path(namespace, key)
+    try:
+        with open(path) as fp:
+            entry = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if entry.get('key') != json.loads(json.dumps(key)):
+        return None
+    if entry.get('expires') is not None and entry['expires'] < time.time():
+        return None
+
+    return entry.get('value')
+
+
+def put(namespace, key, value, ttl):
+    """
+    Store an entry. The file is written to a temporary name and renamed
+    into place, so concurrent deployer processes never see a partial
+    entry.
+
+    Args:
+        namespace: string grouping related entries, e.g. 'identity'
+        key: JSON serializable value identifying the entry
+        value: JSON serializable value to store
+        ttl: number of seconds the entry stays valid for. None means
+             the entry never expires.
+
+    Returns:
+        nothing
+    """
+    path = _entry_path(namespace, key)
+    expires = None if ttl is None else time.time() + ttl
+    entry = { 'key' : key, 'expires' : expires, 'value' : value }
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path),
+                                          prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(tmp_path, path)
+    except (IOError, OSError) as e:
+        # The cache is an optimization. Never fail a deploy over it.
+        logger.warning("Unable to write cache entry {}: {}".format(path, e))
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return
+
+
+def memoize(namespace, key, compute, ttl):
+    """
+    Return the cached value for KEY, calling COMPUTE() and caching its
+    result on a miss. None results are never cached.
+
+    Args:
+        namespace: string grouping related entries, e.g. 'metadata'
+        key: JSON serializable value identifying the entry
+        compute: callable taking no arguments which produces the value
+        ttl: number of seconds the entry stays valid for. 0 bypasses
+             the cache entirely.
+
+    Returns:
+        The cached or freshly computed value.
+    """
+    if not ttl:
+        return compute()
+
+    value = get(namespace, key)
+    if value is None:
+        value = compute()
+        if value is not None:
+            put(namespace, key, value, ttl)
+    else:
+        logger.debug("Using cached {} entry for {}".format(namespace, key))
+
+    return value
+
+
+def invalidate(namespace, key):
+    """
+    Remove a single entry.
+
+    Args:
+        namespace: string grouping related entries, e.g. 'metadata'
+        key: JSON serializable value identifying the entry
+
+    Returns:
+        True if an entry was removed, False if there was none.
+    """
+    try:
+        os.remove(_entry_path(namespace, key))
+    except OSError:
+        return False
+
+    return True
+
+
+def prune(namespace):
+    """
+    Remove the expired (and unreadable) entries of NAMESPACE. get()
+    ignores them, but entries whose key is never looked up again would
+    otherwise stay on disk forever.
+
+    Args:
+        namespace: string grouping related entries, e.g. 'file_digests'
+
+    Returns:
+        number of entries removed.
+    """
+    path = os.path.join(cache_dir(), namespace)
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return 0
+
+    now = time.time()
+    removed = 0
+    for name in names:
+        # Entries still being written by put() are left alone.
+        if not name.endswith('.json'):
+            continue
+        entry_path = os.path.join(path, name)
+        try:
+            with open(entry_path) as fp:
+                expires = json.load(fp).get('expires')
+        except (IOError, OSError, ValueError, AttributeError):
+            expires = now
+        if expires is None or expires > now:
+            continue
+        try:
+            os.remove(entry_path)
+            removed += 1
+        except OSError:
+            pass
+
+    if removed:
+        log_msg = "Pruned {} expired {} cache entries"
+        logger.debug(log_msg.format(removed, namespace))
+    return removed
+
+
+def clear(namespace=None):
+    """
+    Remove every entry of NAMESPACE, or the whole cache.
+
+    The directory is renamed out of the way before it is removed, so a
+    concurrent deployer process either sees the old entry or none at
+    all.
+
+    Args:
+        namespace: string grouping related entries. None clears
+                   everything.
+
+    Returns:
+        nothing
+    """
+    path = cache_dir()
+    if namespace:
+        path = os.path.join(path, namespace)
+    if not os.path.isdir(path):
+        return
+
+    doomed = "{}.deleting-{}".format(path, os.getpid())
+    os.rename(path, doomed)
+    logger.debug("Clearing cache: {}".format(path))
+    shutil.rmtree(doomed, ignore_errors=True)
+
+    return
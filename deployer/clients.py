@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+import boto3
+from   botocore.config import Config
+import logging
+import os
+import threading
+
+from   deployer import context
+from   deployer import metrics
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# Tunables for every client handed out by the registry. A deployment
+# overrides them with the 'aws_client' section of its config, carried
+# on its DeploymentContext (see client_settings()).
+settings = {
+    'max_pool_connections' : 50,
+    'max_attempts'         : 10,
+    'retry_mode'           : 'adaptive',
+    'tcp_keepalive'        : True,
+}
+
+_lock = threading.RLock()
+_sessions = {}
+_clients = {}
+_resources = threading.local()
+_generation = [0]
+
+
+def configure(config):
+    """
+    Check the 'aws_client' section of the deployer config, warning about
+    settings the registry does not know. The section itself takes effect
+    through the deployment's DeploymentContext, so nothing process-wide
+    is changed.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        nothing
+    """
+    unknown = set(config.get('aws_client', {})) - set(settings)
+    if unknown:
+        logger.warning("Ignoring unknown aws_client settings: {}".format(
+            ", ".join(sorted(unknown))))
+
+    return
+
+
+def reset():
+    """
+    Drop every cached session and client.
+
+    Args:
+        None
+
+    Returns:
+        nothing
+    """
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+        # Per-thread resource caches notice the bump and start over.
+        _generation[0] += 1
+
+    return
+
+
+def resolve(profile=None, region=None):
+    """
+    Resolve the profile and region a client will really be built for,
+    falling back to the active DeploymentContext (see deployer.context),
+    then to the AWS_* environment just like boto3 does.
+    """
+    deployment = context.current()
+    if deployment:
+        profile = profile or deployment.profile
+        region = region or deployment.region
+    profile = (profile or os.environ.get('AWS_PROFILE') or
+               os.environ.get('AWS_DEFAULT_PROFILE'))
+    region = (region or os.environ.get('AWS_DEFAULT_REGION') or
+              os.environ.get('AWS_REGION'))
+    return (profile, region)
+
+
+def client_settings():
+    """
+    Return settings, overridden by the 'aws_client' section of the
+    active deployment (see deployer.context).
+
+    Args:
+        None
+
+    Returns:
+        dict with the keys of settings.
+    """
+    effective = dict(settings)
+    overrides = context.setting('aws_client', {})
+    effective.update((key, value) for (key, value) in overrides.items()
+                     if key in settings)
+    return effective
+
+
+def client_config(tunables=None):
+    """
+    Return the botocore Config every registry client is created with.
+
+    Args:
+        tunables: dict as returned by client_settings(), which it
+                  defaults to.
+
+    Returns:
+        botocore.config.Config
+    """
+    tunables = tunables or client_settings()
+    return Config(max_pool_connections=tunables['max_pool_connections'],
+                  retries={ 'max_attempts' : tunables['max_attempts'],
+                            'mode'         : tunables['retry_mode'] },
+                  tcp_keepalive=tunables['tcp_keepalive'])
+
+
+def session(profile=None, region=None):
+    """
+    Return the cached boto3 Session for a profile and region. Every
+    call made through it is measured (see deployer.metrics).
+
+    Args:
+        profile: string representing an AWS profile name. Defaults to
+                 the profile set in the environment.
+        region: string representing an AWS region. Defaults to the
+                region set in the environment or the profile.
+
+    Returns:
+        boto3.Session
+    """
+    key = resolve(profile, region)
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = boto3.Session(profile_name=key[0],
+                                           region_name=key[1])
+            metrics.register(_sessions[key])
+        return _sessions[key]
+
+
+def client(service, profile=None, region=None):
+    """
+    Return a cached, thread-safe low-level client for SERVICE.
+
+    Clients share a warm connection pool and are created with
+    client_config(), so retries and pool sizes are tuned in one place.
+    Deployments tuning them differently get clients of their own.
+
+    Args:
+        service: string representing an AWS service name, e.g. 'ec2'
+        profile: string representing an AWS profile name.
+        region: string representing an AWS region.
+
+    Returns:
+        boto3 client
+    """
+    tunables = client_settings()
+    key = resolve(profile, region) + (service,
+                                      tuple(sorted(tunables.items())))
+    with _lock:
+        if key not in _clients:
+            logger.debug("Creating {} client for profile {} in {}".format(
+                service, key[0], key[1]))
+            _clients[key] = session(profile, region).client(
+                service, config=client_config(tunables))
+        return _clients[key]
+
+
+def resource(service, profile=None, region=None):
+    """
+    Return a cached resource for SERVICE.
+
+    boto3 resources are not thread-safe, so these are cached per thread
+    rather than shared like clients. They are built from the shared
+    Session under the registry lock, as clients are.
+
+    Args:
+        service: string representing an AWS service name, e.g. 's3'
+        profile: string representing an AWS profile name.
+        region: string representing an AWS region.
+
+    Returns:
+        boto3 resource
+    """
+    tunables = client_settings()
+    key = resolve(profile, region) + (service,
+                                      tuple(sorted(tunables.items())))
+    if getattr(_resources, 'generation', None) != _generation[0]:
+        _resources.generation = _generation[0]
+        _resources.cache = {}
+    cached = _resources.cache
+    if key not in cached:
+        # Sessions are shared by every thread, and are not thread-safe.
+        with _lock:
+            cached[key] = session(profile, region).resource(
+                service, config=client_config(tunables))
+    return cached[key]
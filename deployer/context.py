@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+from   concurrent.futures import ThreadPoolExecutor
+from   contextlib import contextmanager
+import contextvars
+import logging
+import os
+
+from   deployer import clients
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# Variables which would make terraform (or any AWS SDK) use other
+# credentials than those of the deployment's profile. They are left out
+# of the environment commands are run with.
+CREDENTIAL_VARIABLES = ( 'AWS_ACCESS_KEY_ID',
+                         'AWS_SECRET_ACCESS_KEY',
+                         'AWS_SESSION_TOKEN',
+                         'AWS_SECURITY_TOKEN' )
+
+# Sections and keys of the deployer config tuning how a deployment
+# talks to AWS. They are carried on its DeploymentContext, so
+# deployments running side by side can tune them differently.
+SETTINGS = ( 'aws_client',
+             'aws_metrics',
+             'identity_cache_ttl',
+             'metadata_cache_ttl' )
+
+_current = contextvars.ContextVar('deployer_context', default=None)
+
+
+class DeploymentContext(object):
+    """
+    The AWS profile and region one deployment runs against, and the
+    SETTINGS it tunes AWS access with.
+
+    AWS clients (see deployer.clients) and commands (see
+    utils.run_command) started while a context is active use it instead
+    of the AWS_* variables of the process environment. Every thread,
+    and every task handed to a ContextThreadPoolExecutor, has a context
+    of its own, so deployments to different accounts or regions can
+    run side by side in one process.
+    """
+
+    def __init__(self, profile, region, environment=None, settings=None):
+        """
+        Args:
+            profile: string representing an AWS profile name.
+            region: string representing an AWS region.
+            environment: dict of further variables to run commands with.
+            settings: dict of SETTINGS keys to the deployment's values,
+                      e.g. { 'aws_client' : { 'max_attempts' : 5 } }
+        """
+        self.profile = profile
+        self.region = region
+        self.environment = dict(environment or {})
+        self.settings = dict(settings or {})
+
+    def __repr__(self):
+        return "DeploymentContext(profile={!r}, region={!r})".format(
+            self.profile, self.region)
+
+    @property
+    def session(self):
+        """
+        The boto3 Session of the deployment's profile and region.
+        """
+        return clients.session(self.profile, self.region)
+
+    def variables(self):
+        """
+        Return the variables commands run in this context get on top of
+        the process environment.
+
+        Returns:
+            dict of environment variable name to value.
+        """
+        variables = { 'AWS_DEFAULT_PROFILE' : self.profile,
+                      'AWS_PROFILE'         : self.profile,
+                      'AWS_DEFAULT_REGION'  : self.region }
+        variables.update(self.environment)
+        return variables
+
+    def command_environment(self, base):
+        """
+        Return the environment to run a command in this context with.
+
+        Args:
+            base: dict of the environment to start from, usually
+                  os.environ. It is not modified.
+
+        Returns:
+            dict of environment variable name to value.
+        """
+        env = { key : value for (key, value) in base.items()
+                if key not in CREDENTIAL_VARIABLES }
+        env.update(self.variables())
+        return env
+
+
+def from_config(config):
+    """
+    Create the context of the deployment CONFIG describes.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        DeploymentContext
+    """
+    settings = { key : config[key] for key in SETTINGS if key in config }
+    return DeploymentContext(config['aws_profile'], config['aws_region'],
+                             settings=settings)
+
+
+def current():
+    """
+    Return the active context of the calling thread (or task), or None.
+
+    Args:
+        None
+
+    Returns:
+        DeploymentContext or None
+    """
+    return _current.get()
+
+
+def setting(key, default=None):
+    """
+    Return the active deployment's value of KEY, one of SETTINGS.
+
+    Args:
+        key: string, e.g. 'metadata_cache_ttl'
+        default: value to return when no deployment is active, or it
+                 does not set KEY.
+
+    Returns:
+        The value.
+    """
+    deployment = _current.get()
+    if deployment is None:
+        return default
+    return deployment.settings.get(key, default)
+
+
+def activate(deployment):
+    """
+    Make DEPLOYMENT the active context of the calling thread, and of the
+    threads and tasks it starts from then on.
+
+    Args:
+        deployment: DeploymentContext, or None to deactivate.
+
+    Returns:
+        DEPLOYMENT
+    """
+    _current.set(deployment)
+    return deployment
+
+
+@contextmanager
+def using(deployment):
+    """
+    Make DEPLOYMENT the active context while the context manager is
+    open, restoring the previous one afterwards.
+
+    Args:
+        deployment: DeploymentContext
+    """
+    token = _current.set(deployment)
+    try:
+        yield deployment
+    finally:
+        _current.reset(token)
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    A ThreadPoolExecutor whose tasks run in the context (and so with
+    the DeploymentContext) of the thread which submitted them.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super(ContextThreadPoolExecutor, self).submit(
+            contextvars.copy_context().run, fn, *args, **kwargs)
@@ -4,18 +4,44 @@
 import json
 import logging
 import os
+import string
 from termcolor import colored
 
 from   deployer import aws
+from   deployer import memo
+from   deployer import providers
 from   deployer import s3
+from   deployer import tracing
 from   deployer import utils
 import deployer.terraform as tf
 from   deployer.exceptions import ( EnvironmentExistsException,
-                                    InvalidCommandException)
+                                    InvalidCommandException,
+                                    ShellCommandException)
 
 logger = logging.getLogger(os.path.basename('deployer'))
 
 
+def _terraform(config, tf_command):
+    """
+    Run a terraform command in config['tf_root'], with the shared
+    provider cache set up (see deployer.providers) and the timeout the
+    'commands' config section sets for it.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+        tf_command: list of command-line arguments to run terraform with.
+
+    Returns:
+        return code of the command.
+    """
+    result = utils.run_command(tf_command, cwd=config['tf_root'],
+                               env=providers.environment(config),
+                               **utils.command_options(config, tf_command))
+    return result.returncode
+
+
+@tracing.traced('precheck')
 def _precheck(config, action):
     """
     Run through preflight checklist before running terraform apply/destroy.
@@ -24,36 +50,61 @@ def _precheck(config, action):
         config: dictionary containing all variable settings required
                 to run terraform with
 
-        action: string (create | destroy)
+        action: string (create | destroy | plan)
 
     Returns:
-        Nothing
+        path of the plan saved for 'create' and 'destroy' to apply, or
+        None when there is none (the 'plan' action, or config['skip_plan']
+        is set).
 
     Raises:
         InvalidCommandException exception on unknown command.
+        ShellCommandException if a plan to be saved could not be made.
     """
-    # Instantiate remote state only if:
-    # - the terraform code isn't already checked out
-    # - and we haven't already run 'terraform remote config...'
-    if not os.path.isfile(os.path.join(config['tf_root'],
-                                       '.terraform',
-                                       'terraform.tfstate')):
+    # 'terraform init', 'get' and 'validate' are skipped when nothing
+    # they depend on changed since they last succeeded in this
+    # workspace (see deployer.memo). Each step's inputs include those
+    # of the steps before it, so re-running one re-runs the rest.
+    tf_root = config['tf_root']
+    memoize = config.get('memoize_preflight', True)
+    source = memo.source_digest(tf_root) if memoize else None
+
+    # Instantiate remote state if:
+    # - we haven't already run 'terraform init' here
+    # - or the code, the backend settings or the providers changed
+    tf_command = tf.remote_state(config)
+    init_inputs = memo.digest('init', tf_command, config['terraform'],
+                              source, providers.environment(config))
+    initialized = os.path.isfile(os.path.join(tf_root,
+                                              '.terraform',
+                                              'terraform.tfstate'))
+    if not initialized or (memoize and
+                           not memo.is_current(tf_root, 'init', init_inputs)):
         log_msg = "Configuring terraform remote state in: {}"
-        logger.debug(log_msg.format(config['tf_root']))
-        tf_command = tf.remote_state(config)
-        return_code = utils.run_command(tf_command, cwd=config['tf_root'])
+        logger.debug(log_msg.format(tf_root))
+        # 'terraform init' installs providers into the shared cache.
+        with providers.locked(config):
+            return_code = _terraform(config, tf_command)
         if return_code != 0:
             raise BaseException("{} failed with code {}.".format(tf_command,
                                                                  return_code))
+        _record(config, 'init', init_inputs)
 
     # Grab all the tf modules required
     tf_command = tf.get()
-    utils.run_command(tf_command, cwd=config['tf_root'])
+    get_inputs = memo.digest('get', init_inputs)
+    if not (memoize and memo.is_current(tf_root, 'get', get_inputs)):
+        if _terraform(config, tf_command) == 0:
+            _record(config, 'get', get_inputs)
 
     # validate env_name
     utils.validate_env_name(config['env_name'])
     tf_command = tf.validate(config)
-    utils.run_command(tf_command, cwd=config['tf_root'])
+    validate_inputs = memo.digest('validate', get_inputs, tf_command,
+                                  _file_digest(config['tfvars']))
+    if not (memoize and memo.is_current(tf_root, 'validate', validate_inputs)):
+        if _terraform(config, tf_command) == 0:
+            _record(config, 'validate', validate_inputs)
 
     # Push remote state
     push_or_pull = {
@@ -66,11 +117,58 @@ def _precheck(config, action):
     except KeyError:
         raise InvalidCommandException("Invalid Command: {}".format(action))
 
-    utils.run_command(tf_command, cwd=config['tf_root'])
+    _terraform(config, tf_command)
+
+    if action == 'plan':
+        _terraform(config, tf.plan(config, action))
+        return None
+    if config.get('skip_plan'):
+        logger.debug("Skipping plan, '{}' plans for itself".format(action))
+        return None
+
+    # Save the plan, so exactly what was planned is applied.
+    plan_file = tf.plan_file(config, action)
+    _remove_plan(plan_file)
+    tf_command = tf.plan(config, action, plan_file)
+    return_code = _terraform(config, tf_command)
+    if return_code != 0:
+        _remove_plan(plan_file)
+        raise ShellCommandException("{} failed with code {}.".format(
+            tf_command, return_code))
+
+    return plan_file
+
+
+def _record(config, step, inputs):
+    """
+    Remember a step succeeded, unless memoization is turned off.
+    """
+    if config.get('memoize_preflight', True):
+        memo.record(config['tf_root'], step, inputs)
+
+    return
+
+
+def _file_digest(path):
+    """
+    Return the digest of the file at PATH, or None if there is none.
+    """
+    try:
+        # Not cached: the tmpdir is new every run, so would never hit.
+        return utils.file_digest(path, cached=False)
+    except (IOError, OSError):
+        return None
+
 
-    # Run Plan
-    tf_command = tf.plan(config, action)
-    utils.run_command(tf_command, cwd=config['tf_root'])
+def _remove_plan(plan_file):
+    """
+    Remove a saved plan. Plans hold the variables (and secrets) they
+    were made with, so none is left behind once applied.
+    """
+    try:
+        os.remove(plan_file)
+    except OSError:
+        pass
 
     return
 
@@ -128,7 +226,8 @@ def query(config):
 
 def create(config):
     """
-    Create the environment by running 'terraform apply'.
+    Create the environment by running 'terraform apply' on the plan
+    saved by _precheck, or straight away when config['skip_plan'] is set.
 
     Args:
         config: dictionary containing all variable settings required
@@ -163,18 +262,26 @@ def create(config):
         message = colored(msg.format(env,resources_json), 'red')
         raise EnvironmentExistsException(message)
 
-    _precheck(config, 'create')
+    plan_file = _precheck(config, 'create')
 
-    # Run Apply
-    tf_command = tf.apply(config)
+    # Run Apply, of the saved plan if there is one.
+    if plan_file:
+        tf_command = tf.apply_plan(plan_file)
+    else:
+        tf_command = tf.apply(config)
     logger.debug("Command: {}".format(" ".join(tf_command)))
     logger.debug("In: {}".format(config['tf_root']))
 
     try:
-        return_code = utils.run_command(tf_command, cwd=config['tf_root'])
+        return_code = _terraform(config, tf_command)
     except:
         aws.tag_resources(config)
         return False
+    finally:
+        # The apply may have created or removed VPCs.
+        aws.forget_vpc_inventories()
+        if plan_file:
+            _remove_plan(plan_file)
 
     aws.tag_resources(config)
     return True
@@ -182,7 +289,9 @@ def create(config):
 
 def destroy(config):
     """
-    Destroy the environment by running 'terraform destroy'.
+    Destroy the environment by applying the destroy plan saved by
+    _precheck, or by running 'terraform destroy' when config['skip_plan']
+    is set.
 
     Args:
         config: dictionary containing all variable settings required
@@ -210,27 +319,36 @@ def destroy(config):
             env = "-".join([system_type, env])
         raise EnvironmentExistsException(msg.format(env))
 
-    tf_root = _precheck(config, 'destroy')
+    plan_file = _precheck(config, 'destroy')
 
     # Tag the resources as ready to destroy
     aws.tag_resources(config)
 
-    # Run destroy
-    tf_command = tf.destroy(config)
-    return_code = utils.run_command(tf_command, cwd=config['tf_root'])
+    # Run destroy, by applying the saved destroy plan if there is one.
+    if plan_file:
+        tf_command = tf.apply_plan(plan_file)
+    else:
+        tf_command = tf.destroy(config)
+    try:
+        return_code = _terraform(config, tf_command)
+    finally:
+        aws.forget_vpc_inventories()
+        if plan_file:
+            _remove_plan(plan_file)
 
     # Double check the make sure we don't have anything left running
     # before destroying the S3 resources.
     if not aws.environment_exists(env_name, env_vers, system_type) and return_code == 0:
-        # Destroy the per-environment S3 folder in
-        msg = "Destroying S3 env folder: {}".format(config['env_folder'])
-        logger.debug(msg)
-        s3.destroy_folder(config['project_config'],config['env_folder'])
+        with tracing.span('s3_cleanup', env_folder=config['env_folder']):
+            # Destroy the per-environment S3 folder in
+            msg = "Destroying S3 env folder: {}".format(config['env_folder'])
+            logger.debug(msg)
+            s3.destroy_folder(config['project_config'],config['env_folder'])
 
-        # Destroy the state file in S3
-        msg = "Destroying S3 State file: {}".format(config['tf_state'])
-        logger.debug(msg)
-        s3.delete_object(config['tf_state_bucket'], config['tf_state'])
+            # Destroy the state file in S3
+            msg = "Destroying S3 State file: {}".format(config['tf_state'])
+            logger.debug(msg)
+            s3.delete_object(config['tf_state_bucket'], config['tf_state'])
 
     return True
 
@@ -250,7 +368,7 @@ def output(config, tf_var):
 
     """
     tf_command = tf.output(tf_var)
-    utils.run_command(tf_command, cwd=config['tf_root'])
+    _terraform(config, tf_command)
 
     return True
 
@@ -267,7 +385,6 @@ def list_deployed_environment_versions(env):
         list of version letters in use.
 
     """
-    vpcs = aws.list_vpcs(env)
     versions = [ version.split('-')[1] for version in aws.list_vpcs(env) ]
     versions.sort()
     return versions
@@ -276,8 +393,10 @@ def list_deployed_environment_versions(env):
 def get_next_version(env, ephemeral_env=None):
     """
     Return the next available version letter not currently in use.
-    Will skip over letters in use. Will loop back to 'a' if it reaches
-    'z'
+    Will skip over letters in use.
+
+    Every version in use is found with a single scan of the tagging API,
+    no matter how many there are.
 
     Args:
         env: string name of a particular environement to check for
@@ -286,14 +405,13 @@ def get_next_version(env, ephemeral_env=None):
     Returns:
         character representing next available, unused environment version.
 
+    Raises:
+        EnvironmentExistsException if every version is in use.
     """
-    next_env = 'a'
-    while aws.environment_exists(env, next_env, ephemeral_env):
-        # increment to next version.
-        # If we're already at 'z', loop back to 'a'
-        if ord(next_env.lower()) == 122:
-            next_env = 'a'
-        else:
-            # otherwise increment
-            next_env = chr(ord(next_env.lower()) + 1)
-    return next_env
+    in_use = aws.live_environment_versions(env, ephemeral_env)
+    for next_env in string.ascii_lowercase:
+        if next_env not in in_use:
+            return next_env
+
+    msg = "All environment versions of {} are in use.".format(env)
+    raise EnvironmentExistsException(msg)
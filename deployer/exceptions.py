@@ -52,3 +52,42 @@ class InvalidCommandException(Exception):
     An invalid command was issued to the deployer.
     """
     pass
+
+
+class ResourceTaggingException(Exception):
+    """
+    One or more resources could not be tagged. The second argument is
+    a dict of ARN to error message.
+    """
+    pass
+
+
+class ObjectDeletionException(Exception):
+    """
+    One or more S3 objects could not be deleted. The second argument is
+    a dict of key to error message.
+    """
+    pass
+
+
+class ObjectCopyException(Exception):
+    """
+    One or more S3 objects could not be copied. The second argument, if
+    given, is a dict of key to error message.
+    """
+    pass
+
+
+class ArtifactDownloadException(Exception):
+    """
+    One or more staged artifacts could not be downloaded. The second
+    argument is a dict of key to error message.
+    """
+    pass
+
+
+class StageCancelledException(Exception):
+    """
+    A pipeline stage was stopped because another stage failed.
+    """
+    pass
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from   deployer import utils
+from   deployer.mirrors import LOCAL_MODULE_SOURCE
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# Kept inside terraform's own working directory, so it goes away with
+# it: removing .terraform always re-runs every step.
+MEMO_FILE = os.path.join('.terraform', 'deployer-memo.json')
+
+
+def memo_path(tf_root):
+    """
+    Return the location of the memo store of the workspace at TF_ROOT.
+
+    Args:
+        tf_root: string (path) terraform runs from.
+
+    Returns:
+        string (path)
+    """
+    return os.path.join(tf_root, MEMO_FILE)
+
+
+def load(tf_root):
+    """
+    Read the memo store of the workspace at TF_ROOT.
+
+    Args:
+        tf_root: string (path) terraform runs from.
+
+    Returns:
+        dict of step name to the digest of the inputs it last succeeded
+        with. Empty if there is no (readable) store.
+    """
+    try:
+        with open(memo_path(tf_root)) as fp:
+            memo = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    return memo if isinstance(memo, dict) else {}
+
+
+def is_current(tf_root, step, inputs):
+    """
+    Return True if STEP last succeeded in the workspace at TF_ROOT with
+    the same INPUTS digest, so running it again would change nothing.
+
+    Args:
+        tf_root: string (path) terraform runs from.
+        step: string naming the step, e.g. 'init'
+        inputs: string, digest() of everything the step depends on.
+
+    Returns:
+        True or False
+    """
+    current = load(tf_root).get(step) == inputs
+    if current:
+        logger.debug("Skipping {}, its inputs are unchanged".format(step))
+    return current
+
+
+def record(tf_root, step, inputs):
+    """
+    Remember that STEP succeeded with INPUTS in the workspace at
+    TF_ROOT. Nothing is recorded before terraform has created its
+    .terraform directory there.
+
+    Args:
+        tf_root: string (path) terraform runs from.
+        step: string naming the step, e.g. 'init'
+        inputs: string, digest() of everything the step depends on.
+
+    Returns:
+        nothing
+    """
+    path = memo_path(tf_root)
+    if not os.path.isdir(os.path.dirname(path)):
+        return
+
+    memo = load(tf_root)
+    memo[step] = inputs
+    tmp_path = None
+    try:
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path),
+                                          prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(memo, fp, sort_keys=True)
+        os.replace(tmp_path, path)
+    except (IOError, OSError) as e:
+        # The memo is an optimization. Never fail a deploy over it.
+        logger.warning("Unable to write {}: {}".format(path, e))
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return
+
+
+def digest(*inputs):
+    """
+    Return a digest of INPUTS, any JSON serializable values.
+
+    Args:
+        inputs: values a step depends on.
+
+    Returns:
+        string: hex digest.
+    """
+    encoded = json.dumps(inputs, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def source_digest(tf_root):
+    """
+    Return a digest of the terraform code at TF_ROOT, including every
+    local module it references ('source = "../modules/vpc"') outside of
+    it. Remote module sources and versions are part of the code, so a
+    changed one changes the digest too.
+
+    Hidden directories (.terraform, .git) are skipped. File digests are
+    not kept in the local digest cache: checkouts live in a new tmpdir
+    every run, so their paths would never be looked up again.
+
+    Args:
+        tf_root: string (path) terraform runs from.
+
+    Returns:
+        string: hex digest.
+    """
+    tf_root = os.path.abspath(tf_root)
+    roots = [ tf_root ]
+    files = []
+    for root in roots:
+        for (path, dirs, names) in os.walk(root):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(names):
+                file_path = os.path.join(path, name)
+                if not os.path.isfile(file_path):
+                    continue
+                files.append([ os.path.relpath(file_path, tf_root),
+                               utils.file_digest(file_path,
+                                                 cached=False) ])
+                if name.endswith('.tf'):
+                    for module in _local_modules(file_path):
+                        if not any(_below(module, r) for r in roots):
+                            roots.append(module)
+
+    return digest(files)
+
+
+def _local_modules(tf_file):
+    """
+    Return the absolute paths of the local modules TF_FILE references.
+    """
+    try:
+        with open(tf_file) as fp:
+            sources = LOCAL_MODULE_SOURCE.findall(fp.read())
+    except (IOError, OSError, UnicodeDecodeError):
+        return []
+
+    base = os.path.dirname(tf_file)
+    return [ os.path.normpath(os.path.join(base, s)) for s in sources ]
+
+
+def _below(path, root):
+    """
+    Return True if PATH is ROOT, or below it.
+    """
+    return path == root or path.startswith(root + os.sep)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+from   deployer import context
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# Tunables for AWS API call metrics. A deployment overrides them with
+# the 'aws_metrics' section of its config, carried on its
+# DeploymentContext (see deployer.context).
+settings = {
+    # Calls taking longer than this many seconds (retries included)
+    # are logged individually. 0 turns the slow call log off.
+    'slow_call_seconds' : 5.0,
+}
+
+# Upper bounds (seconds) of the call latency histogram buckets. Calls
+# slower than the last bound land in a final, open ended bucket.
+LATENCY_BUCKETS = [ 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 ]
+
+# Error codes AWS answers with when a caller is being rate limited, as
+# botocore's retry handlers know them.
+THROTTLING_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'TransactionInProgressException',
+    'RequestLimitExceeded',
+    'BandwidthLimitExceeded',
+    'LimitExceededException',
+    'SlowDown',
+    'PriorRequestNotComplete',
+    'EC2ThrottledException',
+])
+
+_lock = threading.Lock()
+_operations = {}
+
+# The key botocore's per-request context dict carries the operation
+# name and start time of a call in.
+_CALL = 'deployer_metrics_call'
+
+
+def configure(config):
+    """
+    Check the 'aws_metrics' section of the deployer config, warning
+    about settings it does not know. The section itself takes effect
+    through the deployment's DeploymentContext.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        nothing
+    """
+    unknown = set(config.get('aws_metrics', {})) - set(settings)
+    if unknown:
+        logger.warning("Ignoring unknown aws_metrics settings: {}".format(
+            ", ".join(sorted(unknown))))
+
+    return
+
+
+def register(session):
+    """
+    Attach the metrics handlers to the event system of a boto3 Session,
+    so every client and resource created from it is measured.
+
+    Args:
+        session: boto3.Session
+
+    Returns:
+        nothing
+    """
+    events = session.events
+    events.register('before-call', _before_call,
+                    unique_id='deployer-metrics-before-call')
+    events.register('after-call', _after_call,
+                    unique_id='deployer-metrics-after-call')
+    events.register('after-call-error', _after_call_error,
+                    unique_id='deployer-metrics-after-call-error')
+    events.register('needs-retry', _needs_retry,
+                    unique_id='deployer-metrics-needs-retry')
+    return
+
+
+def reset():
+    """
+    Forget every call recorded so far.
+
+    Args:
+        None
+
+    Returns:
+        nothing
+    """
+    with _lock:
+        _operations.clear()
+    return
+
+
+def _name(model):
+    return "{}.{}".format(model.service_model.service_name, model.name)
+
+
+def _stats(name):
+    """
+    Return the (mutable) statistics of operation NAME. Call with _lock
+    held.
+    """
+    if name not in _operations:
+        _operations[name] = { 'calls'     : 0,
+                              'errors'    : 0,
+                              'retries'   : 0,
+                              'throttles' : 0,
+                              'seconds'   : 0.0,
+                              'max_seconds' : 0.0,
+                              'histogram' : [0] * (len(LATENCY_BUCKETS) + 1) }
+    return _operations[name]
+
+
+def _before_call(model, context, **kwargs):
+    context[_CALL] = (_name(model), time.time())
+
+
+def _after_call(parsed, context, **kwargs):
+    metadata = parsed.get('ResponseMetadata', {}) if parsed else {}
+    error = parsed.get('Error', {}).get('Code') if parsed else None
+    _record(context, error, metadata.get('RetryAttempts', 0))
+
+
+def _after_call_error(context, exception, **kwargs):
+    _record(context, type(exception).__name__, 0)
+
+
+def _needs_retry(operation, response, attempts, **kwargs):
+    # Called once per attempt, with the response to it. Throttled
+    # attempts are counted here, as retries can hide them from the
+    # final response. Returns None: retry decisions are left alone.
+    if response is None or not response[1]:
+        return None
+    if response[1].get('Error', {}).get('Code') in THROTTLING_CODES:
+        with _lock:
+            _stats(_name(operation))['throttles'] += 1
+    return None
+
+
+def _record(context, error, retries):
+    """
+    Add a finished call to the statistics, logging it when it was slow.
+    """
+    if _CALL not in context:
+        return
+    (name, started) = context.pop(_CALL)
+    elapsed = time.time() - started
+    with _lock:
+        stats = _stats(name)
+        stats['calls'] += 1
+        stats['errors'] += 1 if error else 0
+        stats['retries'] += retries
+        stats['seconds'] += elapsed
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    slow = _slow_call_seconds()
+    if slow and elapsed >= slow:
+        log_msg = "Slow AWS call: {} took {:.2f}s ({} retries{})"
+        logger.warning(log_msg.format(
+            name, elapsed, retries, ", failed with {}".format(error)
+            if error else ""))
+
+    return
+
+
+def _slow_call_seconds():
+    """
+    Return the active deployment's 'slow_call_seconds'. The hooks run on
+    the thread making the call, so in the deployment which made it.
+    """
+    return context.setting('aws_metrics', {}).get(
+        'slow_call_seconds', settings['slow_call_seconds'])
+
+
+def summary():
+    """
+    Return the statistics of every AWS API call made so far.
+
+    Args:
+        None
+
+    Returns:
+        dict with the totals (calls, errors, retries, throttles, seconds)
+        and, under 'operations', the statistics of each 'service.Operation':
+        the totals plus max_seconds, and a latency histogram mapping each
+        LATENCY_BUCKETS bound ('<=0.1s', ..., '>10s') to a number of
+        calls.
+    """
+    labels = [ "<={}s".format(b) for b in LATENCY_BUCKETS ]
+    labels.append(">{}s".format(LATENCY_BUCKETS[-1]))
+    operations = {}
+    totals = { 'calls' : 0, 'errors' : 0, 'retries' : 0, 'throttles' : 0,
+               'seconds' : 0.0 }
+    with _lock:
+        for (name, stats) in _operations.items():
+            operation = dict(stats)
+            operation['histogram'] = dict(zip(labels, stats['histogram']))
+            operations[name] = operation
+            for key in totals:
+                totals[key] += stats[key]
+
+    totals['operations'] = operations
+    return totals
+
+
+def report():
+    """
+    Log the statistics of every AWS API call made so far, busiest
+    operations first.
+
+    Args:
+        None
+
+    Returns:
+        nothing
+    """
+    stats = summary()
+    if not stats['calls']:
+        return
+
+    lines = []
+    for (name, op) in sorted(stats['operations'].items(),
+                             key=lambda item: -item[1]['calls']):
+        lines.append("\t{:<48} {:5d} calls {:8.2f}s (max {:.2f}s) "
+                     "{} errors {} retries {} throttled".format(
+                         name, op['calls'], op['seconds'], op['max_seconds'],
+                         op['errors'], op['retries'], op['throttles']))
+    log_msg = ("AWS API calls: {} in {:.2f}s, {} errors, {} retries, "
+               "{} throttled:\n{}")
+    logger.info(log_msg.format(stats['calls'], stats['seconds'],
+                               stats['errors'], stats['retries'],
+                               stats['throttles'], "\n".join(lines)))
+    return
+
+
+def write(path):
+    """
+    Write summary() to PATH as JSON.
+
+    Args:
+        path: string (path) of the file to write.
+
+    Returns:
+        nothing
+    """
+    with open(path, 'w') as fp:
+        json.dump(summary(), fp, indent=2, sort_keys=True)
+    logger.debug("Wrote AWS API call metrics to {}".format(path))
+    return
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+import base64
+from   contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+from   urllib.parse import (unquote,
+                            urlsplit,
+                            urlunsplit)
+
+from   deployer import cache
+from   deployer import utils
+from   deployer.exceptions import ShellCommandException
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# Defaults for the 'git_mirror' section of the deployer config.
+MIRROR_DEFAULTS = {
+    # Clone git repositories through the local mirror cache. When off,
+    # every run clones straight from the remote.
+    'enabled'        : True,
+
+    # Seconds after a fetch during which a mirror is used as is, without
+    # fetching again. 0 fetches on every run.
+    'fetch_interval' : 0,
+}
+
+# Matches the section headers and the path/url entries of a .gitmodules
+# file.
+GITMODULES_SECTION = re.compile(r'^\s*\[submodule\s+"(?P<name>[^"]*)"\s*\]\s*$')
+GITMODULES_ENTRY = re.compile(r'^\s*(?P<key>path|url)\s*=\s*(?P<value>.*?)\s*$')
+
+# Matches local module references ('source = "../modules/vpc"') in
+# terraform files, which sparse checkouts have to include.
+LOCAL_MODULE_SOURCE = re.compile(r'\bsource\s*=\s*"(?P<path>\.\.?/[^"]*)"')
+
+
+def mirror_settings(config):
+    """
+    Return the 'git_mirror' section of the deployer config, filled in
+    with MIRROR_DEFAULTS.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        dict with the keys of MIRROR_DEFAULTS.
+    """
+    settings = dict(MIRROR_DEFAULTS)
+    settings.update(config.get('git_mirror', {}))
+    return settings
+
+
+def mirrors_dir():
+    """
+    Return the directory git mirrors are kept in.
+
+    Args:
+        None
+
+    Returns:
+        string (path)
+    """
+    return os.path.join(cache.cache_dir(), 'git')
+
+
+def split_credentials(url):
+    """
+    Split the credentials ('user:API_TOKEN@') off an http(s) URL.
+
+    Args:
+        url: string representing a git repo.
+
+    Returns:
+        tuple of the URL without credentials, and the credentials
+        ('user:token') or None.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or '@' not in parts.netloc:
+        return (url, None)
+
+    (credentials, host) = parts.netloc.rsplit('@', 1)
+    return (urlunsplit(parts._replace(netloc=host)), credentials)
+
+
+def _credentials_env(credentials):
+    """
+    Return the environment which makes git authenticate its requests
+    with CREDENTIALS ('user:token'). Passed to each command rather than
+    stored in a mirror's config, and kept out of its command line.
+    """
+    if not credentials:
+        return None
+
+    token = base64.b64encode(unquote(credentials).encode('utf-8'))
+    return { 'GIT_CONFIG_COUNT'   : '1',
+             'GIT_CONFIG_KEY_0'   : 'http.extraHeader',
+             'GIT_CONFIG_VALUE_0' : "Authorization: Basic {}".format(
+                 token.decode('ascii')) }
+
+
+def mirror_path(url):
+    """
+    Return the location of the bare mirror of repository URL. Mirrors
+    are keyed by the URL without credentials, so a rotated API token
+    keeps using the same mirror.
+
+    Args:
+        url: string representing a git repo.
+
+    Returns:
+        string (path)
+    """
+    url = split_credentials(url)[0]
+    name = os.path.basename(url.rstrip('/')).replace('.git', '')
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(mirrors_dir(), "{}-{}.git".format(name, digest))
+
+
+@contextmanager
+def _locked(path, exclusive):
+    """
+    Hold a lock on mirror PATH, shared by readers (clones) and held
+    exclusively while the mirror is created or fetched into. The lock
+    is taken on a separate file, so it survives the mirror being
+    replaced.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open("{}.lock".format(path), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _git(args, cwd=None, env=None, config=None):
+    """
+    Run a git command, with the timeout and log file the 'commands'
+    section of CONFIG sets for it, raising ShellCommandException if it
+    fails.
+    """
+    # Per command timeouts are keyed by the git subcommand, past any
+    # '-c' options.
+    subcommand = args
+    while subcommand[:1] == ['-c']:
+        subcommand = subcommand[2:]
+    options = utils.command_options(config or {}, ['git'] + subcommand)
+    returncode = utils.run_command(['git'] + args, cwd, env,
+                                   **options).returncode
+    if returncode != 0:
+        msg = "git {} failed with code {}".format(" ".join(args), returncode)
+        raise ShellCommandException(msg)
+
+    return
+
+
+def update_mirror(url, fetch_interval=0, config=None):
+    """
+    Create or refresh the bare mirror of repository URL.
+
+    A missing mirror is cloned into a temporary location and renamed
+    into place, so an interrupted clone never leaves a broken mirror
+    behind. An existing one is brought up to date with an incremental
+    fetch, unless it was fetched less than FETCH_INTERVAL seconds ago.
+
+    Credentials in URL are never written to the mirror: it is cloned
+    from, and its config points at, the URL without them. They are
+    handed to each git command that talks to the remote instead.
+
+    Args:
+        url: string representing a git repo.
+        fetch_interval: seconds a fetch stays fresh for.
+        config: dictionary containing all variable settings required
+                to run terraform with. Only the 'commands' section is
+                used.
+
+    Returns:
+        string (path) of the mirror.
+
+    Raises:
+        ShellCommandException if git fails.
+    """
+    (url, credentials) = split_credentials(url)
+    env = _credentials_env(credentials)
+    path = mirror_path(url)
+    with _locked(path, exclusive=True):
+        if not os.path.isdir(path):
+            logger.debug("Creating git mirror of {} in {}".format(url, path))
+            tmp_path = "{}.tmp-{}".format(path, os.getpid())
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            try:
+                _git(['clone', '--mirror', '--quiet', url, tmp_path],
+                     env=env, config=config)
+                os.rename(tmp_path, path)
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        elif time.time() - _last_fetch(path) >= fetch_interval:
+            logger.debug("Updating git mirror of {}".format(url))
+            _git(['fetch', '--prune', '--quiet', 'origin'], path, env,
+                 config=config)
+        else:
+            logger.debug("Using recently fetched git mirror of {}".format(url))
+        _touch(os.path.join(path, 'deployer-fetched'))
+
+    return path
+
+
+def _last_fetch(path):
+    """
+    Return the time mirror PATH was last created or fetched into.
+    """
+    try:
+        return os.path.getmtime(os.path.join(path, 'deployer-fetched'))
+    except OSError:
+        return 0
+
+
+def _touch(path):
+    with open(path, 'a'):
+        os.utime(path)
+
+
+def clone(url, dest, branch=None, config=None):
+    """
+    Check out repository URL at DEST through its local mirror.
+
+    The clone is made from the mirror on the local disk, so objects are
+    hard linked rather than transferred. Its 'origin' remote is pointed
+    back at URL afterwards. Submodules are checked out recursively from
+    mirrors of their own.
+
+    Args:
+        url: string representing a git repo.
+        dest: string (path) to check the repository out to.
+        branch: string representing a branch name.
+        config: dictionary containing all variable settings required
+                to run terraform with. Only the 'git_mirror' and
+                'commands' sections are used.
+
+    Returns:
+        nothing
+
+    Raises:
+        ShellCommandException if git fails.
+    """
+    config = config or {}
+    settings = mirror_settings(config)
+    path = update_mirror(url, settings['fetch_interval'], config)
+    started = time.time()
+
+    cmd = ['clone', '--quiet']
+    if branch:
+        cmd += ['--branch', branch]
+    with _locked(path, exclusive=False):
+        _git(cmd + [path, dest], config=config)
+    _git(['remote', 'set-url', 'origin', url], dest, config=config)
+    _clone_submodules(url, dest, config)
+
+    log_msg = "Checked out {} to {} from its mirror in {:.2f}s"
+    logger.debug(log_msg.format(split_credentials(url)[0], dest,
+                                time.time() - started))
+    return
+
+
+def _clone_submodules(url, checkout, config):
+    """
+    Initialize the submodules of CHECKOUT (a clone of URL) from their
+    mirrors, recursively.
+    """
+    settings = mirror_settings(config)
+    for (name, path, sub_url) in gitmodules(checkout):
+        sub_url = resolve_url(url, sub_url)
+        sub_mirror = update_mirror(sub_url, settings['fetch_interval'],
+                                   config)
+        _git(['submodule', 'init', '--', path], checkout, config=config)
+        _git(['config', "submodule.{}.url".format(name), sub_mirror],
+             checkout, config=config)
+        with _locked(sub_mirror, exclusive=False):
+            # Local submodule clones need the file transport, which
+            # recent git versions only allow on request.
+            _git(['-c', 'protocol.file.allow=always',
+                  'submodule', 'update', '--quiet', '--', path], checkout,
+                 config=config)
+        sub_checkout = os.path.join(checkout, path)
+        _git(['config', "submodule.{}.url".format(name), sub_url], checkout,
+             config=config)
+        _git(['remote', 'set-url', 'origin', sub_url], sub_checkout,
+             config=config)
+        _clone_submodules(sub_url, sub_checkout, config)
+
+    return
+
+
+def sparse_clone(url, dest, subdir, branch=None, config=None):
+    """
+    Check out only SUBDIR of repository URL at DEST.
+
+    Only the tip of the branch is fetched, as a shallow, blob-less
+    partial clone. The working tree is a sparse checkout of SUBDIR plus
+    every directory its terraform code references as a local module
+    ('source = "../modules/vpc"'), found repeatedly until no new ones
+    turn up. File contents are fetched only for the directories checked
+    out. Submodules are initialized only where they fall inside them.
+
+    Args:
+        url: string representing a git repo.
+        dest: string (path) to check the repository out to.
+        subdir: string representing the directory within the repo
+                terraform runs from.
+        branch: string representing a branch name.
+        config: dictionary containing all variable settings required
+                to run terraform with. Only the 'commands' section is
+                used.
+
+    Returns:
+        list of the directories checked out.
+
+    Raises:
+        ShellCommandException if git fails.
+    """
+    started = time.time()
+    cmd = ['clone', '--quiet', '--filter=blob:none', '--depth', '1',
+           '--single-branch', '--no-checkout']
+    if branch:
+        cmd += ['--branch', branch]
+    _git(cmd + [url, dest], config=config)
+
+    paths = [ os.path.normpath(subdir).strip('/') ]
+    _git(['sparse-checkout', 'set', '--cone'] + paths, dest, config=config)
+    _git(['checkout', '--quiet'], dest, config=config)
+    while True:
+        found = [ path for path in local_module_paths(dest, paths)
+                  if not _covered(path, paths) ]
+        if not found:
+            break
+        paths = sorted(set(paths + found))
+        _git(['sparse-checkout', 'set', '--cone'] + paths, dest,
+             config=config)
+
+    for (name, path, sub_url) in gitmodules(dest):
+        if _covered(path, paths):
+            _git(['submodule', 'update', '--init', '--recursive',
+                  '--depth', '1', '--quiet', '--', path], dest,
+                 config=config)
+
+    log_msg = "Checked out {} of {} to {} in {:.2f}s"
+    logger.debug(log_msg.format(", ".join(paths), url, dest,
+                                time.time() - started))
+    return paths
+
+
+def local_module_paths(checkout, paths):
+    """
+    Find the directories the terraform code under PATHS references as
+    local modules.
+
+    Args:
+        checkout: string (path) of a git working tree.
+        paths: list of directories, relative to CHECKOUT, to search.
+
+    Returns:
+        set of directories relative to CHECKOUT. References which point
+        outside of the repository are ignored.
+    """
+    found = set()
+    for path in paths:
+        for (root, dirs, files) in os.walk(os.path.join(checkout, path)):
+            dirs[:] = [ d for d in dirs if not d.startswith('.') ]
+            for tf_file in [ f for f in files if f.endswith('.tf') ]:
+                with open(os.path.join(root, tf_file)) as fp:
+                    sources = LOCAL_MODULE_SOURCE.findall(fp.read())
+                for source in sources:
+                    module = os.path.relpath(os.path.join(root, source),
+                                             checkout)
+                    if module != '..' and not module.startswith('../'):
+                        found.add(module)
+
+    return found
+
+
+def _covered(path, paths):
+    """
+    Return True if PATH is one of PATHS, or below one of them.
+    """
+    return any(path == p or path.startswith(p + '/') for p in paths)
+
+
+def gitmodules(checkout):
+    """
+    List the submodules declared in the .gitmodules file of CHECKOUT.
+
+    Args:
+        checkout: string (path) of a git working tree.
+
+    Returns:
+        list of (name, path, url) tuples.
+    """
+    modules = []
+    entries = {}
+    try:
+        with open(os.path.join(checkout, '.gitmodules')) as fp:
+            lines = fp.readlines()
+    except (IOError, OSError):
+        return modules
+
+    name = None
+    for line in lines + ['[submodule ""]']:
+        section = GITMODULES_SECTION.match(line)
+        if section:
+            if name and 'path' in entries and 'url' in entries:
+                modules.append((name, entries['path'], entries['url']))
+            (name, entries) = (section.group('name'), {})
+            continue
+        entry = GITMODULES_ENTRY.match(line)
+        if entry and name:
+            entries[entry.group('key')] = entry.group('value')
+
+    return modules
+
+
+def resolve_url(base, url):
+    """
+    Resolve a submodule URL, which may be relative ('../other.git') to
+    the URL of its superproject BASE.
+
+    Args:
+        base: string representing the superproject's git repo.
+        url: string representing the submodule's git repo.
+
+    Returns:
+        string representing the submodule's git repo.
+    """
+    if not url.startswith('./') and not url.startswith('../'):
+        return url
+
+    base = base.rstrip('/')
+    for part in url.split('/'):
+        if part == '..':
+            # 'git@host:group/project' -> 'git@host:group',
+            # 'git@host:project' -> 'git@host:'
+            cut = max(base.rfind('/'), base.rfind(':'))
+            if cut > 0:
+                base = base[:cut + 1] if base[cut] == ':' else base[:cut]
+        elif part not in ('', '.'):
+            base = base + part if base.endswith(':') else base + '/' + part
+
+    return base
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+from   collections import namedtuple
+from   concurrent.futures import (FIRST_COMPLETED,
+                                  wait)
+import contextvars
+import logging
+import os
+import threading
+import time
+
+from   deployer import context
+from   deployer import tracing
+from   deployer.exceptions import StageCancelledException
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# A unit of work: NAME identifies it, FUNCTION is called with no
+# arguments, and DEPENDS lists the names of the stages which have to
+# finish before it starts.
+Stage = namedtuple('Stage', ['name', 'function', 'depends'])
+
+# The Cancellation of the pipeline the calling stage (or a task it
+# handed to a ContextThreadPoolExecutor) runs in.
+_cancellation = contextvars.ContextVar('deployer_pipeline', default=None)
+
+
+class Cancellation(object):
+    """
+    Set once a stage of a pipeline failed, to stop the stages still
+    running. Long running steps either check it (see check_cancelled())
+    or register a callback to be stopped by (see on_cancel()).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks = []
+
+    def cancel(self):
+        """
+        Cancel, calling every registered callback.
+        """
+        with self._lock:
+            self._cancelled = True
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def register(self, callback):
+        """
+        Call CALLBACK on cancel(), or at once if already cancelled.
+        """
+        with self._lock:
+            cancelled = self._cancelled
+            if not cancelled:
+                self._callbacks.append(callback)
+        if cancelled:
+            callback()
+
+    def unregister(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def run(stages, workers=None):
+    """
+    Run STAGES, each as soon as the stages it depends on have finished,
+    from a pool of worker threads.
+
+    The first stage to fail stops the pipeline: no further stage is
+    started, and the stages which are already running are cancelled.
+    Commands they run are sent SIGTERM (see utils.run_command), and S3
+    transfers they queued are skipped. Once they have returned, the
+    exception is re-raised.
+
+    Args:
+        stages: list of Stage tuples.
+        workers: number of stages run at once. Defaults to one per stage.
+
+    Returns:
+        dict of stage name to the number of seconds it ran for.
+
+    Raises:
+        ValueError if a stage depends on an unknown stage, or the
+        dependencies form a cycle.
+        Whatever exception the first failing stage raised.
+    """
+    _check(stages)
+    waiting = list(stages)
+    done = set()
+    running = {}
+    started = {}
+    timings = {}
+    failure = None
+    pipeline_started = time.time()
+
+    cancellation = Cancellation()
+    workers = workers or max(len(stages), 1)
+    with context.ContextThreadPoolExecutor(max_workers=workers) as executor:
+        while waiting or running:
+            if failure is None:
+                for stage in [ s for s in waiting if done.issuperset(s.depends) ]:
+                    waiting.remove(stage)
+                    logger.debug("Starting stage {}".format(stage.name))
+                    started[stage.name] = time.time()
+                    running[executor.submit(_traced, stage,
+                                            cancellation)] = stage.name
+            elif not running:
+                break
+
+            (finished, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                timings[name] = time.time() - started[name]
+                if future.exception() is not None:
+                    logger.error("Stage {} failed after {:.2f}s: {}".format(
+                        name, timings[name], future.exception()))
+                    if failure is None:
+                        failure = future.exception()
+                        if running:
+                            logger.error("Cancelling stages: {}".format(
+                                ", ".join(sorted(running.values()))))
+                        cancellation.cancel()
+                else:
+                    logger.debug("Finished stage {} in {:.2f}s".format(
+                        name, timings[name]))
+                    done.add(name)
+
+    _report(started, timings, pipeline_started)
+    if failure is not None:
+        skipped = [ stage.name for stage in waiting ]
+        if skipped:
+            logger.error("Skipped stages: {}".format(", ".join(skipped)))
+        raise failure
+
+    return timings
+
+
+def _traced(stage, cancellation):
+    """
+    Run STAGE as a trace span of its own, in the pipeline CANCELLATION
+    belongs to.
+    """
+    _cancellation.set(cancellation)
+    with tracing.span(stage.name, stage=True):
+        return stage.function()
+
+
+def current():
+    """
+    Return the Cancellation of the pipeline the caller runs in, or None
+    outside of a pipeline.
+
+    Args:
+        None
+
+    Returns:
+        Cancellation or None
+    """
+    return _cancellation.get()
+
+
+def check_cancelled():
+    """
+    Raise StageCancelledException if the pipeline the caller runs in was
+    cancelled. Does nothing outside of a pipeline.
+
+    Args:
+        None
+
+    Returns:
+        nothing
+    """
+    cancellation = _cancellation.get()
+    if cancellation is not None and cancellation.is_cancelled():
+        raise StageCancelledException("Cancelled, another stage failed")
+    return
+
+
+def _check(stages):
+    """
+    Make sure every dependency exists and there are no cycles.
+    """
+    names = [ stage.name for stage in stages ]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate stage names: {}".format(names))
+    for stage in stages:
+        unknown = set(stage.depends) - set(names)
+        if unknown:
+            msg = "Stage {} depends on unknown stage(s): {}"
+            raise ValueError(msg.format(stage.name, ", ".join(sorted(unknown))))
+
+    resolved = set()
+    pending = list(stages)
+    while pending:
+        ready = [ s for s in pending if resolved.issuperset(s.depends) ]
+        if not ready:
+            msg = "Stage dependencies form a cycle: {}"
+            raise ValueError(msg.format(", ".join(s.name for s in pending)))
+        for stage in ready:
+            pending.remove(stage)
+            resolved.add(stage.name)
+
+    return
+
+
+def _report(started, timings, pipeline_started):
+    """
+    Log how long each stage ran for, in the order they started.
+    """
+    lines = []
+    for name in sorted(started, key=started.get):
+        lines.append("\t{:<24} +{:6.2f}s {:7.2f}s".format(
+            name, started[name] - pipeline_started, timings.get(name, 0)))
+    log_msg = "Stage timings (start, duration), {:.2f}s in total:\n{}"
+    logger.info(log_msg.format(time.time() - pipeline_started,
+                               "\n".join(lines)))
+    return
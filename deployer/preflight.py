@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 #
 # Copyright Veracode Inc., 2014
-import boto3
 import json
 import logging
 import os
+import shutil
 import uuid
-import workdir
 
+from   deployer import artifacts
+from   deployer import mirrors
 from   deployer import s3
 import deployer.route53 as r53
 from   deployer import utils
@@ -24,10 +25,9 @@ def pre_setup(config, sync = True):
                                   os.path.join('/tmp', str(uuid.uuid4())))
 
     logger.debug("{}: Creating tmpdir: {}".format(__name__, config['tmpdir']))
-    workdir.options.path = config['tmpdir']
-    workdir.create()
+    os.makedirs(config['tmpdir'], exist_ok=True)
 
-    config['tfvars'] = os.path.join(workdir.options.path,
+    config['tfvars'] = os.path.join(os.path.abspath(config['tmpdir']),
                                     config.get('tfvars_file', 'vars.tf'))
 
     config['tf_root'] = config.get('tf_root',
@@ -44,9 +44,13 @@ def pre_setup(config, sync = True):
             logger.debug(msg)
             if sync:
                 git_pull_cmd = utils.git_pull(repo)
-                utils.run_command(git_pull_cmd, repo)
+                utils.run_command(git_pull_cmd, repo,
+                                  **utils.command_options(config,
+                                                          git_pull_cmd))
                 git_set_branch_cmd = utils.git_set_branch(branch)
-                utils.run_command(git_set_branch_cmd, repo)
+                utils.run_command(git_set_branch_cmd, repo,
+                                  **utils.command_options(config,
+                                                          git_set_branch_cmd))
 
         if subdir:
             tf_root = os.path.join(config.get('tf_root', repo), subdir)
@@ -74,13 +78,48 @@ def setup(config, sync = True):
     Raises:
         MissingConfigurationParameterException for missing config file entries.
     """
-    # Create the per-environment S3 folder in pre-flight
+    create_env_folder(config)
+    config['public_zone_id'] = config.get('public_zone_id',
+                                          lookup_zone_id(config))
+
+    return config
+
+
+def create_env_folder(config):
+    """
+    Create the per-environment S3 folder.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        nothing
+    """
     logmsg = "{}: Creating per-environment folder : {}:{}"
     logger.debug(logmsg.format(__name__,
                                config['project_config'],
                                config['env_folder']))
     s3.create_folder(config['project_config'],config['env_folder'])
 
+    return
+
+
+def lookup_zone_id(config):
+    """
+    Look up the id of the public hosted zone for config['route53_tld'].
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        string: the zone id.
+
+    Raises:
+        MissingConfigurationParameterException if route53_tld is unset,
+        or no zone exists for it.
+    """
     if not config.get('route53_tld', None):
         msg = "route53_tld variable is not set in config file."
         raise MissingConfigurationParameterException(msg)
@@ -90,9 +129,7 @@ def setup(config, sync = True):
         msg = "zone_id not set."
         raise MissingConfigurationParameterException(msg)
 
-    config['public_zone_id'] = config.get('public_zone_id', zone_id)
-
-    return config
+    return zone_id
 
 
 def teardown(config):
@@ -109,21 +146,29 @@ def teardown(config):
     Raises:
         MissingConfigurationParameterException if 'tmpdir' is unset.
     """
-    logger.debug("Removing tmpdir: {}".format(config['tmpdir']))
-    workdir.options.path = config.get('tmpdir')
-    if not workdir.options.path:
+    if not config.get('tmpdir'):
         msg = "tmpdir variable is not set. Can not destroy tmpdir location"
         raise MissingConfigurationParameterException(msg)
 
-    workdir.remove()
+    logger.debug("Removing tmpdir: {}".format(config['tmpdir']))
+    _remove_dir(config['tmpdir'])
+
+    if not utils.git_url(config['terraform']) and config.get('tf_root'):
+        _remove_dir(config['tf_root'])
 
-    if not utils.git_url(config['terraform']):
-        workdir.options.path = config.get('tf_root')
-        workdir.remove()
-    
     return config
 
 
+def _remove_dir(path):
+    """
+    Remove the directory tree at PATH, if there is one.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+    return
+
+
 def write_vars(config, varfile):
     """
     Writes out the modified dict to a location it can be used as a
@@ -154,6 +199,12 @@ def download_staged_artifacts(config):
     Downloads staged artifacts from S3 so terraform can use them access
     them for placing in environment-specific staging location.
 
+    Artifacts are kept in a local cache (see deployer.artifacts), so
+    only objects which changed since the last run are downloaded. When
+    'copy_staged_artifacts' is set, only the keys listed in
+    'local_artifacts' are downloaded; the rest are staged server side
+    by copy_staged_artifacts().
+
     Args:
         config: dictionary containing all variable settings required
                 to run terraform with
@@ -162,8 +213,8 @@ def download_staged_artifacts(config):
 
     Raises:
         MissingConfigurationParameterException if 'project_config' is undefined.
+        ArtifactDownloadException if any artifact could not be downloaded.
     """
-    s3 = boto3.resource('s3')
     bucket_name = config.get('project_config', None)
     if not bucket_name:
         msg = "project_config bucket is not defined. Can not proceed."
@@ -175,32 +226,62 @@ def download_staged_artifacts(config):
 
     logmsg = "Downloading project files from s3 bucket {}"
     logger.debug(logmsg.format(bucket_name))
-    for bucket_key in config['staged_artifacts'].keys():
-        s3_file = os.path.basename(bucket_key)
-        bucket_file = s3.Object(bucket_name, bucket_key)
-        try:
-            local_file = os.path.join(config['tmpdir'],s3_file)
-            workdir.options.path = os.path.dirname(local_file)
-            workdir.create()
-
-            bucket_file.download_file(local_file)
-            log_msg = "Downloading {}/{} to {}"
-            logger.debug(log_msg.format(config['project_config'],
-                                        bucket_key,
-                                        local_file))
-        except:
-            log_msg = "Error downloading {}/{} to {}"
-            logger.debug(log_msg.format(config['project_config'],
-                                        bucket_key,
-                                        local_file))
+    bucket_keys = config['staged_artifacts'].keys()
+    if config.get('copy_staged_artifacts'):
+        bucket_keys = [ bucket_key for bucket_key in bucket_keys
+                        if bucket_key in config.get('local_artifacts', []) ]
+    downloads = { bucket_key : os.path.join(config['tmpdir'],
+                                            os.path.basename(bucket_key))
+                  for bucket_key in bucket_keys }
+    artifacts.fetch(config, bucket_name, downloads)
 
     return
 
 
+def copy_staged_artifacts(config):
+    """
+    Copy staged artifacts into the per-environment folder of the
+    project_config bucket, as <env_folder>/<artifact key>. The copies
+    are made server side, so nothing passes through the deploy host.
+    Does nothing unless 'copy_staged_artifacts' is set.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+    Returns:
+        number of bytes copied.
+
+    Raises:
+        MissingConfigurationParameterException if 'project_config' is undefined.
+        ObjectCopyException if any artifact could not be copied.
+    """
+    if not config.get('copy_staged_artifacts'):
+        return 0
+
+    bucket_name = config.get('project_config', None)
+    if not bucket_name:
+        msg = "project_config bucket is not defined. Can not proceed."
+        raise MissingConfigurationParameterException(msg)
+
+    copies = { bucket_key : "{}/{}".format(config['env_folder'], bucket_key)
+               for bucket_key in config.get('staged_artifacts', {}).keys() }
+    logmsg = "Copying {} staged artifact(s) to {}/{}"
+    logger.debug(logmsg.format(len(copies), bucket_name, config['env_folder']))
+
+    return s3.copy_objects(bucket_name, copies,
+                           transfer=s3.transfer_settings(config))
+
+
 def sync_terraform(config):
     """
     Clone all terraform git repositories to the workdir.
 
+    Repositories are cloned through local mirrors (see deployer.mirrors)
+    unless the 'git_mirror' config section turns them off. URLs pointing
+    at a subdirectory ('repo//subdir') get a shallow, sparse checkout of
+    just that directory and the local modules it uses, unless
+    'sparse_checkout' is false.
+
     Args:
         config: dictionary containing all variable settings required
                 to run terraform with
@@ -217,10 +298,19 @@ def sync_terraform(config):
 
         return
     
-    workdir.options.path = config['tmpdir']
-    workdir.create()
+    os.makedirs(config['tmpdir'], exist_ok=True)
     (repo, branch, subdir) = utils.parse_git_url(config['terraform'])
+    dest = os.path.join(config['tmpdir'], utils.local_dir_from_git_repo(repo))
+    if subdir and config.get('sparse_checkout', True):
+        mirrors.sparse_clone(repo, dest, subdir, branch, config)
+        return
+
+    if mirrors.mirror_settings(config)['enabled']:
+        mirrors.clone(repo, dest, branch, config)
+        return
+
     clone_cmd = utils.git_clone(repo,branch)
-    utils.run_command(clone_cmd, config['tmpdir'])
+    utils.run_command(clone_cmd, config['tmpdir'],
+                      **utils.command_options(config, clone_cmd))
 
     return
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+from   contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import os
+
+from   deployer import cache
+from   deployer import utils
+import deployer.terraform as tf
+from   deployer.exceptions import ShellCommandException
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# Defaults for the 'terraform_providers' section of the deployer config.
+PROVIDER_DEFAULTS = {
+    # Shared provider plugin cache (TF_PLUGIN_CACHE_DIR). None means
+    # $TF_PLUGIN_CACHE_DIR if it is set, else <cache dir>/terraform-plugins.
+    'plugin_cache_dir' : None,
+
+    # Local filesystem mirror providers are installed from, before
+    # falling back to the registry. Needs terraform 0.13 or later. None
+    # turns the mirror off.
+    'mirror_dir'       : None,
+
+    # Platforms 'deployer providers' mirrors providers for. An empty list
+    # means the platform the deployer runs on.
+    'platforms'        : [],
+}
+
+CLI_CONFIG_TEMPLATE = """\
+provider_installation {{
+  filesystem_mirror {{
+    path = "{mirror_dir}"
+  }}
+  direct {{}}
+}}
+"""
+
+
+def provider_settings(config):
+    """
+    Return the 'terraform_providers' section of the deployer config,
+    filled in with PROVIDER_DEFAULTS.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        dict with the keys of PROVIDER_DEFAULTS.
+    """
+    settings = dict(PROVIDER_DEFAULTS)
+    settings.update(config.get('terraform_providers', {}))
+    if not settings['plugin_cache_dir']:
+        settings['plugin_cache_dir'] = os.environ.get(
+            'TF_PLUGIN_CACHE_DIR',
+            os.path.join(cache.cache_dir(), 'terraform-plugins'))
+    return settings
+
+
+def environment(config):
+    """
+    Return the environment variables every terraform command is run
+    with, so all runs share one provider cache (and mirror).
+
+    The plugin cache directory is created if need be. With a mirror
+    configured, a terraform CLI config file pointing at it is written
+    to the deployer cache directory and passed in TF_CLI_CONFIG_FILE.
+    It includes the user's own CLI config (~/.terraformrc), so their
+    credentials and registry settings still apply. A CLI config the
+    caller set in TF_CLI_CONFIG_FILE (or TERRAFORM_CONFIG) is left
+    alone, and has to set up the mirror itself.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        dict of environment variable name to value.
+    """
+    settings = provider_settings(config)
+    os.makedirs(settings['plugin_cache_dir'], exist_ok=True)
+    env = { 'TF_PLUGIN_CACHE_DIR' : settings['plugin_cache_dir'] }
+
+    if settings['mirror_dir']:
+        cli_config = _cli_config(settings['mirror_dir'])
+        if cli_config:
+            env['TF_CLI_CONFIG_FILE'] = cli_config
+
+    return env
+
+
+def _cli_config(mirror_dir):
+    """
+    Write a terraform CLI config file installing providers from
+    MIRROR_DIR, on top of the user's own CLI config.
+
+    Files are named after a digest of their contents, so concurrent
+    runs with different mirrors (or users) each get their own.
+
+    Returns:
+        string (path) of the file, or None when the caller's CLI config
+        is to be used as is.
+    """
+    for variable in [ 'TF_CLI_CONFIG_FILE', 'TERRAFORM_CONFIG' ]:
+        if os.environ.get(variable):
+            log_msg = "Using the terraform CLI config in {}, ignoring " \
+                      "mirror_dir {}"
+            logger.debug(log_msg.format(variable, mirror_dir))
+            return None
+
+    user_config = _read(os.path.join(os.path.expanduser('~'),
+                                     '.terraformrc')) or ''
+    if 'provider_installation' in user_config:
+        log_msg = "~/.terraformrc sets up provider installation, " \
+                  "ignoring mirror_dir {}"
+        logger.warning(log_msg.format(mirror_dir))
+        return None
+
+    contents = user_config.rstrip()
+    if contents:
+        contents += "\n\n"
+    contents += CLI_CONFIG_TEMPLATE.format(
+        mirror_dir=os.path.abspath(mirror_dir))
+    digest = hashlib.sha256(contents.encode('utf-8')).hexdigest()[:16]
+    cli_config = os.path.join(cache.cache_dir(),
+                              'terraform-{}.tfrc'.format(digest))
+    if _read(cli_config) != contents:
+        os.makedirs(cache.cache_dir(), exist_ok=True)
+        # Written aside and renamed, as concurrent runs may read it.
+        # Only readable by the user, as it holds their credentials.
+        tmp_config = "{}.{}".format(cli_config, os.getpid())
+        fd = os.open(tmp_config, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(contents)
+        os.replace(tmp_config, cli_config)
+
+    return cli_config
+
+
+def _read(path):
+    try:
+        with open(path) as fp:
+            return fp.read()
+    except (IOError, OSError):
+        return None
+
+
+@contextmanager
+def locked(config):
+    """
+    Hold the provider cache lock. terraform does not guard its plugin
+    cache against concurrent writers, so every command which may
+    install providers (i.e. 'terraform init') runs under it.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+    """
+    settings = provider_settings(config)
+    os.makedirs(settings['plugin_cache_dir'], exist_ok=True)
+    lock_path = os.path.join(settings['plugin_cache_dir'], '.deployer.lock')
+    with open(lock_path, 'a') as lock_file:
+        logger.debug("Waiting for provider cache lock {}".format(lock_path))
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def populate(config):
+    """
+    Pre-populate the provider cache (or mirror) with every provider the
+    terraform code at config['tf_root'] requires, so later deploys
+    start without downloading any.
+
+    With a mirror configured, 'terraform providers mirror' fills it for
+    the configured platforms. Otherwise 'terraform init -backend=false'
+    fills the plugin cache.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        nothing
+
+    Raises:
+        ShellCommandException if terraform fails.
+    """
+    settings = provider_settings(config)
+    if settings['mirror_dir']:
+        tf_command = tf.providers_mirror(settings['mirror_dir'],
+                                         settings['platforms'])
+        # The mirror has to be filled from the registry, not from itself.
+        env = { 'TF_PLUGIN_CACHE_DIR' : settings['plugin_cache_dir'] }
+        os.makedirs(settings['plugin_cache_dir'], exist_ok=True)
+    else:
+        tf_command = tf.init_providers()
+        env = environment(config)
+
+    with locked(config):
+        return_code = utils.run_command(
+            tf_command, cwd=config['tf_root'], env=env,
+            **utils.command_options(config, tf_command)).returncode
+    if return_code != 0:
+        raise ShellCommandException("{} failed with code {}.".format(
+            tf_command, return_code))
+
+    return
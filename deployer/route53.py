@@ -2,10 +2,12 @@
 #
 # Copyright Veracode Inc., 2014
 
-import boto3
 import logging
 import os
 
+import deployer.aws
+from deployer import cache
+from deployer import clients
 from deployer.exceptions import MissingConfigurationParameterException
 
 logger = logging.getLogger(os.path.basename('deployer'))
@@ -28,11 +30,20 @@ def get_zone_id(zone_name):
         msg = "DNS Zone Name not defined."
         raise MissingConfigurationParameterException(msg)
 
-    r53 = boto3.client('route53')
-    zones = r53.list_hosted_zones_by_name()
-    for zone in zones['HostedZones']:
-        if zone['Name'].rstrip('.') == zone_name :
-            if not zone['Config']['PrivateZone']:
-                return zone['Id'].split('/')[2]
-
-    return None
+    def lookup():
+        r53 = clients.client('route53')
+        zones = r53.list_hosted_zones_by_name()
+        for zone in zones['HostedZones']:
+            if zone['Name'].rstrip('.') == zone_name :
+                if not zone['Config']['PrivateZone']:
+                    return zone['Id'].split('/')[2]
+
+        return None
+
+    # Hosted zones are global, and their ids don't change, so they come
+    # from the local metadata cache whenever possible.
+    return cache.memoize('metadata',
+                         [ deployer.aws.get_account_id(), 'global',
+                           'public_zone_id', zone_name ],
+                         lookup,
+                         cache.metadata_ttl())
@@ -2,15 +2,56 @@
 #
 # Copyright Veracode Inc., 2014
 
-import boto3
+from   boto3.s3.transfer import TransferConfig
 import botocore
+from   concurrent.futures import (as_completed,
+                                  FIRST_COMPLETED,
+                                  wait)
 import logging
 import os
 
 import deployer.aws
+from   deployer import clients
+from   deployer import context
+from   deployer import pipeline
+from   deployer import utils
+from   deployer.exceptions import (ObjectCopyException,
+                                 ObjectDeletionException)
 
 logger = logging.getLogger(os.path.basename('deployer'))
 
+# delete_objects() takes at most 1000 keys per call.
+DELETE_BATCH_SIZE = 1000
+
+settings = {
+    # Concurrent delete_objects() calls made by delete_prefix().
+    'delete_workers' : 8,
+
+    # Concurrent head_object() calls made by objects_metadata().
+    'head_workers'   : 16,
+}
+
+# Defaults for the 's3_transfer' section of the deployer config. Sizes
+# are in bytes.
+TRANSFER_DEFAULTS = {
+    'multipart_threshold' : 64 * 1024 * 1024,
+    'multipart_chunksize' : 16 * 1024 * 1024,
+    'max_concurrency'     : 10,
+    'file_workers'        : 4,
+}
+
+# User metadata key holding the SHA-256 digest of staged artifacts.
+DIGEST_METADATA_KEY = 'deployer-sha256'
+
+# copy_object() copies at most 5 GiB. Larger objects are copied with
+# upload_part_copy(), in parts of 5 MiB to 5 GiB, at most 10000 of them.
+COPY_OBJECT_MAX = 5 * 1024 ** 3
+COPY_PART_MIN = 5 * 1024 * 1024
+COPY_MAX_PARTS = 10000
+
+# Error codes meaning a HEAD request found nothing.
+NOT_FOUND_ERRORS = ( '404', 'NoSuchKey', 'NoSuchBucket', 'NotFound' )
+
 
 def get_bucket_name(config, bucket_suffix=None):
     """
@@ -25,9 +66,10 @@ def get_bucket_name(config, bucket_suffix=None):
     Returns:
         bucket_name: string representing the name of a bucket.
     """
-    bucket_prefix = "{}-{}".format(config.get('account_id',
-                                              deployer.aws.get_account_id()),
-                                   config['project'])
+    account_id = config.get('account_id')
+    if account_id is None:
+        account_id = deployer.aws.get_account_id()
+    bucket_prefix = "{}-{}".format(account_id, config['project'])
     bucket_name = bucket_prefix
     if bucket_suffix:
         bucket_name = "{}-{}".format(bucket_prefix, bucket_suffix)
@@ -69,7 +111,7 @@ def create_bucket(bucket_name):
     Raises:
         botocore.exceptions.ClientError if bucket already exists.
     """
-    s3 = boto3.client('s3')
+    s3 = clients.client('s3')
     try:
         s3.create_bucket(Bucket=bucket_name,
                          ACL='private')
@@ -116,7 +158,7 @@ def destroy_bucket(bucket_name):
     Raises:
         botocore.exceptions.ClientError if bucket already exists.
     """
-    s3 = boto3.client('s3')
+    s3 = clients.client('s3')
     try:
         s3.delete_bucket(Bucket=bucket_name)
     except botocore.exceptions.ClientError as e:
@@ -142,7 +184,7 @@ def create_folder(bucket, key):
     """
     key = key if key.endswith('/') else "{}/".format(key)
     try:
-        boto3.client('s3').put_object(Bucket=bucket, Key=key)
+        clients.client('s3').put_object(Bucket=bucket, Key=key)
     except botocore.exceptions.ClientError as e:
         if not e.response.get('Error', {}).get('Code') == "BucketAlreadyExists":
             logger.error("{}".format(e.message))
@@ -150,45 +192,162 @@ def create_folder(bucket, key):
     return
 
 
-def destroy_folder(bucket, folder):
+def destroy_folder(bucket, folder, all_versions=True):
     """
     Destroys a subfolder of value KEY in bucket BUCKET.
 
     Args:
         bucket: string representing a bucket name
         key   : string representing a folder name
+        all_versions: boolean. Also purge old versions and delete
+                      markers, so nothing is left behind in versioned
+                      buckets. Defaults to True.
 
     Returns:
         nothing
+
+    Raises:
+        ObjectDeletionException if any object could not be deleted.
     """
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket)
-    delete_recursively(bucket, folder, s3)
+    prefix = folder if folder.endswith('/') else "{}/".format(folder)
+    delete_prefix(bucket, prefix, all_versions=all_versions)
 
     return
 
 
-def delete_recursively(bucket, folder, s3):
+def delete_recursively(bucket, folder, s3=None):
     """
     Destroys (recursively) a subfolder of value KEY in bucket BUCKET.
 
     Args:
-        bucket: string representing a bucket name
+        bucket: s3 Bucket object
         key   : string representing a folder name
-        s3    : s3 boto object
+        s3    : unused, kept for compatibility.
 
     Returns:
         nothing
     """
-
-    for obj in bucket.objects.filter(Prefix=folder + "/"):
-        try:
-            s3.Object(bucket.name, obj.key).delete()
-        except:
-            delete_recursively(bucket, obj.key, s3)
+    delete_prefix(bucket.name, folder + "/")
     return
 
 
+def delete_prefix(bucket, prefix, all_versions=True, workers=None):
+    """
+    Delete every object under PREFIX in bucket BUCKET.
+
+    Keys are listed page by page and deleted with delete_objects() calls
+    of up to 1000 keys each, sent from a bounded pool of workers while
+    the listing continues.
+
+    Args:
+        bucket: string representing a bucket name
+        prefix: string every key to delete starts with
+        all_versions: boolean. Delete every version and delete marker
+                      (via list_object_versions) rather than only adding
+                      delete markers to the current objects.
+        workers: number of concurrent delete_objects() calls. Defaults
+                 to settings['delete_workers'].
+
+    Returns:
+        number of keys (or versions) deleted.
+
+    Raises:
+        ObjectDeletionException if any key could not be deleted. Its
+        second argument is a dict of key to error message.
+    """
+    logmsg = "{}: Deleting everything under {}/{}"
+    logger.debug(logmsg.format(__name__, bucket, prefix))
+    client = clients.client('s3')
+    workers = workers or settings['delete_workers']
+
+    deleted = 0
+    errors = {}
+    pending = set()
+    with context.ContextThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in _delete_batches(client, bucket, prefix, all_versions):
+            if len(pending) >= 2 * workers:
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                deleted += _collect_deletes(done, errors)
+            pending.add(executor.submit(_delete_batch, client, bucket, batch))
+        deleted += _collect_deletes(pending, errors)
+
+    if errors:
+        msg = "Failed to delete {} object(s) from {}/{}:\n{}".format(
+            len(errors), bucket, prefix,
+            "\n".join("\t{}: {}".format(key, error)
+                      for key, error in sorted(errors.items())))
+        logger.error(msg)
+        raise ObjectDeletionException(msg, errors)
+
+    logmsg = "{}: Deleted {} object(s) under {}/{}"
+    logger.debug(logmsg.format(__name__, deleted, bucket, prefix))
+    return deleted
+
+
+def _delete_batches(client, bucket, prefix, all_versions):
+    """
+    Yield lists of ObjectIdentifier dicts, as taken by delete_objects(),
+    of at most DELETE_BATCH_SIZE entries.
+    """
+    batch = []
+    if all_versions:
+        paginator = client.get_paginator('list_object_versions')
+        pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
+        listings = ('Versions', 'DeleteMarkers')
+    else:
+        paginator = client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
+        listings = ('Contents',)
+
+    for page in pages:
+        for listing in listings:
+            for obj in page.get(listing, []):
+                identifier = { 'Key' : obj['Key'] }
+                if obj.get('VersionId'):
+                    identifier['VersionId'] = obj['VersionId']
+                batch.append(identifier)
+                if len(batch) == DELETE_BATCH_SIZE:
+                    yield batch
+                    batch = []
+
+    if batch:
+        yield batch
+
+
+def _delete_batch(client, bucket, batch):
+    """
+    Delete a single batch of objects.
+
+    Returns:
+        (number deleted, dict of key to error for keys which failed)
+    """
+    response = client.delete_objects(Bucket=bucket,
+                                     Delete={ 'Objects' : batch,
+                                              'Quiet' : True })
+    errors = {}
+    for error in response.get('Errors', []):
+        key = error['Key']
+        if error.get('VersionId'):
+            key = "{} ({})".format(key, error['VersionId'])
+        errors[key] = "{}: {}".format(error.get('Code'), error.get('Message'))
+
+    return (len(batch) - len(errors), errors)
+
+
+def _collect_deletes(futures, errors):
+    """
+    Gather the results of finished _delete_batch() futures, adding their
+    errors to ERRORS. Returns the number of objects deleted.
+    """
+    deleted = 0
+    for future in futures:
+        (succeeded, failed) = future.result()
+        deleted += succeeded
+        errors.update(failed)
+
+    return deleted
+
+
 def object_exists(bucket, key):
     """
     Determine if object KEY exists in specified bucket BUCKET.
@@ -199,24 +358,93 @@ def object_exists(bucket, key):
 
     Returns:
       True on success
-      False if object does not exists
+      False if object (or bucket) does not exists
+
+    Raises:
+        botocore.exceptions.ClientError on any other error.
+    """
+    return object_metadata(bucket, key) is not None
+
+
+def object_metadata(bucket, key, version_id=None):
+    """
+    Look up object KEY in bucket BUCKET with a single HEAD request.
+
+    Args:
+        bucket: string representing a bucket name
+        key   : string representing an object key
+        version_id: optional string representing a specific version
+
+    Returns:
+        None if the object (or bucket) does not exist, otherwise a dict:
+          size:          int, in bytes
+          etag:          string, without the surrounding quotes
+          version_id:    string, or None for unversioned buckets
+          last_modified: datetime
+          content_type:  string
+          metadata:      dict of user metadata
 
     Raises:
-        botocore.exceptions.ClientError if bucket does not exist.
+        botocore.exceptions.ClientError on any other error.
     """
-    s3 = boto3.resource('s3')
+    kwargs = { 'Bucket' : bucket, 'Key' : key }
+    if version_id:
+        kwargs['VersionId'] = version_id
     try:
-        bucket = s3.Bucket(bucket)
-        objs = list(bucket.objects.filter(Prefix=key))
+        response = clients.client('s3').head_object(**kwargs)
     except botocore.exceptions.ClientError as e:
-        if ( e.response.get('Error', {}).get('Code') == "NoSuchBucket" or
-             e.response.get('Error', {}).get('Code') == "NoSuchKey"):
-            return False
-    
-    if len(objs) > 0 and objs[0].key == key:
-        return True
+        if e.response.get('Error', {}).get('Code') in NOT_FOUND_ERRORS:
+            return None
+        raise
+
+    return {
+        'size'          : response.get('ContentLength'),
+        'etag'          : response.get('ETag', '').strip('"'),
+        'version_id'    : response.get('VersionId'),
+        'last_modified' : response.get('LastModified'),
+        'content_type'  : response.get('ContentType'),
+        'metadata'      : response.get('Metadata', {}),
+    }
+
+
+def objects_metadata(bucket, keys, workers=None):
+    """
+    Look up many objects in bucket BUCKET concurrently, with one HEAD
+    request per key.
+
+    Args:
+        bucket: string representing a bucket name
+        keys  : iterable of strings representing object keys
+        workers: number of concurrent requests. Defaults to
+                 settings['head_workers'].
+
+    Returns:
+        dict of key to object_metadata() result (None for keys which
+        don't exist).
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    workers = min(workers or settings['head_workers'], len(keys))
+    with context.ContextThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda key: object_metadata(bucket, key), keys)
+        return dict(zip(keys, results))
+
+
+def objects_exist(bucket, keys, workers=None):
+    """
+    Determine which of many objects exist in bucket BUCKET.
+
+    Args:
+        bucket: string representing a bucket name
+        keys  : iterable of strings representing object keys
+        workers: number of concurrent requests.
 
-    return False
+    Returns:
+        dict of key to True or False.
+    """
+    return { key : metadata is not None for key, metadata in
+             objects_metadata(bucket, keys, workers).items() }
 
 
 def delete_object(bucket, key):
@@ -235,8 +463,196 @@ def delete_object(bucket, key):
     """
     logger.debug("{}: Deleting {} from bucket {}".format(__name__, key, bucket))
     try:
-        boto3.client('s3').delete_object(Bucket=bucket, Key=key)
+        clients.client('s3').delete_object(Bucket=bucket, Key=key)
+    except:
+        raise
+
+    return
+
+
+def copy_object(bucket, key, dest_bucket, dest_key, transfer=None):
+    """
+    Copy object KEY in bucket BUCKET to DEST_KEY in bucket DEST_BUCKET,
+    server side. Nothing passes through the deploy host.
+
+    Objects above the multipart threshold are copied in parts by
+    concurrent upload_part_copy() calls, everything else with a single
+    copy_object() call. The copy is pinned to the version (or ETag) of
+    the source seen when the copy started.
+
+    Args:
+        bucket: string representing the source bucket name
+        key   : string representing the source object key
+        dest_bucket: string representing the destination bucket name
+        dest_key   : string representing the destination object key
+        transfer: dict as returned by transfer_settings(). Defaults to
+                  TRANSFER_DEFAULTS.
+
+    Returns:
+        number of bytes copied.
+
+    Raises:
+        ObjectCopyException if the source object does not exist.
+        StageCancelledException if the pipeline stage copying it was
+        cancelled before the copy started.
+        botocore.exceptions.ClientError on any other error.
+    """
+    pipeline.check_cancelled()
+    transfer = transfer or TRANSFER_DEFAULTS
+    metadata = object_metadata(bucket, key)
+    if metadata is None:
+        raise ObjectCopyException("{}/{} does not exist".format(bucket, key))
+
+    client = clients.client('s3')
+    source = { 'Bucket' : bucket, 'Key' : key }
+    if metadata['version_id']:
+        source['VersionId'] = metadata['version_id']
+    size = metadata['size']
+
+    if size <= min(transfer['multipart_threshold'], COPY_OBJECT_MAX):
+        client.copy_object(Bucket=dest_bucket, Key=dest_key,
+                           CopySource=source,
+                           CopySourceIfMatch=metadata['etag'])
+    else:
+        _copy_multipart(client, source, metadata, dest_bucket, dest_key,
+                        transfer)
+
+    logmsg = "{}: Copied {}/{} to {}/{} ({})"
+    logger.debug(logmsg.format(__name__, bucket, key, dest_bucket, dest_key,
+                               utils.format_bytes(size)))
+    return size
+
+
+def _copy_multipart(client, source, metadata, dest_bucket, dest_key,
+                    transfer):
+    """
+    Copy an object in parts, from a pool of transfer['max_concurrency']
+    workers. The upload is aborted if any part fails.
+    """
+    size = metadata['size']
+    part_size = max(transfer['multipart_chunksize'], COPY_PART_MIN,
+                    -(-size // COPY_MAX_PARTS))
+    ranges = [ (number, start, min(start + part_size, size) - 1)
+               for (number, start) in enumerate(range(0, size, part_size),
+                                                start=1) ]
+
+    create_args = { 'Bucket' : dest_bucket,
+                    'Key' : dest_key,
+                    'Metadata' : metadata['metadata'] }
+    if metadata.get('content_type'):
+        create_args['ContentType'] = metadata['content_type']
+    upload_id = client.create_multipart_upload(**create_args)['UploadId']
+
+    def copy_part(part):
+        (number, first, last) = part
+        response = client.upload_part_copy(
+            Bucket=dest_bucket, Key=dest_key, UploadId=upload_id,
+            PartNumber=number, CopySource=source,
+            CopySourceIfMatch=metadata['etag'],
+            CopySourceRange="bytes={}-{}".format(first, last))
+        return { 'PartNumber' : number,
+                 'ETag' : response['CopyPartResult']['ETag'] }
+
+    try:
+        workers = min(transfer['max_concurrency'], len(ranges))
+        executor = context.ContextThreadPoolExecutor(max_workers=workers)
+        with executor:
+            parts = list(executor.map(copy_part, ranges))
+        client.complete_multipart_upload(Bucket=dest_bucket, Key=dest_key,
+                                         UploadId=upload_id,
+                                         MultipartUpload={ 'Parts' : parts })
     except:
+        client.abort_multipart_upload(Bucket=dest_bucket, Key=dest_key,
+                                      UploadId=upload_id)
         raise
 
     return
+
+
+def copy_objects(bucket, copies, dest_bucket=None, transfer=None):
+    """
+    Copy many objects server side, from a pool of
+    transfer['file_workers'] workers.
+
+    Args:
+        bucket: string representing the source bucket name
+        copies: dict of source key to destination key
+        dest_bucket: string representing the destination bucket name.
+                     Defaults to BUCKET.
+        transfer: dict as returned by transfer_settings(). Defaults to
+                  TRANSFER_DEFAULTS.
+
+    Returns:
+        number of bytes copied.
+
+    Raises:
+        ObjectCopyException if any object could not be copied. Its
+        second argument is a dict of source key to error message.
+    """
+    if not copies:
+        return 0
+    transfer = transfer or TRANSFER_DEFAULTS
+    dest_bucket = dest_bucket or bucket
+
+    copied = 0
+    errors = {}
+    workers = min(transfer['file_workers'], len(copies))
+    with context.ContextThreadPoolExecutor(max_workers=workers) as executor:
+        futures = { executor.submit(copy_object, bucket, key, dest_bucket,
+                                    dest_key, transfer) : key
+                    for (key, dest_key) in copies.items() }
+        for future in as_completed(futures):
+            try:
+                copied += future.result()
+            except Exception as e:
+                errors[futures[future]] = str(e)
+
+    if errors:
+        msg = "Failed to copy {} object(s) from {} to {}:\n{}".format(
+            len(errors), bucket, dest_bucket,
+            "\n".join("\t{}: {}".format(key, error)
+                      for key, error in sorted(errors.items())))
+        logger.error(msg)
+        raise ObjectCopyException(msg, errors)
+
+    return copied
+
+
+def transfer_settings(config):
+    """
+    Return the 's3_transfer' section of the deployer config, filled in
+    with TRANSFER_DEFAULTS.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        dict with the keys of TRANSFER_DEFAULTS:
+          multipart_threshold: size (bytes) above which multipart is used
+          multipart_chunksize: size (bytes) of each part
+          max_concurrency:     concurrent parts per file
+          file_workers:        concurrent files
+    """
+    transfer = dict(TRANSFER_DEFAULTS)
+    transfer.update(config.get('s3_transfer', {}))
+    return transfer
+
+
+def transfer_config(config):
+    """
+    Build the boto3 TransferConfig used for every managed upload and
+    download of a file.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        boto3.s3.transfer.TransferConfig
+    """
+    transfer = transfer_settings(config)
+    return TransferConfig(multipart_threshold=transfer['multipart_threshold'],
+                          multipart_chunksize=transfer['multipart_chunksize'],
+                          max_concurrency=transfer['max_concurrency'],
+                          use_threads=transfer['max_concurrency'] > 1)
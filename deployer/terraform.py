@@ -25,6 +25,22 @@ def apply(config):
     return tf_command
 
 
+def apply_plan(plan_file):
+    """
+    Generate command for 'terraform apply' of a saved plan.
+
+    The variables were fixed when the plan was made, so none are passed,
+    and terraform does not prompt before applying a saved plan.
+
+    Args:
+        plan_file: path to a plan written by 'terraform plan -out'.
+
+    Returns:
+        tf_command: list of command-line arguments to run terraform with.
+    """
+    return ['terraform', 'apply', '-input=false', plan_file]
+
+
 def destroy(config):
     """
     Generate command for 'terraform destroy'.
@@ -55,13 +71,45 @@ def get():
     return ['terraform', 'get']
 
 
-def plan(config, action):
+def init_providers():
+    """
+    Generate command for 'terraform init' which only installs providers
+    and modules, without touching the backend.
+
+    Returns:
+        tf_command: list of command-line arguments to run terraform with.
+    """
+    return ['terraform', 'init', '-backend=false', '-input=false']
+
+
+def providers_mirror(directory, platforms=None):
+    """
+    Generate command for 'terraform providers mirror'.
+
+    Args:
+        directory: path to the local filesystem mirror to populate.
+        platforms: list of platforms (e.g. 'linux_amd64') to mirror
+                   providers for. Defaults to the current platform.
+
+    Returns:
+        tf_command: list of command-line arguments to run terraform with.
+    """
+    tf_command = ['terraform', 'providers', 'mirror']
+    tf_command += [ '-platform={}'.format(p) for p in platforms or [] ]
+    tf_command.append(directory)
+
+    return tf_command
+
+
+def plan(config, action, plan_file=None):
     """Generate command for 'terraform plan'.
 
     Args:
         config: dictionary containing all variable settings required
                 to run terraform with
         action: one of: 'create', 'destroy', or 'plan'
+        plan_file: path to save the plan to, for 'terraform apply' to
+                   run later. The plan is only shown when None.
 
     Returns:
         tf_command: list of command-line arguments to run terraform with.
@@ -71,9 +119,27 @@ def plan(config, action):
         tf_command = ['terraform', 'plan', '-destroy']
 
     tf_command += default_cmdline_options(config)
+    if plan_file:
+        tf_command.append('-out={}'.format(plan_file))
     return tf_command
 
 
+def plan_file(config, action):
+    """
+    Return the path the plan for ACTION on the environment is saved to.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+        action: one of: 'create' or 'destroy'
+
+    Returns:
+        string (path) inside the temporary workdir.
+    """
+    return os.path.join(config['tmpdir'],
+                        "{}-{}.tfplan".format(config['env_name'], action))
+
+
 def remote_state(config):
     """
     Generate command for 'terraform remote config ...'.
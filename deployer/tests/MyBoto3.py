@@ -1,4 +1,5 @@
 import boto3
+from botocore.exceptions import ClientError
 from mock import Mock
 from moto import mock_ec2
 
@@ -12,15 +13,23 @@ class MyBoto3(object):
         route53 = boto3.client('route53')
         s3 = boto3.client('s3')
         sts = boto3.client('sts')
+        # Sessions get event handlers registered (deployer.metrics).
+        self.events = Mock()
         return
 
     def setup_default_session(self, **kwargs):
         return
 
-    def resource(self, service_name):
+    def Session(self, **kwargs):
+        return self
+
+    def get_credentials(self):
+        return Mock(access_key='AKIATESTS')
+
+    def resource(self, service_name, **kwargs):
         return self.client(service_name)
 
-    def client(self, service_name):
+    def client(self, service_name, **kwargs):
         services = { 'iam'     : self.iam_stub,
                      'ec2'     : self.ec2_stub,
                      'resourcegroupstaggingapi' : self.rgtaggingapi_stub,
@@ -50,6 +59,17 @@ class MyBoto3(object):
         return Mock(get_caller_identity=Mock(
             return_value=Mock(get=Mock(return_value='123456789012'))))
 
+    class Paginator():
+        """
+        Stand-in for a botocore paginator: a single page holding the
+        whole response of the wrapped method.
+        """
+        def __init__(self, method):
+            self.method = method
+
+        def paginate(self, **kwargs):
+            yield self.method(**kwargs)
+
     class ResourceGroupsTaggingAPIClass():
         def __init__(self):
             return
@@ -57,29 +77,39 @@ class MyBoto3(object):
         def client(self):
             return self.client
 
+        def get_paginator(self, operation_name):
+            return MyBoto3.Paginator(getattr(self, operation_name))
+
+        def tag_resources(self, **kwargs):
+            return { "FailedResourcesMap": {} }
+
+        # Instances of versions a, b & c of the 'myenvname' environment.
+        resources = [
+            ("arn:aws:ec2:us-east-1:419934374614:instance/i-c3bef428", "a"),
+            ("arn:aws:ec2:us-east-1:419934374614:instance/i-0b1e7a32", "b"),
+            ("arn:aws:ec2:us-east-1:419934374614:instance/i-0c2f8b43", "c"),
+        ]
+
         def get_resources(self, **kwargs):
-            exists = {
-                "PaginationToken": "",
-                "ResourceTagMappingList": [
-                    {
-                        "ResourceARN": "arn:aws:ec2:us-east-1:419934374614:instance/i-c3bef428",
-                        "Tags": [
-                            {
-                                "Key": "env_name",
-                                "Value": "myenvname"
-                            },
-                            {
-                                "Key": "env_version",
-                                "Value": "a"
-                            },
-                            {
-                                "Key": "product",
-                                "Value": "mock_product"
-                            }
+            mappings = []
+            for (arn, version) in self.resources:
+                tags = {
+                    "env_name": "myenvname",
+                    "env_version": version,
+                    "system_type": "mock_product",
+                    "deployer_state": "running"
+                }
+                if all(tags.get(f['Key']) in f['Values']
+                       for f in kwargs['TagFilters']):
+                    mappings.append({
+                        "ResourceARN": arn,
+                        "Tags": [ { "Key": k, "Value": v }
+                                  for k, v in tags.items() ]
+                    })
 
-                        ]
-                    }
-                ],
+            return {
+                "PaginationToken": "",
+                "ResourceTagMappingList": mappings,
                 "ResponseMetadata": {
                     "RetryAttempts": 0,
                     "HTTPStatusCode": 200,
@@ -93,14 +123,6 @@ class MyBoto3(object):
                 }
             }
 
-            not_exists = { u'ResourceTagMappingList': [] }
-
-            if ( kwargs['TagFilters'][0]['Values'][0] == 'myenvname' and
-                 kwargs['TagFilters'][2]['Values'][0] != 'd') :
-                return exists
-            else:
-                return not_exists
-
     class Route53Class():
         def __init__(self):
             return
@@ -152,11 +174,16 @@ class MyBoto3(object):
         def client(self):
             return self.client
 
+        def head_object(self, **kwargs):
+            raise ClientError({ 'Error' : { 'Code' : '404',
+                                            'Message' : 'Not Found' } },
+                              'HeadObject')
+
         class Object():
             def __init__(self, bucket, key):
                 return
 
-            def upload_file(self, file):
+            def upload_file(self, file, **kwargs):
                 return True
 
     class ec2Class():
@@ -166,6 +193,40 @@ class MyBoto3(object):
         def client(self):
             return self.client
 
+        def get_paginator(self, operation_name):
+            return MyBoto3.Paginator(getattr(self, operation_name))
+
+        def describe_instances(self, **kwargs):
+            ids = kwargs.get('InstanceIds', [])
+            for f in kwargs.get('Filters', []):
+                if f['Name'] == 'instance-id':
+                    ids = f['Values']
+            return {
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {
+                                "InstanceId": instance_id,
+                                "State": { "Code": 16, "Name": "running" }
+                            }
+                            for instance_id in ids
+                        ]
+                    }
+                ]
+            }
+
+        def describe_nat_gateways(self, **kwargs):
+            ids = kwargs.get('NatGatewayIds', [])
+            for f in kwargs.get('Filter', []):
+                if f['Name'] == 'nat-gateway-id':
+                    ids = f['Values']
+            return {
+                "NatGateways": [
+                    { "NatGatewayId": natgw_id, "State": "available" }
+                    for natgw_id in ids
+                ]
+            }
+
         def describe_availability_zones(self, **kwargs):
             return {
                 "AvailabilityZones": [
@@ -0,0 +1,32 @@
+import pytest
+
+from deployer import aws
+from deployer import cache
+from deployer import clients
+from deployer import context
+from deployer import metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    # Clients are cached process-wide; make sure no test sees another
+    # test's (possibly faked or mocked) clients.
+    clients.reset()
+    aws.forget_identities()
+    aws.forget_vpc_inventories()
+    metrics.reset()
+    context.activate(None)
+    yield
+    clients.reset()
+    aws.forget_identities()
+    aws.forget_vpc_inventories()
+    metrics.reset()
+    context.activate(None)
+
+
+@pytest.fixture(autouse=True)
+def local_cache_dir(tmpdir, monkeypatch):
+    # Keep the on-disk caches out of the home directory, and make sure
+    # nothing leaks between tests.
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmpdir.join('cache')))
+    return str(tmpdir.join('cache'))
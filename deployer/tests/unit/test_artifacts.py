@@ -0,0 +1,148 @@
+'''
+Unit tests for the artifacts.py module.
+'''
+import boto3
+import hashlib
+from mock import patch
+from moto import mock_s3
+import os
+import pytest
+
+import deployer.artifacts as artifacts
+import deployer.preflight as preflight
+from   deployer.exceptions import ArtifactDownloadException
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    # Newer botocore releases send aws-chunked bodies with trailing
+    # checksums by default, which moto stores verbatim.
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    with mock_s3():
+        s3client = boto3.Session().client('s3', region_name='us-east-1')
+        s3client.create_bucket(Bucket='s3_bucket')
+        s3client.put_object(Bucket='s3_bucket', Key='artifacts/foo.zip',
+                            Body=b"foo" * 1000)
+        s3client.put_object(Bucket='s3_bucket', Key='artifacts/bar.zip',
+                            Body=b"bar" * 2000)
+        yield s3client
+
+
+def _config(tmpdir, name):
+    return {
+        "project_config" : "s3_bucket",
+        "tmpdir" : str(tmpdir.join(name)),
+        "staged_artifacts" : {
+            "artifacts/foo.zip" : "local/foo.zip",
+            "artifacts/bar.zip" : "local/bar.zip",
+        }
+    }
+
+
+def test_download_staged_artifacts_uses_cache(bucket, tmpdir):
+    config = _config(tmpdir, "env1")
+    preflight.download_staged_artifacts(config)
+    with open(os.path.join(config['tmpdir'], 'foo.zip'), 'rb') as fp:
+        assert fp.read() == b"foo" * 1000
+    with open(os.path.join(config['tmpdir'], 'bar.zip'), 'rb') as fp:
+        assert fp.read() == b"bar" * 2000
+
+    # A second environment is served entirely from the cache.
+    config = _config(tmpdir, "env2")
+    with patch('deployer.artifacts._verify', side_effect=AssertionError):
+        assert artifacts.fetch(config, 's3_bucket', {
+            'artifacts/foo.zip' : os.path.join(config['tmpdir'], 'foo.zip'),
+            'artifacts/bar.zip' : os.path.join(config['tmpdir'], 'bar.zip'),
+        }) == 0
+    with open(os.path.join(config['tmpdir'], 'foo.zip'), 'rb') as fp:
+        assert fp.read() == b"foo" * 1000
+
+    # Changing the object in S3 changes its ETag, and so its entry.
+    bucket.put_object(Bucket='s3_bucket', Key='artifacts/foo.zip',
+                      Body=b"new foo")
+    config = _config(tmpdir, "env3")
+    assert artifacts.fetch(config, 's3_bucket', {
+        'artifacts/foo.zip' : os.path.join(config['tmpdir'], 'foo.zip'),
+    }) == len(b"new foo")
+    with open(os.path.join(config['tmpdir'], 'foo.zip'), 'rb') as fp:
+        assert fp.read() == b"new foo"
+    return
+
+
+def test_fetch_without_cache(bucket, tmpdir):
+    config = _config(tmpdir, "env1")
+    config['artifact_cache'] = { 'max_bytes' : 0 }
+    local_file = str(tmpdir.join('env1', 'foo.zip'))
+    assert artifacts.fetch(config, 's3_bucket',
+                           { 'artifacts/foo.zip' : local_file }) == 3000
+    assert artifacts.fetch(config, 's3_bucket',
+                           { 'artifacts/foo.zip' : local_file }) == 3000
+    assert not os.path.exists(artifacts.artifacts_dir())
+    return
+
+
+def test_fetch_survives_concurrent_eviction(bucket, tmpdir):
+    config = _config(tmpdir, "env1")
+    local_file = str(tmpdir.join('env1', 'foo.zip'))
+    artifacts.fetch(config, 's3_bucket', { 'artifacts/foo.zip' : local_file })
+
+    # Another process evicts the blob once it was found in the cache:
+    # the artifact is downloaded again.
+    blob_size = artifacts._blob_size
+    def evicted(path):
+        size = blob_size(path)
+        os.remove(path)
+        return size
+    local_file = str(tmpdir.join('env2', 'foo.zip'))
+    with patch('deployer.artifacts._blob_size', side_effect=evicted):
+        assert artifacts.fetch(config, 's3_bucket',
+                               { 'artifacts/foo.zip' : local_file }) == 3000
+    with open(local_file, 'rb') as fp:
+        assert fp.read() == b"foo" * 1000
+
+    # Blobs of other users can't be touched, but are still used.
+    local_file = str(tmpdir.join('env3', 'foo.zip'))
+    with patch('os.utime', side_effect=PermissionError):
+        assert artifacts.fetch(config, 's3_bucket',
+                               { 'artifacts/foo.zip' : local_file }) == 0
+    with open(local_file, 'rb') as fp:
+        assert fp.read() == b"foo" * 1000
+    return
+
+
+def test_fetch_errors_propagate(bucket, tmpdir):
+    bucket.put_object(Bucket='s3_bucket', Key='artifacts/bad.zip',
+                      Body=b"bad", Metadata={ 'deployer-sha256' : 'f00' })
+    config = _config(tmpdir, "env1")
+    with pytest.raises(ArtifactDownloadException) as e:
+        artifacts.fetch(config, 's3_bucket', {
+            'artifacts/foo.zip'     : str(tmpdir.join('env1', 'foo.zip')),
+            'artifacts/bad.zip'     : str(tmpdir.join('env1', 'bad.zip')),
+            'artifacts/missing.zip' : str(tmpdir.join('env1', 'missing.zip')),
+        })
+    errors = e.value.args[1]
+    assert sorted(errors) == [ 'artifacts/bad.zip', 'artifacts/missing.zip' ]
+    assert 'does not match f00' in errors['artifacts/bad.zip']
+    assert 'does not exist' in errors['artifacts/missing.zip']
+
+    # Nothing unverified makes it into the cache.
+    digest = hashlib.sha256(b"bad").hexdigest()
+    assert not os.path.exists(os.path.join(artifacts.artifacts_dir(), digest))
+    return
+
+
+def test_evict(tmpdir):
+    os.makedirs(artifacts.artifacts_dir())
+    for (i, name) in enumerate(['old', 'middle', 'new']):
+        path = os.path.join(artifacts.artifacts_dir(), name)
+        with open(path, 'wb') as fp:
+            fp.write(b"x" * 100)
+        os.utime(path, (1000 + i, 1000 + i))
+    stale = os.path.join(artifacts.artifacts_dir(), '.tmp-abc')
+    open(stale, 'w').close()
+    os.utime(stale, (0, 0))
+
+    assert artifacts.evict(250) == 1
+    assert sorted(os.listdir(artifacts.artifacts_dir())) == ['middle', 'new']
+    assert artifacts.evict(0) == 2
+    return
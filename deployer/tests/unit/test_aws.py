@@ -7,14 +7,18 @@ in moto yet.
 '''
 import os
 import pytest
+import threading
 import boto3
-from mock import patch
+from botocore.exceptions import ClientError
+from mock import Mock, patch
 from moto import mock_s3
 from moto import mock_ec2
 from moto import mock_iam
 from moto import mock_sts
 
 import deployer.aws as aws
+from   deployer import context
+from   deployer.exceptions import ResourceTaggingException
 import deployer.tests.MyBoto3 as MyBoto3
 
 _environment = {}
@@ -143,7 +147,7 @@ def test_configure_config(mock_config):
 
     s3client.create_bucket(Bucket=expected_config['project_config'])
     s3client.create_bucket(Bucket=expected_config['tf_state_bucket'])
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         # We need to create the bucket since this is all in Moto's 'virtual'
         # AWS account
         returned_config = aws.configure(mock_config)
@@ -205,7 +209,7 @@ def test_configure_config_with_tags_no_version(mock_config_with_tags):
     s3client.create_bucket(Bucket=expected_config['tf_state_bucket'])
     # We need to create the bucket since this is all in Moto's 'virtual'
     # AWS account
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         returned_config = aws.configure(mock_config_with_tags)
     assert returned_config == expected_config
 
@@ -258,7 +262,7 @@ def test_configure_config_with_tags(mock_config_with_tags):
     s3client = boto3.client('s3')
     s3client.create_bucket(Bucket=expected_config['project_config'])
     s3client.create_bucket(Bucket=expected_config['tf_state_bucket'])
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         # We need to create the bucket since this is all in Moto's 'virtual'
         # AWS account
         returned_config = aws.configure(mock_config_with_tags)
@@ -278,13 +282,20 @@ def test_configure_env(mock_config, mock_env):
     # fake_boto3 still required here because mock_iam has not yet
     # implemented the list_account_aliases() method yet, which is used
     # in aws.configure().
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         session = boto3.Session(profile_name='tests-random')
         s3client = session.client('s3')
         s3client.create_bucket(Bucket="123456789012-myproj-data")
         aws.configure(mock_config)
         returned_env = dict(os.environ)
-    assert returned_env == mock_env
+    # The process environment is left alone; the deployment's settings
+    # are carried by its context, and commands get them from there.
+    assert returned_env == {}
+    deployment = context.current()
+    assert deployment.variables() == mock_env
+    assert deployment.command_environment(
+        { 'AWS_ACCESS_KEY_ID' : 'foo', 'PATH' : '/bin' }) == dict(mock_env,
+                                                                 PATH='/bin')
     reset_env()
     return
 
@@ -292,7 +303,7 @@ def test_configure_env(mock_config, mock_env):
 @mock_iam
 def test_get_account_name(mock_config):
     '''list_account_aliases() Not yet implemented.'''
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         assert aws.get_account_name() == mock_config['aws_profile']
     return
 
@@ -300,7 +311,7 @@ def test_get_account_name(mock_config):
 @mock_sts
 def test_get_account_id(mock_config):
     mock_config['account_id'] = "123456789012"
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         returned_id = aws.get_account_id()
     assert returned_id == mock_config['account_id']
     return
@@ -333,7 +344,7 @@ def test_get_current_az_list_no_list():
                       "us-east-1e",
                       "us-east-1f"]
 
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         returned_zones = aws.get_current_az_list(passed_config)
 
     for zone in returned_zones:
@@ -348,7 +359,7 @@ def test_list_vpcs(mock_config):
 
     # Create our mock VPCs.
     mock_vpcs()
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         returned_vpcs = aws.list_vpcs(env)
     assert returned_vpcs == expected_vpcs
     return
@@ -359,6 +370,353 @@ def test_list_vpcs(mock_config):
 def test_environment_does_not_exist(mock_config):
     mock_config['environment']['name'] = 'myenvname'
     mock_config['environment']['version'] = 'z'
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         assert not aws.environment_exists(mock_config)
     return
+
+
+@mock_ec2
+def test_resource_liveness():
+    ec2c = boto3.client('ec2', region_name='us-east-1')
+    image_id = ec2c.describe_images()['Images'][0]['ImageId']
+    reservation = ec2c.run_instances(ImageId=image_id, MinCount=2, MaxCount=2)
+    (running, stopped) = [ i['InstanceId'] for i in reservation['Instances'] ]
+    ec2c.stop_instances(InstanceIds=[ stopped ])
+
+    arn = "arn:aws:ec2:us-east-1:123456789012:{}"
+    running_arn = arn.format("instance/{}".format(running))
+    stopped_arn = arn.format("instance/{}".format(stopped))
+    missing_arn = arn.format("instance/i-00000000")
+    vpc_arn = arn.format("vpc/vpc-00000000")
+
+    liveness = aws.resource_liveness([ running_arn, stopped_arn,
+                                       missing_arn, vpc_arn ])
+    assert liveness == { running_arn : True,
+                         stopped_arn : False,
+                         missing_arn : False,
+                         vpc_arn     : True }
+    assert aws.live_resources([ vpc_arn, stopped_arn, running_arn ]) == [
+        vpc_arn, running_arn ]
+    return
+
+
+def test_arn_resource():
+    arn = "arn:aws:ec2:us-east-1:123456789012:natgateway/nat-0123456789"
+    assert aws.arn_resource(arn) == ('natgateway', 'nat-0123456789')
+    arn = "arn:aws:s3:::my-bucket"
+    assert aws.arn_resource(arn) == ('my-bucket', None)
+    return
+
+
+class PagedTaggingClient(object):
+    """
+    resourcegroupstaggingapi stand-in which serves one resource per page.
+    """
+    def __init__(self, mappings):
+        self.mappings = mappings
+        self.pages_served = 0
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, **kwargs):
+        for mapping in self.mappings:
+            self.pages_served += 1
+            yield { 'ResourceTagMappingList' : [ mapping ],
+                    'PaginationToken' : 'token' }
+
+
+@mock_ec2
+def test_iter_tagged_resources_streams_pages():
+    ec2c = boto3.client('ec2', region_name='us-east-1')
+    image_id = ec2c.describe_images()['Images'][0]['ImageId']
+    reservation = ec2c.run_instances(ImageId=image_id, MinCount=3, MaxCount=3)
+    instance_ids = [ i['InstanceId'] for i in reservation['Instances'] ]
+    ec2c.stop_instances(InstanceIds=instance_ids[-1:])
+
+    arn = "arn:aws:ec2:us-east-1:123456789012:instance/{}"
+    tags = [ { 'Key' : 'env_name', 'Value' : 'myenvname' },
+             { 'Key' : 'env_version', 'Value' : 'a' } ]
+    client = PagedTaggingClient([ { 'ResourceARN' : arn.format(i),
+                                    'Tags' : tags } for i in instance_ids ])
+
+    tag_filters = aws.environment_tag_filters('myenvname', 'a',
+                                              state='running')
+    resources = aws.iter_tagged_resources(tag_filters, client)
+    first = next(resources)
+    assert client.pages_served == 1
+    assert first.resource_id == instance_ids[0]
+    assert first.tags['env_version'] == 'a'
+    assert len(list(resources)) == 2
+
+    live = list(aws.iter_live_resources(
+        aws.iter_tagged_resources(tag_filters, PagedTaggingClient(
+            client.mappings)), batch_size=2))
+    assert [ r.resource_id for r in live ] == instance_ids[:-1]
+    return
+
+
+def test_identity_is_resolved_once_per_profile():
+    sts = Mock(get_caller_identity=Mock(return_value={ 'Account' : '42' }))
+    with patch('deployer.clients.client', return_value=sts), \
+         patch('deployer.aws._credentials_key', return_value='key-1'):
+        assert aws.get_account_id('tests-random') == '42'
+        assert aws.get_account_id('tests-random') == '42'
+        assert sts.get_caller_identity.call_count == 1
+
+        # A new process (no memo) is served from the on-disk cache.
+        aws.forget_identities()
+        assert aws.get_account_id('tests-random') == '42'
+        assert sts.get_caller_identity.call_count == 1
+
+        assert aws.get_account_id('other-profile') == '42'
+        assert sts.get_caller_identity.call_count == 2
+    return
+
+
+def test_identity_disk_cache_follows_credentials():
+    # A profile pointed at other credentials (maybe of another account)
+    # never gets the account id cached for the old ones.
+    sts = Mock(get_caller_identity=Mock(side_effect=[ { 'Account' : '42' },
+                                                      { 'Account' : '43' } ]))
+    with patch('deployer.clients.client', return_value=sts):
+        with patch('deployer.aws._credentials_key', return_value='key-1'):
+            assert aws.get_account_id('tests-random') == '42'
+        aws.forget_identities()
+        with patch('deployer.aws._credentials_key', return_value='key-2'):
+            assert aws.get_account_id('tests-random') == '43'
+    return
+
+
+def test_account_name_is_never_cached_on_disk():
+    iam = Mock(list_account_aliases=Mock(return_value={
+        'AccountAliases' : [ 'tests-random' ] }))
+    with patch('deployer.clients.client', return_value=iam), \
+         patch('deployer.aws._credentials_key', return_value='key-1'):
+        aws.get_account_name('tests-random')
+        aws.get_account_name('tests-random')
+        assert iam.list_account_aliases.call_count == 1
+        aws.get_account_name('tests-random', refresh=True)
+        assert iam.list_account_aliases.call_count == 2
+        aws.forget_identities()
+        aws.get_account_name('tests-random')
+        assert iam.list_account_aliases.call_count == 3
+    return
+
+
+def test_identity_disk_cache_disabled():
+    sts = Mock(get_caller_identity=Mock(return_value={ 'Account' : '42' }))
+    with patch('deployer.clients.client', return_value=sts):
+        with patch.dict(aws.settings, { 'identity_cache_ttl' : 0 }):
+            aws.get_account_id('tests-random')
+            aws.forget_identities()
+            aws.get_account_id('tests-random')
+    assert sts.get_caller_identity.call_count == 2
+    return
+
+
+def test_get_current_az_list_is_cached():
+    ec2c = Mock(describe_availability_zones=Mock(return_value={
+        'AvailabilityZones' : [ { 'State' : 'available',
+                                  'ZoneName' : 'us-east-1a' },
+                                { 'State' : 'impaired',
+                                  'ZoneName' : 'us-east-1b' } ] }))
+    passed_config = { 'account_id' : '123456789012',
+                      'aws_region' : 'us-east-1' }
+    with patch('deployer.clients.client', return_value=ec2c):
+        assert aws.get_current_az_list(dict(passed_config)) == ['us-east-1a']
+        assert aws.get_current_az_list(dict(passed_config)) == ['us-east-1a']
+    assert ec2c.describe_availability_zones.call_count == 1
+    return
+
+
+class TaggingClient(PagedTaggingClient):
+    """
+    resourcegroupstaggingapi stand-in which records tag_resources()
+    calls and fails the ARNs listed in FAILURES the first N times.
+    """
+    def __init__(self, mappings, failures=None):
+        super(TaggingClient, self).__init__(mappings)
+        self.failures = failures or {}
+        self.tagged = []
+        self.lock = threading.Lock()
+
+    def tag_resources(self, ResourceARNList, Tags):
+        assert len(ResourceARNList) <= 20
+        failed = {}
+        with self.lock:
+            for arn in ResourceARNList:
+                (error, times) = self.failures.get(arn, (None, 0))
+                if times:
+                    self.failures[arn] = (error, times - 1)
+                    failed[arn] = error
+                else:
+                    self.tagged.append(arn)
+        return { 'FailedResourcesMap' : failed }
+
+
+def tagging_config(state):
+    return { 'environment' : { 'name' : 'myenvname', 'version' : 'a' },
+             'tags' : { 'deployer_state' : state } }
+
+
+def subnet_mappings(count, state=None):
+    arn = "arn:aws:ec2:us-east-1:123456789012:subnet/subnet-{:04d}"
+    mappings = []
+    for i in range(count):
+        tags = [ { 'Key' : 'env_name', 'Value' : 'myenvname' } ]
+        if state and i % 2:
+            tags.append({ 'Key' : 'deployer_state', 'Value' : state })
+        mappings.append({ 'ResourceARN' : arn.format(i), 'Tags' : tags })
+    return mappings
+
+
+def test_tag_resources_skips_already_tagged():
+    client = TaggingClient(subnet_mappings(90, state='running'))
+    with patch('deployer.clients.client', return_value=client):
+        assert aws.tag_resources(tagging_config('running')) == 45
+    assert len(client.tagged) == 45
+    assert len(set(client.tagged)) == 45
+    return
+
+
+def test_tag_resources_retries_failed_arns():
+    mappings = subnet_mappings(50)
+    throttled = { 'StatusCode' : 400, 'ErrorCode' : 'ThrottlingException',
+                  'ErrorMessage' : 'Rate exceeded' }
+    flaky = mappings[3]['ResourceARN']
+    client = TaggingClient(mappings, { flaky : (throttled, 2) })
+    with patch.dict(aws.settings, { 'tagging_base_backoff' : 0 }):
+        with patch('deployer.clients.client', return_value=client):
+            assert aws.tag_resources(tagging_config('destroy')) == 50
+    assert client.tagged.count(flaky) == 1
+    assert len(client.tagged) == 50
+    return
+
+
+def test_tag_resources_reports_failures():
+    mappings = subnet_mappings(30)
+    invalid = { 'StatusCode' : 400, 'ErrorCode' : 'InvalidParameterException',
+                'ErrorMessage' : 'Nope' }
+    internal = { 'StatusCode' : 500, 'ErrorCode' : 'InternalServiceException',
+                 'ErrorMessage' : 'Oops' }
+    bad = mappings[0]['ResourceARN']
+    broken = mappings[25]['ResourceARN']
+    client = TaggingClient(mappings, { bad : (invalid, 1),
+                                       broken : (internal, 100) })
+    with patch.dict(aws.settings, { 'tagging_base_backoff' : 0 }):
+        with patch('deployer.clients.client', return_value=client):
+            with pytest.raises(ResourceTaggingException) as e:
+                aws.tag_resources(tagging_config('destroy'))
+
+    assert e.value.args[1] == {
+        bad : 'InvalidParameterException: Nope',
+        broken : 'InternalServiceException: Oops' }
+    assert len(client.tagged) == 28
+    return
+
+
+def test_tag_resources_tags_stopped_resources():
+    # Stopped instances and deleted nat gateways get the new
+    # deployer_state too, without any EC2 call to look at them.
+    arn = "arn:aws:ec2:us-east-1:123456789012:{}"
+    tags = [ { 'Key' : 'env_name', 'Value' : 'myenvname' } ]
+    arns = [ arn.format("instance/i-00000001"),
+             arn.format("natgateway/nat-00000001"),
+             arn.format("vpc/vpc-00000001") ]
+    client = TaggingClient([ { 'ResourceARN' : a, 'Tags' : tags }
+                             for a in arns ])
+    def tagging_client(service, *args, **kwargs):
+        assert service == 'resourcegroupstaggingapi'
+        return client
+    with patch('deployer.clients.client', side_effect=tagging_client):
+        assert aws.tag_resources(tagging_config('destroy')) == 3
+    assert sorted(client.tagged) == sorted(arns)
+    return
+
+
+def test_instance_states_raises_errors():
+    denied = ClientError({ 'Error' : { 'Code' : 'UnauthorizedOperation',
+                                       'Message' : 'Nope' } },
+                         'DescribeInstances')
+    paginator = Mock(paginate=Mock(side_effect=denied))
+    ec2c = Mock(get_paginator=Mock(return_value=paginator))
+    with pytest.raises(ClientError):
+        aws.instance_states([ 'i-00000001' ], ec2c)
+    return
+
+
+def test_live_environment_versions():
+    arn = "arn:aws:ec2:us-east-1:123456789012:{}"
+    def mapping(resource, version):
+        return { 'ResourceARN' : arn.format(resource),
+                 'Tags' : [ { 'Key' : 'env_name', 'Value' : 'myenvname' },
+                            { 'Key' : 'env_version', 'Value' : version } ] }
+
+    client = PagedTaggingClient([ mapping('instance/i-stopped', 'a'),
+                                  mapping('instance/i-running1', 'b'),
+                                  mapping('vpc/vpc-1', 'b'),
+                                  mapping('natgateway/nat-1', 'c'),
+                                  mapping('instance/i-running2', 'c'),
+                                  mapping('vpc/vpc-2', 'e') ])
+    liveness = Mock(side_effect=lambda arns: {
+        a : not a.endswith('stopped') for a in arns })
+    with patch('deployer.clients.client', return_value=client):
+        with patch('deployer.aws.resource_liveness', liveness):
+            versions = aws.live_environment_versions('myenvname')
+
+    assert versions == { 'b', 'c', 'e' }
+    # Only the versions without any always-live resource get checked,
+    # all in a single batch.
+    assert liveness.call_count == 1
+    assert sorted(liveness.call_args[0][0]) == sorted([
+        arn.format('instance/i-stopped'),
+        arn.format('natgateway/nat-1'),
+        arn.format('instance/i-running2') ])
+    return
+
+
+@mock_ec2
+def test_vpc_inventory_single_pass(mock_config):
+    ec2c = boto3.client('ec2', region_name='us-east-1')
+    for (i, version) in enumerate('abc'):
+        vpc = ec2c.create_vpc(CidrBlock='10.{}.0.0/16'.format(i + 1))
+        ec2c.create_tags(Resources=[ vpc['Vpc']['VpcId'] ],
+                         Tags=[ { 'Key' : 'Name',
+                                  'Value' : 'myproj-myenvname-' + version },
+                                { 'Key' : 'env',
+                                  'Value' : 'myenvname-' + version } ])
+    vpc = ec2c.create_vpc(CidrBlock='10.9.0.0/16')
+    ec2c.create_tags(Resources=[ vpc['Vpc']['VpcId'] ],
+                     Tags=[ { 'Key' : 'env', 'Value' : 'otherenv-a' } ])
+
+    registry_client = aws.clients.client('ec2', region='us-east-1')
+    with patch('deployer.clients.client', return_value=registry_client):
+        with patch.object(registry_client, 'get_paginator',
+                          wraps=registry_client.get_paginator) as paginator:
+            assert aws.list_vpcs('myenvname') == [ 'myenvname-a',
+                                                   'myenvname-b',
+                                                   'myenvname-c' ]
+            assert aws.list_vpcs('otherenv') == [ 'otherenv-a' ]
+
+            mock_config['env_name'] = 'myenvname-b'
+            assert aws.vpc_exists(mock_config)
+            mock_config['env_name'] = 'myenvname-d'
+            assert not aws.vpc_exists(mock_config)
+
+            assert paginator.call_count == 1
+            aws.vpc_inventory(refresh=True)
+            assert paginator.call_count == 2
+
+            # Expired indexes are rebuilt, picking up new VPCs. One
+            # entry is listed per VPC, even if they share a tag value.
+            vpc = ec2c.create_vpc(CidrBlock='10.8.0.0/16')
+            ec2c.create_tags(Resources=[ vpc['Vpc']['VpcId'] ],
+                             Tags=[ { 'Key' : 'env',
+                                      'Value' : 'otherenv-a' } ])
+            assert aws.list_vpcs('otherenv') == [ 'otherenv-a' ]
+            with patch.dict(aws.settings, { 'vpc_inventory_ttl' : 0 }):
+                assert aws.list_vpcs('otherenv') == [ 'otherenv-a',
+                                                      'otherenv-a' ]
+            assert paginator.call_count == 3
+    return
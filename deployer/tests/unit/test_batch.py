@@ -0,0 +1,75 @@
+'''
+Unit tests for the batch.py module.
+'''
+import json
+import os
+import pytest
+
+import deployer.batch as batch
+from   deployer.exceptions import ConfigFileException
+
+FAKE_DEPLOYER = """
+import os, sys
+print("{} {} cache={}".format(sys.argv[1], os.path.basename(sys.argv[3]),
+                              os.environ['DEPLOYER_CACHE_DIR']))
+sys.exit(3 if 'bad' in sys.argv[3] else 0)
+"""
+
+
+def _varfile(directory, name, version, **extra):
+    config = { 'environment' : { 'name' : name, 'version' : version } }
+    config.update(extra)
+    path = directory.join("{}-{}.json".format(name, version))
+    path.write(json.dumps(config))
+    return str(path)
+
+
+def test_expand_and_jobs(tmpdir):
+    good = _varfile(tmpdir, 'good', 'a', tags={ 'system_type' : 'svc' })
+    bad = _varfile(tmpdir, 'bad', 'b')
+    varfiles = batch.expand([ str(tmpdir.join('*.json')), good ])
+    assert varfiles == sorted([ good, bad ])
+    assert batch.jobs(varfiles) == [ batch.Job('bad-b', bad),
+                                     batch.Job('svc-good-a', good) ]
+
+    with pytest.raises(ConfigFileException):
+        batch.expand([ str(tmpdir.join('missing*.json')) ])
+
+    other = tmpdir.mkdir('other')
+    duplicate = _varfile(other, 'bad', 'b')
+    with pytest.raises(ConfigFileException):
+        batch.jobs([ bad, duplicate ])
+
+    first = _varfile(other, 'one', 'a', tmpdir='/tmp/shared')
+    second = _varfile(other, 'two', 'a', tmpdir='/tmp/shared')
+    with pytest.raises(ConfigFileException):
+        batch.jobs([ first, second ])
+    return
+
+
+def test_run(tmpdir, capsys, local_cache_dir):
+    script = tmpdir.join('deployer')
+    script.write(FAKE_DEPLOYER)
+    good = _varfile(tmpdir, 'good', 'a')
+    bad = _varfile(tmpdir, 'bad', 'b')
+    log_dir = str(tmpdir.join('logs'))
+
+    results = batch.run(str(script), 'plan', [ str(tmpdir.join('*.json')) ],
+                        workers=2, log_dir=log_dir, options=['--debug'])
+    assert [ (r.name, r.returncode) for r in results ] == [ ('bad-b', 3),
+                                                            ('good-a', 0) ]
+
+    # Every line is prefixed with its environment on the console, and
+    # each environment has a log of its own.
+    out = capsys.readouterr().out
+    assert "[good-a] plan good-a.json cache={}\n".format(local_cache_dir) in out
+    assert "[bad-b ] plan bad-b.json" in out
+    with open(os.path.join(log_dir, 'good-a.log')) as fp:
+        assert fp.read().endswith("plan good-a.json cache={}\n".format(
+            local_cache_dir))
+
+    summary = batch.summary(results).splitlines()
+    assert summary[1].split()[:3] == [ 'bad-b', 'failed', '3' ]
+    assert summary[2].split()[:2] == [ 'good-a', 'ok' ]
+    assert summary[-1].startswith("1 succeeded, 1 failed")
+    return
@@ -6,6 +6,7 @@ apparently, the features of boto3 we use have not yet been implemented
 in moto yet.
 '''
 import boto3
+import hashlib
 from mock import patch
 from moto import mock_ec2
 from moto import mock_s3
@@ -80,17 +81,15 @@ def test_upload_staged_artifacts_no_local_dir():
     return
 
 
-def mock_isfile(args):
-    return True
-
-
 @mock_s3
 @mock_ec2
-def test_upload_staged_artifacts_upload_succeeds():
+def test_upload_staged_artifacts_upload_succeeds(tmpdir):
+    local_file = tmpdir.join("orig_foo")
+    local_file.write("foo")
     config = {
         "project_config" : "s3_bucket",
         "staged_artifacts" : {
-            "artifacts/foo" : "local_dir/orig_foo",
+            "artifacts/foo" : str(local_file),
         }
     }
     s3client = boto3.client('s3')
@@ -98,25 +97,26 @@ def test_upload_staged_artifacts_upload_succeeds():
 
     # Still need fake_boto3 here because of how moto's file_upload
     # call works...
-    with patch('deployer.bootstrap.boto3', fake_boto3):
-        with patch('deployer.bootstrap.os.path.isfile', mock_isfile):
-            ret_val = bootstrap.upload_staged_artifacts(config)
+    with patch('deployer.clients.boto3', fake_boto3):
+        ret_val = bootstrap.upload_staged_artifacts(config)
     assert ret_val
 
     return
 
 
-def mock_upload(*args):
+def mock_upload(*args, **kwargs):
     raise ValueError("FAILED TO UPLOAD")
     return False
 
 
 @mock_s3
-def test_upload_staged_artifacts_upload_fails():
+def test_upload_staged_artifacts_upload_fails(tmpdir):
+    local_file = tmpdir.join("orig_foo")
+    local_file.write("foo")
     config = {
         "project_config" : "s3_bucket",
         "staged_artifacts" : {
-            "artifacts/foo" : "local_dir/orig_foo",
+            "artifacts/foo" : str(local_file),
         }
     }
     source_file = os.path.abspath(config['staged_artifacts']['artifacts/foo'])
@@ -131,11 +131,90 @@ def test_upload_staged_artifacts_upload_fails():
     with pytest.raises(ValueError) as e:
         # Still need fake_boto3 here because of how moto's file_upload
         # call works...
-        with patch('deployer.bootstrap.boto3', fake_boto3):
-            with patch('deployer.bootstrap.os.path.isfile', mock_isfile):
-                with patch('deployer.tests.MyBoto3.MyBoto3.S3Class.Object.upload_file', mock_upload):
-                    bootstrap.upload_staged_artifacts(config)
+        with patch('deployer.clients.boto3', fake_boto3):
+            with patch('deployer.tests.MyBoto3.MyBoto3.S3Class.Object.upload_file', mock_upload):
+                bootstrap.upload_staged_artifacts(config)
 
     assert e.value.args[0] == expected_error
     return
 
+
+
+@mock_s3
+def test_upload_staged_artifacts_parallel_multipart(tmpdir, monkeypatch):
+    # Newer botocore releases send aws-chunked bodies with trailing
+    # checksums by default, which moto stores verbatim.
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    staged = {}
+    for i in range(6):
+        local_file = tmpdir.join("artifact{}".format(i))
+        local_file.write_binary(bytes([i]) * (6 * 1024 * 1024 + i))
+        staged["artifacts/artifact{}".format(i)] = str(local_file)
+    config = {
+        "project_config" : "s3_bucket",
+        "staged_artifacts" : staged,
+        "s3_transfer" : {
+            "multipart_threshold" : 5 * 1024 * 1024,
+            "multipart_chunksize" : 5 * 1024 * 1024,
+            "file_workers" : 3
+        }
+    }
+    s3client = boto3.Session().client('s3', region_name='us-east-1')
+    s3client.create_bucket(Bucket=config['project_config'])
+
+    assert bootstrap.upload_staged_artifacts(config)
+
+    for (i, bucket_key) in enumerate(sorted(staged)):
+        body = s3client.get_object(Bucket='s3_bucket',
+                                   Key=bucket_key)['Body'].read()
+        assert body == bytes([i]) * (6 * 1024 * 1024 + i)
+    return
+
+
+def _staged_config(tmpdir, contents):
+    staged = {}
+    for (name, body) in contents.items():
+        local_file = tmpdir.join(name)
+        local_file.write_binary(body)
+        staged["artifacts/{}".format(name)] = str(local_file)
+    return {
+        "project_config" : "s3_bucket",
+        "staged_artifacts" : staged,
+    }
+
+
+@mock_s3
+def test_upload_staged_artifacts_skips_unchanged(tmpdir, monkeypatch):
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    config = _staged_config(tmpdir, { "foo" : b"foo", "bar" : b"bar" })
+    s3client = boto3.Session().client('s3', region_name='us-east-1')
+    s3client.create_bucket(Bucket=config['project_config'])
+
+    assert bootstrap.upload_staged_artifacts(config)
+    head = s3client.head_object(Bucket='s3_bucket', Key='artifacts/foo')
+    assert head['Metadata']['deployer-sha256'] == hashlib.sha256(b"foo").hexdigest()
+
+    uploaded = []
+    real_upload = bootstrap._upload_file
+    def counting_upload(*args, **kwargs):
+        size = real_upload(*args, **kwargs)
+        if size:
+            uploaded.append(args[2])
+        return size
+
+    # Only the changed file goes out the second time around.
+    tmpdir.join("bar").write_binary(b"bar, changed")
+    with patch('deployer.bootstrap._upload_file', counting_upload):
+        assert bootstrap.upload_staged_artifacts(config)
+    assert uploaded == ['artifacts/bar']
+    body = s3client.get_object(Bucket='s3_bucket',
+                               Key='artifacts/bar')['Body'].read()
+    assert body == b"bar, changed"
+
+    # Turning the check off uploads everything again.
+    del uploaded[:]
+    config['skip_unchanged_artifacts'] = False
+    with patch('deployer.bootstrap._upload_file', counting_upload):
+        assert bootstrap.upload_staged_artifacts(config)
+    assert sorted(uploaded) == ['artifacts/bar', 'artifacts/foo']
+    return
@@ -0,0 +1,99 @@
+'''
+Unit tests for the cache.py module.
+'''
+import os
+from   mock import Mock, patch
+
+from   deployer import cache
+
+
+def test_put_get(local_cache_dir):
+    cache.put('things', [ 'profile', 'key' ], { 'a' : 1 }, 60)
+    assert cache.get('things', [ 'profile', 'key' ]) == { 'a' : 1 }
+    assert cache.get('things', [ 'profile', 'other' ]) is None
+    assert cache.get('other_things', [ 'profile', 'key' ]) is None
+
+    # Nothing but the entry itself is left behind.
+    assert len(os.listdir(os.path.join(local_cache_dir, 'things'))) == 1
+    return
+
+
+def test_expired_entry():
+    with patch('deployer.cache.time.time', return_value=1000):
+        cache.put('things', 'key', 'value', 60)
+    with patch('deployer.cache.time.time', return_value=1059):
+        assert cache.get('things', 'key') == 'value'
+    with patch('deployer.cache.time.time', return_value=1061):
+        assert cache.get('things', 'key') is None
+    return
+
+
+def test_prune(local_cache_dir):
+    with patch('deployer.cache.time.time', return_value=1000):
+        cache.put('things', 'old', 'value', 60)
+        cache.put('things', 'new', 'value', 600)
+        cache.put('things', 'forever', 'value', None)
+        cache.put('other_things', 'old', 'value', 60)
+    with open(os.path.join(local_cache_dir, 'things', 'broken.json'),
+              'w') as fp:
+        fp.write("{")
+    with patch('deployer.cache.time.time', return_value=1100):
+        assert cache.prune('things') == 2
+        assert cache.get('things', 'new') == 'value'
+        assert cache.get('things', 'forever') == 'value'
+    assert len(os.listdir(os.path.join(local_cache_dir, 'things'))) == 2
+    assert len(os.listdir(os.path.join(local_cache_dir, 'other_things'))) == 1
+    assert cache.prune('missing') == 0
+    return
+
+
+def test_put_never_fails(local_cache_dir):
+    with open(local_cache_dir, 'w') as fp:
+        fp.write("not a directory")
+    cache.put('things', 'key', 'value', 60)
+    assert cache.get('things', 'key') is None
+    return
+
+
+def test_memoize():
+    compute = Mock(return_value=[ 'us-east-1a' ])
+    key = [ '123456789012', 'us-east-1', 'availability_zones' ]
+    assert cache.memoize('metadata', key, compute, 60) == [ 'us-east-1a' ]
+    assert cache.memoize('metadata', key, compute, 60) == [ 'us-east-1a' ]
+    assert compute.call_count == 1
+
+    # A ttl of 0 turns the cache off.
+    cache.memoize('metadata', key, compute, 0)
+    assert compute.call_count == 2
+
+    # Misses are not cached.
+    missing = Mock(return_value=None)
+    cache.memoize('metadata', 'missing', missing, 60)
+    cache.memoize('metadata', 'missing', missing, 60)
+    assert missing.call_count == 2
+    return
+
+
+def test_invalidate():
+    cache.put('metadata', 'key', 'value', 60)
+    assert cache.invalidate('metadata', 'key')
+    assert cache.get('metadata', 'key') is None
+    assert not cache.invalidate('metadata', 'key')
+    return
+
+
+def test_clear(local_cache_dir):
+    cache.put('metadata', 'key', 'value', 60)
+    cache.put('identity', 'key', 'value', 60)
+
+    cache.clear('metadata')
+    assert cache.get('metadata', 'key') is None
+    assert cache.get('identity', 'key') == 'value'
+
+    cache.clear()
+    assert cache.get('identity', 'key') is None
+    assert not os.path.exists(local_cache_dir)
+
+    # Clearing an empty cache is fine.
+    cache.clear()
+    return
@@ -0,0 +1,84 @@
+'''
+Unit tests for the clients.py module.
+'''
+import threading
+import time
+from   mock import patch
+
+from   deployer import clients
+from   deployer import context
+
+
+def test_client_is_cached():
+    ec2c = clients.client('ec2', region='us-east-1')
+    assert clients.client('ec2', region='us-east-1') is ec2c
+    assert clients.client('ec2', region='us-west-2') is not ec2c
+    assert clients.client('s3', region='us-east-1') is not ec2c
+    return
+
+
+def test_client_config():
+    ec2c = clients.client('ec2', region='us-east-1')
+    assert ec2c.meta.config.max_pool_connections == \
+        clients.settings['max_pool_connections']
+    assert ec2c.meta.config.retries['mode'] == 'adaptive'
+    return
+
+
+def test_deployment_settings():
+    # A deployment's 'aws_client' section gets it clients of its own,
+    # and leaves everyone else's alone.
+    ec2c = clients.client('ec2', region='us-east-1')
+    tuned = context.DeploymentContext('default', 'us-east-1', settings={
+        'aws_client' : { 'max_pool_connections' : 7 } })
+    with context.using(tuned):
+        new_ec2c = clients.client('ec2', region='us-east-1')
+        assert new_ec2c is not ec2c
+        assert new_ec2c.meta.config.max_pool_connections == 7
+    assert clients.client('ec2', region='us-east-1') is ec2c
+    assert clients.settings['max_pool_connections'] != 7
+
+    clients.configure({ 'aws_client' : { 'max_pool_connections' : 7 } })
+    assert clients.client('ec2', region='us-east-1') is ec2c
+    return
+
+
+def test_resource_is_cached_per_thread():
+    s3 = clients.resource('s3', region='us-east-1')
+    assert clients.resource('s3', region='us-east-1') is s3
+
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(clients.resource('s3',
+                                                     region='us-east-1')))
+    thread.start()
+    thread.join()
+    assert other[0] is not s3
+
+    clients.reset()
+    assert clients.resource('s3', region='us-east-1') is not s3
+    return
+
+
+def test_resources_are_built_under_the_lock():
+    # Sessions are shared and not thread-safe: no two threads may build
+    # a resource from one at the same time.
+    active = []
+    overlaps = []
+    class FakeSession(object):
+        def resource(self, service, **kwargs):
+            active.append(service)
+            overlaps.append(len(active))
+            time.sleep(0.01)
+            active.remove(service)
+            return object()
+    fake = FakeSession()
+    with patch('deployer.clients.session', return_value=fake):
+        threads = [ threading.Thread(target=clients.resource, args=('s3',))
+                    for _ in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert overlaps == [ 1 ] * 8
+    return
@@ -0,0 +1,104 @@
+'''
+Unit tests for the context.py module.
+'''
+import os
+import threading
+
+from   deployer import cache
+from   deployer import clients
+from   deployer import context
+import deployer.preflight as preflight
+import deployer.utils as utils
+
+
+def _deploy(deployment, out_file, seen):
+    context.activate(deployment)
+    # Tasks handed to an executor run in the submitting deployment.
+    with context.ContextThreadPoolExecutor(max_workers=2) as executor:
+        seen[deployment.profile] = executor.submit(clients.resolve).result()
+    utils.run_command([ 'sh', '-c', 'echo "$AWS_PROFILE $AWS_DEFAULT_REGION '
+                        '${AWS_ACCESS_KEY_ID:-none}" > ' + out_file ])
+
+
+def test_concurrent_deployments(tmpdir, monkeypatch):
+    monkeypatch.setenv('AWS_PROFILE', 'process-profile')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'process-key')
+    deployments = [ context.DeploymentContext('prod', 'us-east-1'),
+                    context.DeploymentContext('dev', 'eu-west-1') ]
+    seen = {}
+    threads = [ threading.Thread(target=_deploy,
+                                 args=(d, str(tmpdir.join(d.profile)), seen))
+                for d in deployments ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert seen == { 'prod' : ('prod', 'us-east-1'),
+                     'dev'  : ('dev', 'eu-west-1') }
+    assert tmpdir.join('prod').read() == "prod us-east-1 none\n"
+    assert tmpdir.join('dev').read() == "dev eu-west-1 none\n"
+
+    # None of it leaked into the process, or this thread.
+    assert os.environ['AWS_PROFILE'] == 'process-profile'
+    assert context.current() is None
+    assert clients.resolve()[0] == 'process-profile'
+    return
+
+
+def test_using():
+    outer = context.activate(context.DeploymentContext('outer', 'us-east-1'))
+    with context.using(context.DeploymentContext('inner', 'us-west-2')):
+        assert clients.resolve() == ('inner', 'us-west-2')
+        # Explicit arguments still win.
+        assert clients.resolve('other') == ('other', 'us-west-2')
+    assert context.current() is outer
+    assert context.from_config({ 'aws_profile' : 'p',
+                                 'aws_region' : 'r' }).variables() == {
+        'AWS_DEFAULT_PROFILE' : 'p', 'AWS_PROFILE' : 'p',
+        'AWS_DEFAULT_REGION' : 'r' }
+    return
+
+
+def test_concurrent_workdirs(tmpdir):
+    # Each deployment writes its tfvars into, and removes, its own
+    # tmpdir only, however their steps interleave.
+    configs = [ { 'terraform' : 'git@gitlab.org:group/{}.git'.format(name),
+                  'tmpdir'    : str(tmpdir.join(name)) }
+                for name in [ 'prod', 'dev' ] ]
+    barrier = threading.Barrier(len(configs))
+    def deploy(config):
+        preflight.pre_setup(config)
+        barrier.wait()
+        preflight.write_vars(config, config['tfvars'])
+        barrier.wait()
+        if config['tmpdir'].endswith('dev'):
+            preflight.teardown(config)
+
+    threads = [ threading.Thread(target=deploy, args=(c,)) for c in configs ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    (prod, dev) = configs
+    assert prod['tfvars'] == str(tmpdir.join('prod', 'vars.tf'))
+    assert dev['tfvars'] == str(tmpdir.join('dev', 'vars.tf'))
+    assert tmpdir.join('prod', 'vars.tf').check()
+    assert not tmpdir.join('dev').check()
+    return
+
+
+def test_deployment_settings():
+    config = { 'aws_profile' : 'p', 'aws_region' : 'r',
+               'metadata_cache_ttl' : 0,
+               'aws_metrics' : { 'slow_call_seconds' : 1 } }
+    deployment = context.from_config(config)
+    assert deployment.settings == {
+        'metadata_cache_ttl' : 0, 'aws_metrics' : { 'slow_call_seconds' : 1 } }
+    assert context.setting('metadata_cache_ttl', 5) == 5
+    with context.using(deployment):
+        assert cache.metadata_ttl() == 0
+        assert context.setting('identity_cache_ttl', 5) == 5
+    assert cache.metadata_ttl() == cache.settings['metadata_ttl']
+    return
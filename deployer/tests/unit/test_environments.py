@@ -3,23 +3,26 @@ Unit tests for the environments.py module.
 '''
 import boto3
 import json
+import os
 import pytest
-from   mock import patch
+from   mock import Mock, patch
 from   moto import ( mock_ec2,
                      mock_s3 )
 
 from   deployer.exceptions    import ( EnvironmentExistsException,
-                                       InvalidCommandException)
+                                       InvalidCommandException,
+                                       ShellCommandException)
 import deployer.environments   as    env
+from   deployer.utils          import CommandResult
 
 import deployer.tests.MyBoto3 as MyBoto3
 
 fake_boto3 = MyBoto3.MyBoto3()
 
 
-def mock_run_cmd(args, cwd=None):
+def mock_run_cmd(args, cwd=None, env=None, **kwargs):
     print("CWD: {}, Running command: {}".format(cwd, " ".join(args)))
-    return 0
+    return CommandResult(args, 0)
 
 
 def mock_inst_is_running(instance_id):
@@ -113,7 +116,7 @@ def test_create_env_exists(mock_config):
 
         with patch('deployer.aws.instance_is_running', mock_inst_is_running):
             with patch('deployer.utils.run_command', mock_run_cmd):
-                with patch('deployer.aws.boto3', fake_boto3):
+                with patch('deployer.clients.boto3', fake_boto3):
                     env.create(mock_config)
 
     from termcolor import colored
@@ -130,7 +133,7 @@ def test_create_env_does_not_exist(mock_config):
     s3client = boto3.client('s3')
     s3client.create_bucket(Bucket="123456789012-myproj-tfstate")
     with patch('deployer.utils.run_command', mock_run_cmd):
-        with patch('deployer.aws.boto3', fake_boto3):
+        with patch('deployer.clients.boto3', fake_boto3):
             assert env.create(mock_config)
 
     return
@@ -144,6 +147,115 @@ def test_precheck_valid_keys(mock_config):
     return
 
 
+def test_precheck_uses_provider_cache(mock_config, local_cache_dir):
+    calls = []
+    def record_run_cmd(args, cwd=None, env=None, **kwargs):
+        calls.append((args, env))
+        return CommandResult(args, 0)
+
+    with patch('deployer.utils.run_command', record_run_cmd):
+        env._precheck(mock_config, 'create')
+    plugin_cache = os.path.join(local_cache_dir, 'terraform-plugins')
+    assert calls[0][0][:2] == ['terraform', 'init']
+    assert all(env_vars == { 'TF_PLUGIN_CACHE_DIR' : plugin_cache }
+               for (args, env_vars) in calls)
+    assert os.path.isdir(plugin_cache)
+    return
+
+
+def test_precheck_memoizes_steps(mock_config, tmpdir):
+    tf_root = tmpdir.join('terraform')
+    tf_root.join('main.tf').write('resource "null_resource" "a" {}\n',
+                                  ensure=True)
+    tf_root.join('.terraform', 'terraform.tfstate').write('{}', ensure=True)
+    tmpdir.join('vars.tf').write('{}')
+    mock_config['tf_root'] = str(tf_root)
+    mock_config['tfvars'] = str(tmpdir.join('vars.tf'))
+
+    def precheck(config, action='plan'):
+        calls = []
+        def record_run_cmd(args, cwd=None, env=None, **kwargs):
+            calls.append(args[1])
+            return CommandResult(args, 0)
+        with patch('deployer.utils.run_command', record_run_cmd):
+            env._precheck(config, action)
+        return calls
+
+    assert precheck(mock_config) == ['init', 'get', 'validate', 'state', 'plan']
+    # A warm workspace goes straight to terraform's real work.
+    assert precheck(mock_config) == ['state', 'plan']
+
+    tmpdir.join('vars.tf').write('{"changed": true}')
+    assert precheck(mock_config) == ['validate', 'state', 'plan']
+
+    tf_root.join('main.tf').write('resource "null_resource" "b" {}\n')
+    assert precheck(mock_config) == ['init', 'get', 'validate', 'state', 'plan']
+
+    mock_config['terraform'] += '-other'
+    assert precheck(mock_config) == ['init', 'get', 'validate', 'state', 'plan']
+
+    mock_config['tf_state'] = 'other.tfstate'
+    assert precheck(mock_config)[0] == 'init'
+
+    mock_config['memoize_preflight'] = False
+    assert precheck(mock_config) == ['get', 'validate', 'state', 'plan']
+    return
+
+
+def test_create_applies_saved_plan(mock_config, tmpdir):
+    mock_config['tmpdir'] = str(tmpdir)
+    calls = []
+    def record_run_cmd(args, cwd=None, env=None, **kwargs):
+        calls.append(args)
+        for arg in args:
+            if arg.startswith('-out='):
+                open(arg[len('-out='):], 'w').close()
+        return CommandResult(args, 0)
+
+    plan_file = str(tmpdir.join('myenvname-a-create.tfplan'))
+    with patch('deployer.utils.run_command', record_run_cmd):
+        with patch('deployer.aws.environment_exists', return_value=[]):
+            with patch('deployer.aws.tag_resources'):
+                assert env.create(mock_config)
+    assert calls[-2][:2] == ['terraform', 'plan']
+    assert calls[-2][-1] == '-out={}'.format(plan_file)
+    assert calls[-1] == ['terraform', 'apply', '-input=false', plan_file]
+    # The plan holds the environment's variables; it does not outlive
+    # the run.
+    assert not os.path.exists(plan_file)
+    return
+
+
+def test_destroy_skip_plan(mock_config):
+    mock_config['skip_plan'] = True
+    calls = []
+    def record_run_cmd(args, cwd=None, env=None, **kwargs):
+        calls.append(args)
+        return CommandResult(args, 0)
+
+    with patch('deployer.utils.run_command', record_run_cmd):
+        with patch('deployer.aws.environment_exists', side_effect=[True, []]):
+            with patch('deployer.aws.tag_resources'):
+                with patch('deployer.s3.destroy_folder'):
+                    with patch('deployer.s3.delete_object'):
+                        mock_config['env_folder'] = 'myenvname-a'
+                        assert env.destroy(mock_config)
+    assert not [ args for args in calls if args[:2] == ['terraform', 'plan'] ]
+    assert calls[-1][:3] == ['terraform', 'destroy', '-force']
+    return
+
+
+def test_precheck_plan_failure(mock_config, tmpdir):
+    mock_config['tmpdir'] = str(tmpdir)
+    def failing_plan(args, cwd=None, env=None, **kwargs):
+        return CommandResult(args, 1 if args[:2] == ['terraform', 'plan'] else 0)
+
+    with patch('deployer.utils.run_command', failing_plan):
+        with pytest.raises(ShellCommandException):
+            env._precheck(mock_config, 'destroy')
+    return
+
+
 def test_precheck_invalid_key(mock_config):
     with patch('deployer.utils.run_command', mock_run_cmd):
         with pytest.raises(InvalidCommandException):
@@ -155,7 +267,7 @@ def test_precheck_invalid_key(mock_config):
 def test_list_deployed_environment_versions(mock_config):
     mock_vpcs()
     env_name = mock_config['environment']['name']
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         existing_env_versions = env.list_deployed_environment_versions(env_name)
 
     assert existing_env_versions == [ 'a', 'b', 'c' ]
@@ -168,8 +280,24 @@ def test_get_next_env_version(mock_config):
     env_name = mock_config['environment']['name']
     expected = 'd'
 
-    with patch('deployer.aws.boto3', fake_boto3):
+    with patch('deployer.clients.boto3', fake_boto3):
         with patch('deployer.aws.instance_is_running', mock_inst_is_running):
             next_version = env.get_next_version(env_name)
 
     assert expected == next_version
+
+
+def test_get_next_env_version_skips_gaps():
+    in_use = Mock(return_value={ 'a', 'b', 'd' })
+    with patch('deployer.aws.live_environment_versions', in_use):
+        assert env.get_next_version('myenvname', 'mock_product') == 'c'
+    in_use.assert_called_once_with('myenvname', 'mock_product')
+    return
+
+
+def test_get_next_env_version_all_in_use():
+    in_use = Mock(return_value=set('abcdefghijklmnopqrstuvwxyz'))
+    with patch('deployer.aws.live_environment_versions', in_use):
+        with pytest.raises(EnvironmentExistsException):
+            env.get_next_version('myenvname')
+    return
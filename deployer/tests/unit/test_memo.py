@@ -0,0 +1,61 @@
+'''
+Unit tests for the memo.py module.
+'''
+import os
+
+import deployer.memo as memo
+
+
+def _write(path, contents):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fp:
+        fp.write(contents)
+
+
+def test_record_and_is_current(tmpdir):
+    tf_root = str(tmpdir)
+    # Nothing is recorded before terraform created .terraform.
+    memo.record(tf_root, 'init', 'abc')
+    assert not os.path.exists(memo.memo_path(tf_root))
+    assert not memo.is_current(tf_root, 'init', 'abc')
+
+    os.makedirs(os.path.join(tf_root, '.terraform'))
+    memo.record(tf_root, 'init', 'abc')
+    memo.record(tf_root, 'get', 'def')
+    assert memo.is_current(tf_root, 'init', 'abc')
+    assert not memo.is_current(tf_root, 'init', 'def')
+    assert memo.load(tf_root) == { 'init' : 'abc', 'get' : 'def' }
+
+    _write(memo.memo_path(tf_root), "not json")
+    assert memo.load(tf_root) == {}
+    return
+
+
+def test_source_digest(tmpdir, local_cache_dir):
+    tf_root = str(tmpdir.join('repo', 'env'))
+    _write(os.path.join(tf_root, 'main.tf'),
+           'module "vpc" {\n  source = "../modules/vpc"\n}\n')
+    _write(str(tmpdir.join('repo', 'modules', 'vpc', 'main.tf')),
+           'resource "aws_vpc" "vpc" {}\n')
+    _write(str(tmpdir.join('repo', 'unrelated', 'main.tf')), '')
+    first = memo.source_digest(tf_root)
+    assert memo.source_digest(tf_root) == first
+
+    # terraform's own files and unreferenced directories don't count.
+    _write(os.path.join(tf_root, '.terraform', 'terraform.tfstate'), '{}')
+    _write(str(tmpdir.join('repo', 'unrelated', 'main.tf')), 'changed')
+    assert memo.source_digest(tf_root) == first
+
+    # Local modules do.
+    _write(str(tmpdir.join('repo', 'modules', 'vpc', 'main.tf')),
+           'resource "aws_vpc" "other" {}\n')
+    second = memo.source_digest(tf_root)
+    assert second != first
+
+    _write(os.path.join(tf_root, 'outputs.tf'), '')
+    assert memo.source_digest(tf_root) != second
+
+    # Checkouts are new every run, so their digests are not cached.
+    assert not os.path.exists(os.path.join(local_cache_dir, 'file_digests'))
+    return
@@ -0,0 +1,62 @@
+'''
+Unit tests for the metrics.py module.
+'''
+from   botocore.exceptions import ClientError
+import json
+from   mock import Mock, patch
+from   moto import mock_s3
+import pytest
+
+from   deployer import clients
+from   deployer import metrics
+
+
+@mock_s3
+def test_calls_are_counted(tmpdir):
+    s3 = clients.client('s3', region='us-east-1')
+    s3.create_bucket(Bucket='bucket')
+    s3.list_objects_v2(Bucket='bucket')
+    s3.list_objects_v2(Bucket='bucket')
+    with pytest.raises(ClientError):
+        s3.head_object(Bucket='bucket', Key='missing')
+
+    stats = metrics.summary()
+    assert stats['calls'] == 4
+    assert stats['errors'] == 1
+    operations = stats['operations']
+    assert sorted(operations) == [ 's3.CreateBucket', 's3.HeadObject',
+                                   's3.ListObjectsV2' ]
+    assert operations['s3.ListObjectsV2']['calls'] == 2
+    assert sum(operations['s3.ListObjectsV2']['histogram'].values()) == 2
+    assert operations['s3.HeadObject']['errors'] == 1
+
+    metrics_file = str(tmpdir.join('metrics.json'))
+    metrics.write(metrics_file)
+    with open(metrics_file) as fp:
+        assert json.load(fp)['calls'] == 4
+    return
+
+
+def test_throttles_and_slow_calls(monkeypatch):
+    operation = Mock()
+    operation.name = 'DescribeVpcs'
+    operation.service_model.service_name = 'ec2'
+    throttled = (None, { 'Error' : { 'Code' : 'RequestLimitExceeded' } })
+    metrics._needs_retry(operation=operation, response=throttled, attempts=1)
+    metrics._needs_retry(operation=operation, response=(None, {}), attempts=2)
+
+    monkeypatch.setitem(metrics.settings, 'slow_call_seconds', 0.5)
+    context = {}
+    with patch('deployer.metrics.time.time', side_effect=[100.0, 101.0]):
+        metrics._before_call(model=operation, context=context)
+        with patch.object(metrics.logger, 'warning') as warning:
+            metrics._after_call(
+                parsed={ 'ResponseMetadata' : { 'RetryAttempts' : 1 } },
+                context=context)
+    assert warning.call_args[0][0] == \
+        "Slow AWS call: ec2.DescribeVpcs took 1.00s (1 retries)"
+
+    stats = metrics.summary()['operations']['ec2.DescribeVpcs']
+    assert (stats['calls'], stats['retries'], stats['throttles']) == (1, 1, 1)
+    assert stats['histogram']['<=1s'] == 1
+    return
@@ -0,0 +1,107 @@
+'''
+Unit tests for the pipeline.py module.
+'''
+import pytest
+import threading
+import time
+
+from   deployer import pipeline
+from   deployer.exceptions import StageCancelledException
+from   deployer.pipeline import Stage
+import deployer.utils as utils
+
+
+def test_run_respects_dependencies():
+    order = []
+    lock = threading.Lock()
+    def step(name, delay=0):
+        def function():
+            time.sleep(delay)
+            with lock:
+                order.append(name)
+        return function
+
+    stages = [ Stage('write', step('write'), ['clone', 'download', 'zone']),
+               Stage('setup', step('setup'), []),
+               Stage('clone', step('clone', 0.2), ['setup']),
+               Stage('download', step('download', 0.2), ['setup']),
+               Stage('zone', step('zone', 0.2), []) ]
+    started = time.time()
+    timings = pipeline.run(stages)
+    elapsed = time.time() - started
+
+    assert order[0] in ('setup', 'zone')
+    assert order[-1] == 'write'
+    assert sorted(timings) == sorted(s.name for s in stages)
+    # The three slow stages run side by side.
+    assert elapsed < 0.5
+    return
+
+
+def test_run_fails_fast():
+    ran = []
+    release = threading.Event()
+    def fail():
+        raise RuntimeError("boom")
+    def slow():
+        release.wait(5)
+        ran.append('slow')
+
+    stages = [ Stage('fail', fail, []),
+               Stage('slow', slow, []),
+               Stage('after_fail', lambda: ran.append('after_fail'), ['fail']),
+               Stage('after_slow', lambda: ran.append('after_slow'), ['slow']) ]
+    threading.Timer(0.2, release.set).start()
+    with pytest.raises(RuntimeError) as e:
+        pipeline.run(stages)
+    assert e.value.args[0] == "boom"
+    # Running stages are waited for, but nothing new is started.
+    assert ran == ['slow']
+    return
+
+
+def test_run_cancels_running_stages():
+    # A failure stops the commands other stages are running, and the
+    # work they queued, rather than waiting for them.
+    results = {}
+    def clone():
+        results['clone'] = utils.run_command([ 'sleep', '30' ])
+    def fail():
+        time.sleep(0.5)
+        raise RuntimeError("boom")
+    def download():
+        time.sleep(1)
+        try:
+            pipeline.check_cancelled()
+        except StageCancelledException:
+            results['download'] = 'cancelled'
+            raise
+
+    stages = [ Stage('clone', clone, []),
+               Stage('fail', fail, []),
+               Stage('download', download, []) ]
+    started = time.time()
+    with pytest.raises(RuntimeError):
+        pipeline.run(stages)
+    assert time.time() - started < 10
+    assert results['clone'].returncode < 0
+    assert results['download'] == 'cancelled'
+
+    # Outside of a pipeline there is nothing to cancel.
+    assert pipeline.current() is None
+    pipeline.check_cancelled()
+    return
+
+
+def test_run_rejects_bad_dependencies():
+    with pytest.raises(ValueError) as e:
+        pipeline.run([ Stage('a', lambda: None, ['nope']) ])
+    assert 'unknown' in e.value.args[0]
+
+    with pytest.raises(ValueError) as e:
+        pipeline.run([ Stage('a', lambda: None, ['b']),
+                       Stage('b', lambda: None, ['a']),
+                       Stage('c', lambda: None, []) ])
+    assert e.value.args[0] == "Stage dependencies form a cycle: a, b"
+    assert pipeline.run([]) == {}
+    return
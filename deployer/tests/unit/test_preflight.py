@@ -15,10 +15,14 @@ import workdir
 import pytest
 
 import deployer.preflight as preflight
+from   deployer.exceptions import MissingConfigurationParameterException
+from   deployer.utils import CommandResult
 
 
-def mock_run_cmd(args, cwd=None):
-    return "CWD: {}, Running command: {}".format(cwd, " ".join(args))
+def mock_run_cmd(args, cwd=None, env=None, **kwargs):
+    return CommandResult(args, 0,
+                         output="CWD: {}, Running command: {}".format(
+                             cwd, " ".join(args)))
 
 
 @pytest.fixture
@@ -65,6 +69,23 @@ def test_presetup(setup_teardown):
     return
 
 
+def test_presetup_local_branch_command_options(setup_teardown):
+    setup_teardown['terraform'] = "/some/local/path?branch=BRANCH_NAME"
+    setup_teardown['commands'] = { 'timeout' : 600,
+                                   'timeouts' : { 'git pull' : 60 } }
+    calls = []
+    def record_run_cmd(args, cwd=None, env=None, **kwargs):
+        calls.append((args, cwd, kwargs['timeout']))
+        return CommandResult(args, 0)
+
+    with patch('deployer.utils.run_command', record_run_cmd):
+        preflight.pre_setup(setup_teardown)
+    assert calls == [ (['git', 'pull'], '/some/local/path', 60),
+                      (['git', 'checkout', 'BRANCH_NAME'], '/some/local/path',
+                       600) ]
+    return
+
+
 @mock_route53
 @mock_s3
 def test_setup(setup_teardown):
@@ -173,12 +194,38 @@ def test_sync_terraform(setup_teardown):
     git_url = 'git@gitlab.org:group/project?branch=made_up_branch'
     setup_teardown['terraform'] = git_url
     
+    with patch('deployer.mirrors.clone') as clone:
+        preflight.sync_terraform(setup_teardown)
+    clone.assert_called_once_with('git@gitlab.org:group/project',
+                                  '/tmp/test_tmp_dir/project',
+                                  'made_up_branch',
+                                  setup_teardown)
+
+    setup_teardown['git_mirror'] = { 'enabled' : False }
     with patch('deployer.utils.run_command', mock_run_cmd):
         preflight.sync_terraform(setup_teardown)
 
     return
 
 
+def test_sync_terraform_subdir(setup_teardown):
+    setup_teardown['terraform'] = \
+        'git@gitlab.org:group/project?branch=made_up_branch//stacks/app'
+    with patch('deployer.mirrors.sparse_clone') as sparse_clone:
+        preflight.sync_terraform(setup_teardown)
+    sparse_clone.assert_called_once_with('git@gitlab.org:group/project',
+                                         '/tmp/test_tmp_dir/project',
+                                         'stacks/app',
+                                         'made_up_branch',
+                                         setup_teardown)
+
+    setup_teardown['sparse_checkout'] = False
+    with patch('deployer.mirrors.clone') as clone:
+        preflight.sync_terraform(setup_teardown)
+    assert clone.called
+    return
+
+
 def test_write_vars(setup_teardown, preconfig):
     expected_file = os.path.join(setup_teardown['tmpdir'], 'vars.tf')
     # We need to create the bucket since this is all in Moto's 'virtual'
@@ -186,3 +233,43 @@ def test_write_vars(setup_teardown, preconfig):
     preflight.write_vars(setup_teardown, setup_teardown['tfvars'])
     assert os.path.exists(expected_file)
 
+
+
+@mock_s3
+def test_copy_staged_artifacts(tmpdir, monkeypatch):
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    s3client = boto3.Session().client('s3', region_name='us-east-1')
+    s3client.create_bucket(Bucket='s3_bucket')
+    s3client.put_object(Bucket='s3_bucket', Key='artifacts/app.war',
+                        Body=b"app")
+    s3client.put_object(Bucket='s3_bucket', Key='artifacts/keys.pem',
+                        Body=b"keys")
+    config = {
+        "project_config" : "s3_bucket",
+        "env_folder" : "myenvname-a",
+        "tmpdir" : str(tmpdir.join("work")),
+        "staged_artifacts" : {
+            "artifacts/app.war"  : "local/app.war",
+            "artifacts/keys.pem" : "local/keys.pem",
+        },
+        "local_artifacts" : [ "artifacts/keys.pem" ]
+    }
+
+    # Nothing is copied unless asked for.
+    assert preflight.copy_staged_artifacts(config) == 0
+
+    config['copy_staged_artifacts'] = True
+    assert preflight.copy_staged_artifacts(config) == len(b"appkeys")
+    body = s3client.get_object(Bucket='s3_bucket',
+                               Key='myenvname-a/artifacts/app.war')['Body']
+    assert body.read() == b"app"
+
+    preflight.download_staged_artifacts(config)
+    assert os.listdir(config['tmpdir']) == [ 'keys.pem' ]
+    return
+
+
+def test_lookup_zone_id_unset():
+    with pytest.raises(MissingConfigurationParameterException):
+        preflight.lookup_zone_id({})
+    return
@@ -6,11 +6,15 @@ apparently, the features of boto3 we use have not yet been implemented
 in moto yet.
 '''
 import boto3
+import botocore
+from   mock import Mock, patch
 import pytest
 from moto import mock_s3
 from moto import mock_sts
 
 from   deployer import s3
+from   deployer.exceptions import (ObjectCopyException,
+                                 ObjectDeletionException)
 
 
 @pytest.fixture
@@ -73,3 +77,169 @@ def test_get_env_bucket_name_no_suffix(canned_config):
     return
 
 
+
+
+def list_versions(s3client, bucket, prefix=''):
+    response = s3client.list_object_versions(Bucket=bucket, Prefix=prefix)
+    return (response.get('Versions', []) + response.get('DeleteMarkers', []))
+
+
+@mock_s3
+def test_destroy_folder_purges_all_versions():
+    s3client = boto3.client('s3', region_name='us-east-1')
+    s3client.create_bucket(Bucket='mybucket')
+    s3client.put_bucket_versioning(
+        Bucket='mybucket', VersioningConfiguration={ 'Status' : 'Enabled' })
+    s3client.put_object(Bucket='mybucket', Key='myenvname-a/')
+    for i in range(7):
+        key = 'myenvname-a/dir/file{}'.format(i)
+        s3client.put_object(Bucket='mybucket', Key=key, Body=b'one')
+        s3client.put_object(Bucket='mybucket', Key=key, Body=b'two')
+    s3client.delete_object(Bucket='mybucket', Key='myenvname-a/dir/file0')
+    s3client.put_object(Bucket='mybucket', Key='myenvname-ab/keep', Body=b'')
+
+    with patch('deployer.s3.DELETE_BATCH_SIZE', 4):
+        s3.destroy_folder('mybucket', 'myenvname-a')
+
+    assert list_versions(s3client, 'mybucket', 'myenvname-a/') == []
+    assert len(list_versions(s3client, 'mybucket', 'myenvname-ab/')) == 1
+    return
+
+
+@mock_s3
+def test_delete_prefix_current_objects_only():
+    s3client = boto3.client('s3', region_name='us-east-1')
+    s3client.create_bucket(Bucket='mybucket')
+    for i in range(3):
+        s3client.put_object(Bucket='mybucket', Key='dir/{}'.format(i))
+
+    assert s3.delete_prefix('mybucket', 'dir/', all_versions=False) == 3
+    assert 'Contents' not in s3client.list_objects_v2(Bucket='mybucket')
+    return
+
+
+def test_delete_prefix_reports_errors():
+    page = { 'Versions' : [ { 'Key' : 'dir/a', 'VersionId' : '1' },
+                            { 'Key' : 'dir/b', 'VersionId' : '2' } ] }
+    client = Mock()
+    client.get_paginator.return_value.paginate.return_value = [ page ]
+    client.delete_objects.return_value = {
+        'Errors' : [ { 'Key' : 'dir/b', 'VersionId' : '2',
+                       'Code' : 'AccessDenied', 'Message' : 'Nope' } ] }
+    with patch('deployer.clients.client', return_value=client):
+        with pytest.raises(ObjectDeletionException) as e:
+            s3.delete_prefix('mybucket', 'dir/')
+    assert e.value.args[1] == { 'dir/b (2)' : 'AccessDenied: Nope' }
+    return
+
+
+@mock_s3
+def test_object_exists():
+    s3client = boto3.client('s3', region_name='us-east-1')
+    s3client.create_bucket(Bucket='mybucket')
+    s3client.put_object(Bucket='mybucket', Key='dir/file', Body=b'hello',
+                        Metadata={ 'deployer-sha256' : 'abc' })
+    s3client.put_object(Bucket='mybucket', Key='dir/file2', Body=b'')
+
+    assert s3.object_exists('mybucket', 'dir/file')
+    # A prefix of an existing key is not an object.
+    assert not s3.object_exists('mybucket', 'dir/fil')
+    assert not s3.object_exists('mybucket', 'dir')
+    assert not s3.object_exists('nosuchbucket', 'dir/file')
+
+    metadata = s3.object_metadata('mybucket', 'dir/file')
+    assert metadata['size'] == 5
+    assert metadata['etag'] == '5d41402abc4b2a76b9719d911017c592'
+    assert metadata['metadata'] == { 'deployer-sha256' : 'abc' }
+    return
+
+
+@mock_s3
+def test_objects_exist():
+    s3client = boto3.client('s3', region_name='us-east-1')
+    s3client.create_bucket(Bucket='mybucket')
+    keys = [ 'dir/{}'.format(i) for i in range(20) ]
+    for key in keys[::2]:
+        s3client.put_object(Bucket='mybucket', Key=key, Body=b'')
+
+    assert s3.objects_exist('mybucket', keys, workers=4) == {
+        key : i % 2 == 0 for i, key in enumerate(keys) }
+    assert s3.objects_exist('mybucket', []) == {}
+    return
+
+
+def test_object_exists_other_errors():
+    error = botocore.exceptions.ClientError(
+        { 'Error' : { 'Code' : '403', 'Message' : 'Forbidden' } }, 'HeadObject')
+    client = Mock(head_object=Mock(side_effect=error))
+    with patch('deployer.clients.client', return_value=client):
+        with pytest.raises(botocore.exceptions.ClientError):
+            s3.object_exists('mybucket', 'dir/file')
+    return
+
+
+def test_transfer_config():
+    transfer = s3.transfer_config({ 's3_transfer' : {
+        'multipart_chunksize' : 8 * 1024 * 1024,
+        'max_concurrency' : 1 } })
+    assert transfer.multipart_chunksize == 8 * 1024 * 1024
+    assert transfer.multipart_threshold == \
+        s3.TRANSFER_DEFAULTS['multipart_threshold']
+    assert transfer.max_request_concurrency == 1
+    assert not transfer.use_threads
+    assert s3.transfer_settings({})['file_workers'] == \
+        s3.TRANSFER_DEFAULTS['file_workers']
+    return
+
+
+@mock_s3
+def test_copy_objects(monkeypatch):
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    s3client = boto3.Session().client('s3', region_name='us-east-1')
+    s3client.create_bucket(Bucket='mybucket')
+    big = b''.join(bytes([i]) * 1024 * 1024 for i in range(11))
+    s3client.put_object(Bucket='mybucket', Key='artifacts/big', Body=big,
+                        Metadata={ 'deployer-sha256' : 'abc' })
+    s3client.put_object(Bucket='mybucket', Key='artifacts/small', Body=b'hi')
+    transfer = dict(s3.TRANSFER_DEFAULTS,
+                    multipart_threshold=5 * 1024 * 1024,
+                    multipart_chunksize=5 * 1024 * 1024)
+
+    with patch.object(s3, '_copy_multipart',
+                      wraps=s3._copy_multipart) as multipart:
+        copied = s3.copy_objects('mybucket',
+                                 { 'artifacts/big' : 'env-a/artifacts/big',
+                                   'artifacts/small' : 'env-a/artifacts/small' },
+                                 transfer=transfer)
+    assert copied == len(big) + 2
+    assert multipart.call_count == 1
+
+    response = s3client.get_object(Bucket='mybucket',
+                                   Key='env-a/artifacts/big')
+    assert response['Body'].read() == big
+    assert response['Metadata'] == { 'deployer-sha256' : 'abc' }
+    assert s3client.get_object(Bucket='mybucket',
+                               Key='env-a/artifacts/small')['Body'].read() == b'hi'
+
+    with pytest.raises(ObjectCopyException) as e:
+        s3.copy_objects('mybucket', { 'artifacts/small' : 'env-b/small',
+                                      'artifacts/nope' : 'env-b/nope' })
+    assert list(e.value.args[1]) == [ 'artifacts/nope' ]
+    assert s3.object_exists('mybucket', 'env-b/small')
+    return
+
+
+def test_copy_multipart_aborts_on_failure():
+    error = botocore.exceptions.ClientError(
+        { 'Error' : { 'Code' : '500', 'Message' : 'Oops' } }, 'UploadPartCopy')
+    client = Mock()
+    client.create_multipart_upload.return_value = { 'UploadId' : 'u1' }
+    client.upload_part_copy.side_effect = error
+    metadata = { 'size' : 12 * 1024 * 1024, 'etag' : 'e', 'metadata' : {} }
+    with pytest.raises(botocore.exceptions.ClientError):
+        s3._copy_multipart(client, { 'Bucket' : 'b', 'Key' : 'k' }, metadata,
+                           'b', 'k2', s3.TRANSFER_DEFAULTS)
+    client.abort_multipart_upload.assert_called_once_with(Bucket='b', Key='k2',
+                                                          UploadId='u1')
+    assert not client.complete_multipart_upload.called
+    return
@@ -29,7 +29,8 @@ def mock_config(scope="function"):
         "tf_state" : "myenvname-a.tfstate",
         "project_config" : "123456789012-myproj-data",
         "project" : 'myproj',
-        "tfvars" : '/tmp/test_tmp_dir/vars.tf'
+        "tfvars" : '/tmp/test_tmp_dir/vars.tf',
+        "tmpdir" : '/tmp/test_tmp_dir'
     }
 
 
@@ -117,6 +118,27 @@ def test_tf_plan_with_destroy_action(mock_config):
     return
 
 
+def test_tf_plan_with_plan_file(mock_config):
+    plan_file = tf.plan_file(mock_config, 'destroy')
+    assert plan_file == '/tmp/test_tmp_dir/myenvname-a-destroy.tfplan'
+    expected = ['terraform',
+                'plan',
+                '-destroy',
+                "-var='aws_region=us-east-1'",
+                '-var-file=/tmp/test_tmp_dir/vars.tf',
+                '-out=/tmp/test_tmp_dir/myenvname-a-destroy.tfplan',
+                ]
+    result = tf.plan(mock_config, 'destroy', plan_file)
+    assert result == expected
+    return
+
+
+def test_tf_apply_plan():
+    expected = ['terraform', 'apply', '-input=false', '/tmp/env.tfplan']
+    assert tf.apply_plan('/tmp/env.tfplan') == expected
+    return
+
+
 def test_tf_apply(mock_config):
     expected = ['terraform',
                 'apply',
@@ -151,3 +173,18 @@ def test_tf_output():
     result = tf.output(mock_tfvar)
     assert result == expected
     return
+
+
+def test_tf_init_providers():
+    assert tf.init_providers() == ['terraform', 'init', '-backend=false',
+                                   '-input=false']
+    return
+
+
+def test_tf_providers_mirror():
+    assert tf.providers_mirror('/mirror') == ['terraform', 'providers',
+                                              'mirror', '/mirror']
+    assert tf.providers_mirror('/mirror', ['linux_amd64', 'darwin_arm64']) == \
+        ['terraform', 'providers', 'mirror', '-platform=linux_amd64',
+         '-platform=darwin_arm64', '/mirror']
+    return
@@ -0,0 +1,78 @@
+'''
+Unit tests for the tracing.py module.
+'''
+import json
+import pytest
+
+import deployer.pipeline as pipeline
+import deployer.tracing as tracing
+import deployer.utils as utils
+
+
+@pytest.fixture
+def traced():
+    tracing.enable()
+    yield
+    tracing.disable()
+
+
+def test_disabled():
+    with tracing.span('nothing', a=1) as attributes:
+        tracing.annotate(b=2)
+        attributes['c'] = 3
+    assert not tracing.enabled()
+    assert tracing.spans() == []
+    return
+
+
+def test_nested_spans(traced):
+    @tracing.traced('inner')
+    def inner():
+        tracing.annotate(resources=3)
+
+    with tracing.span('outer', env_name='myenv-a') as attributes:
+        inner()
+        attributes['done'] = True
+    with pytest.raises(ValueError):
+        with tracing.span('failing'):
+            raise ValueError("boom")
+
+    (outer, child, failing) = tracing.spans()
+    assert outer['name'] == 'outer'
+    assert outer['attributes'] == { 'env_name' : 'myenv-a', 'done' : True }
+    assert child['parent'] == outer['id']
+    assert child['attributes'] == { 'resources' : 3 }
+    assert outer['start'] <= child['start'] <= child['end'] <= outer['end']
+    assert failing['parent'] is None
+    assert failing['attributes']['error'] == "ValueError: boom"
+    return
+
+
+def test_chrome_trace(traced, tmpdir):
+    stages = [ pipeline.Stage('clone', lambda: None, []),
+               pipeline.Stage('write_vars',
+                              lambda: utils.run_command(['true']),
+                              ['clone']) ]
+    with tracing.span('deployer create'):
+        pipeline.run(stages)
+
+    trace_file = str(tmpdir.join('trace.json'))
+    tracing.write(trace_file)
+    with open(trace_file) as fp:
+        trace = json.load(fp)
+
+    events = { e['name'] : e for e in trace['traceEvents'] if e['ph'] == 'X' }
+    assert sorted(events) == [ 'clone', 'deployer create', 'true', 'write_vars' ]
+    assert events['deployer create']['ts'] == 0
+    assert events['write_vars']['ts'] >= events['clone']['ts']
+    assert events['true']['args']['returncode'] == 0
+    # Commands nest within the stage which ran them, on its thread.
+    assert events['true']['args']['parent_id'] == \
+        events['write_vars']['args']['span_id']
+    assert events['true']['tid'] == events['write_vars']['tid']
+    # Stages run on worker threads, and still nest within the run.
+    for stage in [ 'clone', 'write_vars' ]:
+        assert events[stage]['args']['parent_id'] == \
+            events['deployer create']['args']['span_id']
+    assert [ e for e in trace['traceEvents'] if e['ph'] == 'M' ]
+    return
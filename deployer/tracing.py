@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright Veracode Inc., 2014
+from   contextlib import contextmanager
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(os.path.basename('deployer'))
+
+# Spans are only recorded once enable() was called (bin/deployer
+# --trace). Until then span() and annotate() cost next to nothing.
+_enabled = False
+_lock = threading.Lock()
+_spans = []
+_threads = {}
+# The open spans of the calling thread, innermost last. A context
+# variable rather than thread local, so tasks handed to a
+# ContextThreadPoolExecutor (see deployer.context) nest under the span
+# open where they were submitted.
+_open = contextvars.ContextVar('deployer_spans', default=())
+
+
+def enable():
+    """
+    Start recording spans, forgetting any recorded so far.
+
+    Args:
+        None
+
+    Returns:
+        nothing
+    """
+    global _enabled
+    with _lock:
+        del _spans[:]
+        _threads.clear()
+        _enabled = True
+    return
+
+
+def disable():
+    """
+    Stop recording spans.
+
+    Args:
+        None
+
+    Returns:
+        nothing
+    """
+    global _enabled
+    _enabled = False
+    return
+
+
+def enabled():
+    """
+    Return True if spans are being recorded.
+    """
+    return _enabled
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Record the code run inside the context as a span called NAME.
+
+    Spans nest: a span started while another one is open on the same
+    thread, or in the task which submitted it to a
+    ContextThreadPoolExecutor, is recorded as its child. The yielded dict holds the span's
+    attributes, and more can be added to it (or with annotate()) until
+    the span ends. A span the code inside raises out of is marked with
+    the exception.
+
+    Args:
+        name: string naming the span, e.g. 'terraform plan'
+        attributes: values (JSON serializable) to attach to the span,
+                    e.g. env_name.
+
+    Yields:
+        dict of the span's attributes.
+    """
+    if not _enabled:
+        yield attributes
+        return
+
+    stack = _open.get()
+    parent = stack[-1]['id'] if stack else None
+    record = { 'id' : id(attributes), 'name' : name, 'parent' : parent,
+               'thread' : threading.current_thread().ident,
+               'start' : time.time(), 'attributes' : attributes }
+    _open.set(stack + (record,))
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes['error'] = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        _open.set(stack)
+        record['end'] = time.time()
+        with _lock:
+            _spans.append(record)
+            _threads.setdefault(record['thread'],
+                                threading.current_thread().name)
+
+
+def traced(name):
+    """
+    Decorator recording every call of the decorated function as a span
+    called NAME.
+
+    Args:
+        name: string naming the span.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attributes):
+    """
+    Add ATTRIBUTES to the innermost open span of the calling thread.
+    Does nothing when no span is open.
+
+    Args:
+        attributes: values (JSON serializable) to attach to the span.
+
+    Returns:
+        nothing
+    """
+    stack = _open.get()
+    if _enabled and stack:
+        stack[-1]['attributes'].update(attributes)
+    return
+
+
+def spans():
+    """
+    Return the spans recorded so far, in the order they started.
+
+    Args:
+        None
+
+    Returns:
+        list of dicts with the keys name, parent (the id of the
+        enclosing span, or None), id, thread, start and end (seconds
+        since the epoch) and attributes.
+    """
+    with _lock:
+        return sorted(_spans, key=lambda s: s['start'])
+
+
+def chrome_trace():
+    """
+    Return the recorded spans in the Chrome trace event format, as read
+    by chrome://tracing, Perfetto and speedscope.
+
+    Args:
+        None
+
+    Returns:
+        dict (JSON serializable).
+    """
+    recorded = spans()
+    origin = min([ s['start'] for s in recorded ] or [ 0 ])
+    pid = os.getpid()
+    events = []
+    for (ident, name) in sorted(_threads.items()):
+        events.append({ 'name' : 'thread_name', 'ph' : 'M', 'pid' : pid,
+                        'tid' : ident, 'args' : { 'name' : name } })
+    for record in recorded:
+        args = dict(record['attributes'])
+        args['span_id'] = record['id']
+        if record['parent'] is not None:
+            args['parent_id'] = record['parent']
+        events.append({
+            'name' : record['name'],
+            'cat'  : 'deployer',
+            'ph'   : 'X',
+            'ts'   : int((record['start'] - origin) * 1e6),
+            'dur'  : int((record['end'] - record['start']) * 1e6),
+            'pid'  : pid,
+            'tid'  : record['thread'],
+            'args' : args,
+        })
+
+    return { 'traceEvents' : events,
+             'displayTimeUnit' : 'ms',
+             'otherData' : { 'started' : origin } }
+
+
+def write(path):
+    """
+    Write the recorded spans to PATH as a Chrome trace.
+
+    Args:
+        path: string (path) of the file to write.
+
+    Returns:
+        nothing
+    """
+    trace = chrome_trace()
+    with open(path, 'w') as fp:
+        json.dump(trace, fp, indent=1, default=str)
+    log_msg = "Wrote {} trace spans to {}"
+    logger.info(log_msg.format(len(spans()), path))
+    return
@@ -2,20 +2,78 @@
 #
 # Copyright Veracode Inc., 2014
 
+from   collections import (deque,
+                              namedtuple)
+import hashlib
 from jinja2 import Environment
 import json
 from   jsonschema import validate
 from   jsonschema.exceptions import ValidationError
 import logging
 import os
-from   subprocess import (STDOUT,
+import signal
+from   subprocess import (PIPE,
+                          STDOUT,
                           Popen )
 import sys
+import threading
+import time
 
+from   deployer import cache
+from   deployer import context
+from   deployer import pipeline
+from   deployer import tracing
 from   deployer.exceptions import EnvironmentNameException
 
 logger = logging.getLogger('deployer')
 
+# Files are hashed in chunks of this many bytes.
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+# Seconds a file digest is kept in the local cache. Entries are keyed by
+# size and mtime, so they never go stale, only unused.
+DIGEST_CACHE_TTL = 30 * 86400
+
+# Defaults for the 'commands' section of the deployer config.
+COMMAND_DEFAULTS = {
+    # Seconds any one command may run before it is stopped. None means
+    # no limit.
+    'timeout'      : None,
+
+    # Per command overrides of 'timeout', keyed by the command and its
+    # first argument, e.g. { "terraform apply" : 7200 }.
+    'timeouts'     : {},
+
+    # Seconds a timed out command gets to exit after SIGTERM, before it
+    # is killed with SIGKILL.
+    'kill_timeout' : 30,
+
+    # File the output of every command is appended to, besides the
+    # console. None turns it off.
+    'log_file'     : None,
+}
+
+# Serializes console output, so lines of commands run concurrently do
+# not interleave.
+_console_lock = threading.Lock()
+
+# Process ids of the commands run_command() is running, each the leader
+# of a session of its own. See stop_commands().
+_commands = set()
+_commands_lock = threading.Lock()
+
+# Lines of output kept in CommandResult.output.
+OUTPUT_TAIL_LINES = 200
+
+# The outcome of run_command(): the exit code (negative for the signal
+# which stopped the command), the wall clock and CPU (user + system)
+# seconds it ran for, the last OUTPUT_TAIL_LINES lines of its output,
+# and whether it was stopped for running past its timeout.
+CommandResult = namedtuple('CommandResult',
+                           ['command', 'returncode', 'elapsed', 'cpu_time',
+                            'output', 'timed_out'],
+                           defaults=[0.0, 0.0, '', False])
+
 
 def load_vars(varfile):
     """
@@ -139,31 +197,322 @@ def validate_schema(config, schema_file):
         raise
 
 
-def run_command(command, cwd=None):
+def command_settings(config):
+    """
+    Return the 'commands' section of the deployer config, filled in with
+    COMMAND_DEFAULTS.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        dict with the keys of COMMAND_DEFAULTS.
+    """
+    settings = dict(COMMAND_DEFAULTS)
+    settings.update(config.get('commands', {}))
+    return settings
+
+
+def command_options(config, command):
+    """
+    Return the run_command() keyword arguments the deployer config sets
+    for COMMAND: its timeout, kill timeout and log file.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+        command: list of command line arguments to run.
+
+    Returns:
+        dict of keyword arguments.
+    """
+    settings = command_settings(config)
+    timeout = settings['timeouts'].get(" ".join(command[:2]),
+                                       settings['timeout'])
+    return { 'timeout'      : timeout,
+             'kill_timeout' : settings['kill_timeout'],
+             'log_file'     : settings['log_file'] }
+
+
+def run_command(command, cwd=None, env=None, timeout=None, kill_timeout=30,
+                log_file=None, prefix=None):
     """
-    Runs a command "on the command line" and returns stdout/stderr in
-    real time.
+    Runs a command "on the command line", streaming its output
+    (stdout and stderr) to the console in real time.
+
+    The output is read line by line. The last OUTPUT_TAIL_LINES lines
+    are kept for the result, and every line is also appended to
+    LOG_FILE when one is given. A command which runs for longer than
+    TIMEOUT seconds is sent SIGTERM, and SIGKILL if it is still running
+    KILL_TIMEOUT seconds later, as is a command run by a pipeline stage
+    once the pipeline is cancelled (see deployer.pipeline). The command
+    runs in a session of its
+    own, and the signals go to its whole process group (e.g. terraform
+    and its providers). Processes which start a session of their own,
+    as commands run by a nested run_command do, are not reached by
+    them: a deployer run by run_command passes the SIGTERM on to its own
+    commands (see terminate_on_sigterm). Every run is a trace span (see
+    deployer.tracing).
 
     Args:
         command: list of command line arguments to run.
         cwd    : string (path) representing the location of where to run the
                  command from.
+        env    : dict of environment variables to set for the command, on
+                 top of the deployer's own environment and the AWS
+                 settings of the active DeploymentContext.
+        timeout: seconds the command may run for. None means no limit.
+        kill_timeout: seconds between SIGTERM and SIGKILL on a timeout.
+        log_file: string (path) of a file to append the output to.
+        prefix: string to start every line echoed to the console with,
+                to tell apart the output of commands run concurrently.
+
     Returns:
-        out: out put of the command run.
+        CommandResult
+    """
+    with tracing.span(" ".join(command[:2]), cwd=cwd) as attributes:
+        result = _run_command(command, cwd, env, timeout, kill_timeout,
+                              log_file, prefix)
+        attributes.update(returncode=result.returncode,
+                          cpu_time=round(result.cpu_time, 3),
+                          timed_out=result.timed_out)
+
+    return result
+
+
+def _run_command(command, cwd, env, timeout, kill_timeout, log_file, prefix):
+    """
+    run_command(), outside of its trace span.
     """
     logger.debug("{}: Running command: '{}' in {}".format(__name__,
                                                           " ".join(command),
                                                           cwd ))
-    cmd = Popen(command, shell=False, bufsize=0, stderr=STDOUT, cwd=cwd)
-    (out, err) = cmd.communicate()
-    if err:
-        sys.exit(err)
-        print(out)
-        
+    deployment = context.current()
+    if deployment:
+        env = dict(deployment.command_environment(os.environ), **(env or {}))
+    elif env:
+        env = dict(os.environ, **env)
+    pipeline.check_cancelled()
+    started = time.time()
+    cmd = Popen(command, shell=False, stdout=PIPE, stderr=STDOUT, cwd=cwd,
+                env=env, start_new_session=True)
+    with _commands_lock:
+        _commands.add(cmd.pid)
+
+    timed_out = threading.Event()
+    timers = []
+    def stop(sig):
+        if sig == signal.SIGTERM:
+            timed_out.set()
+            logger.error("{} timed out after {}s, stopping it.".format(
+                command, timeout))
+            timers.append(threading.Timer(kill_timeout, stop,
+                                          [ signal.SIGKILL ]))
+            timers[-1].daemon = True
+            timers[-1].start()
+        _signal_group(cmd.pid, sig)
+
+    if timeout:
+        timers.append(threading.Timer(timeout, stop, [ signal.SIGTERM ]))
+        timers[-1].daemon = True
+        timers[-1].start()
+
+    def cancel():
+        logger.error("Stopping {}, the pipeline was cancelled.".format(
+            command))
+        _signal_group(cmd.pid, signal.SIGTERM)
+        # Only signals the command if it has not been reaped yet.
+        timers.append(threading.Timer(kill_timeout, stop_command,
+                                      [ cmd.pid, signal.SIGKILL ]))
+        timers[-1].daemon = True
+        timers[-1].start()
+
+    cancellation = pipeline.current()
+    if cancellation:
+        cancellation.register(cancel)
+
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    log = open(log_file, 'ab') if log_file else None
+    try:
+        if log:
+            log.write("$ {}\n".format(" ".join(command)).encode('utf-8'))
+        for line in iter(cmd.stdout.readline, b''):
+            text = line.decode('utf-8', 'replace')
+            tail.append(text)
+            with _console_lock:
+                sys.stdout.write(prefix + text if prefix else text)
+                sys.stdout.flush()
+            if log:
+                log.write(line)
+    except BaseException:
+        # e.g. Ctrl-C, which the command's own session does not get.
+        _signal_group(cmd.pid, signal.SIGTERM)
+        with _commands_lock:
+            _commands.discard(cmd.pid)
+        cmd.wait()
+        raise
+    finally:
+        if cancellation:
+            cancellation.unregister(cancel)
+        for timer in list(timers):
+            timer.cancel()
+        cmd.stdout.close()
+        if log:
+            log.close()
+
+    # Forgotten before it is reaped, so its pid can not have been reused
+    # by the time stop_commands() signals it.
+    with _commands_lock:
+        _commands.discard(cmd.pid)
+    # Reaped with wait4() rather than wait(), for its resource usage.
+    (_, status, rusage) = os.wait4(cmd.pid, 0)
+    if os.WIFSIGNALED(status):
+        cmd.returncode = -os.WTERMSIG(status)
+    else:
+        cmd.returncode = os.WEXITSTATUS(status)
+    for timer in list(timers):
+        timer.cancel()
+
+    result = CommandResult(command, cmd.returncode, time.time() - started,
+                           rusage.ru_utime + rusage.ru_stime, "".join(tail),
+                           timed_out.is_set())
+    log_msg = "{}: '{}' finished with code {} in {:.2f}s ({:.2f}s CPU)"
+    logger.debug(log_msg.format(__name__, " ".join(command), result.returncode,
+                                result.elapsed, result.cpu_time))
     if cmd.returncode != 0:
         logger.error("{} failed with code {}.".format(command, cmd.returncode))
-                                 
-    return cmd.returncode
+
+    return result
+
+
+def stop_commands(sig=signal.SIGTERM):
+    """
+    Send SIG to every command run_command() is running, in any thread.
+
+    Args:
+        sig: signal number.
+
+    Returns:
+        nothing
+    """
+    with _commands_lock:
+        pids = list(_commands)
+    for pid in pids:
+        _signal_group(pid, sig)
+
+    return
+
+
+def stop_command(pid, sig):
+    """
+    Send SIG to the command run_command() is running as PID, if it is
+    still running.
+
+    Args:
+        pid: process id of the command.
+        sig: signal number.
+
+    Returns:
+        nothing
+    """
+    with _commands_lock:
+        running = pid in _commands
+    if running:
+        _signal_group(pid, sig)
+
+    return
+
+
+def terminate_on_sigterm():
+    """
+    Make SIGTERM stop the deployer the way Ctrl-C does: the running
+    commands (each in a session of its own, which the signal sent to
+    the deployer's process group does not reach) are sent SIGTERM, and
+    SystemExit is raised in the main thread, so the deployer waits for
+    them and cleans up. Without it, a deployer stopped by 'deployer
+    batch --timeout' would die at once and leave e.g. terraform apply
+    running, holding the state lock.
+
+    Call from the main thread.
+
+    Args:
+        None
+
+    Returns:
+        nothing
+    """
+    def handler(signum, frame):
+        logger.error("Received signal {}, stopping.".format(signum))
+        stop_commands(signum)
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, handler)
+    return
+
+
+def _signal_group(pid, sig):
+    """
+    Send SIG to the process group (session) led by PID, if it is still
+    around.
+    """
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+    return
+
+
+def format_bytes(size):
+    """
+    Return a human readable representation of a number of bytes.
+
+    Args:
+        size: number of bytes
+
+    Returns:
+        string, e.g. '1.5 MiB'
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if abs(size) < 1024 or unit == 'TiB':
+            break
+        size /= 1024.0
+
+    if unit == 'B':
+        return "{} {}".format(int(size), unit)
+    return "{:.1f} {}".format(size, unit)
+
+
+def file_digest(path, cached=True):
+    """
+    Return the SHA-256 digest of a file.
+
+    The file is read in fixed size chunks, so large files are never
+    loaded into memory. Digests are cached locally, keyed by path, size
+    and modification time, so unchanged files are only hashed once.
+
+    Args:
+        path: string (file path) of the file to hash.
+        cached: boolean. Use the local digest cache. Turn it off for
+                short-lived files.
+
+    Returns:
+        string: hex digest.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = [ path, stat.st_size, stat.st_mtime_ns ]
+
+    def compute():
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(DIGEST_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    ttl = DIGEST_CACHE_TTL if cached else 0
+    return cache.memoize('file_digests', key, compute, ttl)
 
 
 def git_clone(repo, branch=None):
@@ -316,6 +665,28 @@ def get_tf_location(config):
         return tf_root
 
 
+def substitute_api_token(config):
+    """
+    Replace the string API_TOKEN in config['terraform'] with the
+    contents of the environment variable API_TOKEN, so repositories
+    which need a token can be cloned over https. Needs no AWS access.
+
+    Args:
+        config: dictionary containing all variable settings required
+                to run terraform with
+
+    Returns:
+        config, with config['API_TOKEN'] set when a token was substituted.
+    """
+    if os.environ.get('API_TOKEN') and "API_TOKEN" in config.get('terraform', ''):
+        git_url = config['terraform']
+        config['terraform'] = git_url.replace("API_TOKEN",
+                                              os.environ['API_TOKEN'])
+        config['API_TOKEN'] = os.environ['API_TOKEN']
+
+    return config
+
+
 def parseConfigOpts(configVars):
     newConfigVars = {}
     for item in configVars:
@@ -26,8 +26,8 @@ setup(
     include_package_data=True,
     install_requires=[
         'argparse',
-        'botocore',
-        'boto3',
+        'botocore>=1.27',
+        'boto3>=1.24',
         'docopt',
         'flake8',
         'jinja2',